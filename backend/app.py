@@ -5,6 +5,8 @@ Backend API - Flask 應用主程式
 from flask import Flask, jsonify, request
 from flask_cors import CORS
 from services.mcp_client import mcp_client
+from services.ingest_queue import ingest_queue
+from services.db_pool import db_pool
 from routes.chat import chat_bp
 from routes.mcp import mcp_bp
 from routes.line import line_bp
@@ -59,6 +61,20 @@ def health_check():
     })
 
 
+@app.route('/api/health/db-pool', methods=['GET'])
+def db_pool_stats():
+    """
+    資料庫連線池統計 (連線數、使用率、等待次數與逾時次數)
+    
+    Returns:
+        連線池統計 JSON
+    """
+    return jsonify({
+        "success": True,
+        "data": db_pool.stats()
+    })
+
+
 @app.route('/api/mcp/status', methods=['GET'])
 def get_mcp_status():
     """
@@ -221,11 +237,22 @@ def get_tool_info(tool_name):
         }), 500
 
 
-if __name__ == '__main__':
+def main():
+    """
+    啟動後端服務
+
+    正式啟動請使用 run.py: 解析行程池的 worker 會重新匯入 __main__ 模組,
+    以輕量的 run.py 作為 __main__ 可避免每個 worker 重新載入本模組與所有路由、服務
+    """
     # 啟動時自動連線 MCP Server
     print("正在連線 MCP Server...")
     mcp_client.connect()
     
+    # 啟動知識庫背景處理並接續未完成的工作
+    # (debug reloader 的監看行程不處理請求,只在實際服務的子行程啟動;其他情況會在第一次排入工作時啟動)
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        ingest_queue.start()
+    
     # 啟動 Flask 應用
     # 監聽所有介面的 5000 端口
     app.run(
@@ -233,3 +260,7 @@ if __name__ == '__main__':
         port=5000,
         debug=True
     )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+切分效能基準測試
+以數 MB 的中文與英文語料測試四種切分策略 (character, token, semantic, recursive)
+
+用法:
+    python benchmark_chunking.py                     # 預設 4 MB 合成語料
+    python benchmark_chunking.py --size-mb 16 --repeat 5
+    python benchmark_chunking.py --file docs/a.txt   # 額外測試指定檔案
+    python benchmark_chunking.py --legacy            # 一併測試舊版 (字串累加) 實作作為對照
+"""
+import sys
+import os
+import time
+import random
+import argparse
+
+# 添加 backend 目錄到路徑
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from services import chunking
+
+STRATEGIES = ['character', 'token', 'semantic', 'recursive']
+
+_ZH_WORDS = ["知識庫", "向量", "檢索", "模型", "資料", "系統", "使用者", "文件", "索引", "查詢",
+             "伺服器", "服務", "設定", "工具", "結果", "效能", "處理", "內容", "問題", "回應"]
+_EN_WORDS = ["knowledge", "vector", "retrieval", "model", "data", "system", "user", "document",
+             "index", "query", "server", "service", "config", "tool", "result", "latency", "the", "of", "and", "a"]
+# 移除所有句尾標點、空白與換行,產生無分隔符號的長文
+_STRIP_TABLE = str.maketrans("", "", "。！？.!? \n")
+
+
+def make_corpus(language: str, size_mb: float, seed: int = 0) -> str:
+    """產生指定大小 (UTF-8 位元組) 的合成語料,含句子、段落與換行"""
+    rng = random.Random(seed)
+    target = int(size_mb * 1024 * 1024)
+    words, joiner, stops = (_ZH_WORDS, "", "。！？") if language == 'zh' else (_EN_WORDS, " ", ".!?")
+    parts = []
+    size = 0
+    while size < target:
+        sentence = joiner.join(rng.choice(words) for _ in range(rng.randint(6, 30))) + rng.choice(stops)
+        if language == 'en':
+            sentence = sentence.capitalize() + " "
+        roll = rng.random()
+        if roll < 0.05:
+            sentence += "\n\n"
+        elif roll < 0.15:
+            sentence += "\n"
+        parts.append(sentence)
+        size += len(sentence.encode('utf-8'))
+    return "".join(parts)
+
+
+def load_encoding():
+    """載入 tiktoken 編碼器 (離線時無法下載則略過 token 策略)"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"⚠ 無法載入 tiktoken 編碼器,略過 token 策略: {str(e)}")
+        return None
+
+
+def run_spans(text: str, strategy: str, encoding, chunk_size: int, chunk_overlap: int):
+    if strategy == 'character':
+        return chunking.character_spans(text, chunk_size, chunk_overlap)
+    if strategy == 'token':
+        return chunking.token_spans(text, encoding, chunk_size, chunk_overlap)
+    if strategy == 'semantic':
+        return chunking.semantic_spans(text, chunk_size)
+    return chunking.recursive_spans(text, chunk_size, chunk_overlap)
+
+
+# --- 舊版實作 (對照用) ---
+
+def legacy_split(text: str, strategy: str, encoding, chunk_size: int, chunk_overlap: int):
+    import re
+
+    def character_split(text, chunk_size, chunk_overlap):
+        chunks = []
+        start = 0
+        while start < len(text):
+            end = start + chunk_size
+            chunks.append(text[start:end])
+            start = end - chunk_overlap
+        return chunks
+
+    if strategy == 'character':
+        return character_split(text, chunk_size, chunk_overlap)
+
+    if strategy == 'token':
+        tokens = encoding.encode(text)
+        chunks = []
+        start = 0
+        while start < len(tokens):
+            end = start + chunk_size
+            chunks.append(encoding.decode(tokens[start:end]))
+            start = end - chunk_overlap
+        return chunks
+
+    if strategy == 'semantic':
+        chunks = []
+        current_chunk = ""
+        for sentence in re.split(r'[。！？\n]+|[.!?\n]+', text):
+            sentence = sentence.strip()
+            if not sentence:
+                continue
+            if len(current_chunk) + len(sentence) <= chunk_size:
+                current_chunk += sentence + "。"
+            else:
+                if current_chunk:
+                    chunks.append(current_chunk)
+                current_chunk = sentence + "。"
+        if current_chunk:
+            chunks.append(current_chunk)
+        return chunks
+
+    def split_with_separators(text, seps):
+        if not seps:
+            return character_split(text, chunk_size, chunk_overlap)
+        sep = seps[0]
+        splits = text.split(sep) if sep else list(text)
+        chunks = []
+        current_chunk = ""
+        for split in splits:
+            if len(current_chunk) + len(split) + len(sep) <= chunk_size:
+                current_chunk += split + sep
+            else:
+                if current_chunk:
+                    chunks.append(current_chunk)
+                if len(split) > chunk_size:
+                    chunks.extend(split_with_separators(split, seps[1:]))
+                    current_chunk = ""
+                else:
+                    current_chunk = split + sep
+        if current_chunk:
+            chunks.append(current_chunk)
+        return chunks
+
+    return split_with_separators(text, chunking.RECURSIVE_SEPARATORS)
+
+
+def bench(fn, repeat: int):
+    """回傳 (最佳耗時秒數, 最後一次結果)"""
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="切分效能基準測試")
+    parser.add_argument('--size-mb', type=float, default=4, help="合成語料大小 (MB)")
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--chunk-overlap', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3, help="每項測試重複次數 (取最佳)")
+    parser.add_argument('--file', action='append', default=[], help="額外測試的 UTF-8 文字檔")
+    parser.add_argument('--legacy', action='store_true', help="一併測試舊版實作")
+    args = parser.parse_args()
+
+    encoding = load_encoding()
+    corpora = [(f"中文 {args.size_mb:g}MB", make_corpus('zh', args.size_mb)),
+               (f"英文 {args.size_mb:g}MB", make_corpus('en', args.size_mb)),
+               # 沒有任何分隔符號的長文 (例如 OCR 結果),遞歸切分會一路退回到逐字元層級
+               (f"無標點 {args.size_mb:g}MB", make_corpus('zh', args.size_mb).translate(_STRIP_TABLE))]
+    for path in args.file:
+        with open(path, "r", encoding="utf-8") as f:
+            corpora.append((os.path.basename(path), f.read()))
+
+    print("=" * 78)
+    print(f"切分效能基準測試 (chunk_size={args.chunk_size}, overlap={args.chunk_overlap}, repeat={args.repeat})")
+    print("=" * 78)
+    header = f"{'語料':<16}{'策略':<12}{'chunks':>10}{'耗時(ms)':>12}{'MB/s':>10}"
+    if args.legacy:
+        header += f"{'舊版(ms)':>12}{'加速':>8}"
+    print(header)
+    print("-" * 78)
+
+    for name, text in corpora:
+        mb = len(text.encode('utf-8')) / 1024 / 1024
+        for strategy in STRATEGIES:
+            if strategy == 'token' and encoding is None:
+                continue
+            seconds, spans = bench(
+                lambda: run_spans(text, strategy, encoding, args.chunk_size, args.chunk_overlap), args.repeat)
+            line = f"{name:<16}{strategy:<12}{len(spans):>10}{seconds * 1000:>12.1f}{mb / seconds:>10.1f}"
+            if args.legacy:
+                legacy_seconds, _ = bench(
+                    lambda: legacy_split(text, strategy, encoding, args.chunk_size, args.chunk_overlap), 1)
+                line += f"{legacy_seconds * 1000:>12.1f}{legacy_seconds / seconds:>7.1f}x"
+            print(line)
+    print("=" * 78)
+
+
+if __name__ == '__main__':
+    main()
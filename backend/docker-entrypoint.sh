@@ -33,7 +33,7 @@ echo "開始初始化數據庫..."
 echo "============================================================"
 
 echo ""
-echo "[1/9] 建立基礎資料表 (conversations, messages)..."
+echo "[1/10] 建立基礎資料表 (conversations, messages)..."
 if python init_db.py; then
   echo "✓ 基礎資料表初始化完成"
 else
@@ -41,7 +41,7 @@ else
 fi
 
 echo ""
-echo "[2/9] 建立 MCP Servers 資料表..."
+echo "[2/10] 建立 MCP Servers 資料表..."
 if python create_mcp_servers_table.py; then
   echo "✓ MCP Servers 資料表初始化完成"
 else
@@ -49,7 +49,7 @@ else
 fi
 
 echo ""
-echo "[3/9] 建立 LINE Bot 相關資料表..."
+echo "[3/10] 建立 LINE Bot 相關資料表..."
 if python init_line_db.py; then
   echo "✓ LINE Bot 資料表初始化完成"
 else
@@ -58,7 +58,7 @@ fi
 
 # Step 4: 系統提示詞資料庫初始化
 echo ""
-echo "[4/9] 建立系統提示詞資料表..."
+echo "[4/10] 建立系統提示詞資料表..."
 if python init_prompts_db.py; then
   echo "✓ 系統提示詞資料表初始化完成"
 else
@@ -67,7 +67,7 @@ fi
 
 # Step 5: RAG 資料庫初始化
 echo ""
-echo "[5/9] 建立 RAG 資料表..."
+echo "[5/10] 建立 RAG 資料表..."
 if python init_rag_db.py; then
   echo "✓ RAG 資料表初始化完成"
 else
@@ -76,34 +76,43 @@ fi
 
 # Step 6: 知識庫配置遷移
 echo ""
-echo "[6/9] 建立知識庫配置表..."
+echo "[6/10] 建立知識庫配置表..."
 if python migrations/add_kb_configs.py; then
   echo "✓ 知識庫配置表初始化完成"
 else
   echo "⚠ add_kb_configs.py 執行失敗或表已存在"
 fi
 
-# Step 7: Agent 資料庫初始化
+# Step 7: 背景處理工作表遷移
 echo ""
-echo "[7/9] 建立 AI Agent 資料表..."
+echo "[7/10] 建立知識庫背景處理工作表..."
+if python migrations/add_ingest_jobs.py; then
+  echo "✓ 背景處理工作表初始化完成"
+else
+  echo "⚠ add_ingest_jobs.py 執行失敗或表已存在"
+fi
+
+# Step 8: Agent 資料庫初始化
+echo ""
+echo "[8/10] 建立 AI Agent 資料表..."
 if python init_agents_db.py; then
   echo "✓ AI Agent 資料表初始化完成"
 else
   echo "⚠ init_agents_db.py 執行失敗或表已存在"
 fi
 
-# Step 8: 認證與權限管理資料庫初始化
+# Step 9: 認證與權限管理資料庫初始化
 echo ""
-echo "[8/9] 建立認證與權限管理資料表..."
+echo "[9/10] 建立認證與權限管理資料表..."
 if python init_auth_db.py; then
   echo "✓ 認證與權限管理資料表初始化完成"
 else
   echo "⚠ init_auth_db.py 執行失敗或表已存在"
 fi
 
-# Step 9: 資料遷移 (建立預設管理員和權限)
+# Step 10: 資料遷移 (建立預設管理員和權限)
 echo ""
-echo "[9/9] 執行資料遷移 (建立預設管理員和權限)..."
+echo "[10/10] 執行資料遷移 (建立預設管理員和權限)..."
 if python migrate_existing_data.py; then
   echo "✓ 資料遷移完成"
 else
@@ -119,4 +128,4 @@ echo "============================================================"
 echo ""
 echo "啟動 Flask 應用..."
 echo "============================================================"
-exec python app.py
+exec python run.py
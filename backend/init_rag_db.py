@@ -103,6 +103,15 @@ def init_db():
         else:
             print("line_bot_configs 表已存在 kb_id 欄位")
             
+        # 6. 修改 kb_files 表，增加 tags (檢索時依標籤過濾)
+        print("檢查並修改 kb_files 表 (增加 tags)...")
+        cursor.execute("SHOW COLUMNS FROM kb_files LIKE 'tags'")
+        if not cursor.fetchone():
+            cursor.execute("ALTER TABLE kb_files ADD COLUMN tags JSON DEFAULT NULL")
+            print("已添加 tags 到 kb_files 表")
+        else:
+            print("kb_files 表已存在 tags 欄位")
+            
         conn.commit()
         print("RAG 資料庫初始化完成！")
         
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+背景處理工作表遷移腳本
+記錄知識庫檔案向量化工作的狀態與進度
+"""
+import pymysql
+import os
+import sys
+
+# 資料庫連線設定
+DB_CONFIG = {
+    'host': os.getenv('DB_HOST', 'db'),
+    'port': int(os.getenv('DB_PORT', '3306')),
+    'user': os.getenv('DB_USER', 'mcp_user'),
+    'password': os.getenv('DB_PASSWORD', 'mcp_password'),
+    'database': os.getenv('DB_NAME', 'mcp_platform'),
+    'charset': 'utf8mb4'
+}
+
+def run_migration():
+    """執行資料庫遷移"""
+    try:
+        print("=" * 60)
+        print("背景處理工作表遷移")
+        print("=" * 60)
+
+        connection = pymysql.connect(**DB_CONFIG)
+        cursor = connection.cursor()
+
+        print("\n[1/1] 檢查 ingest_jobs 表...")
+        cursor.execute("""
+            SELECT COUNT(*)
+            FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = %s
+            AND TABLE_NAME = 'ingest_jobs'
+        """, (DB_CONFIG['database'],))
+
+        if cursor.fetchone()[0] == 0:
+            print("創建 ingest_jobs 表...")
+            cursor.execute("""
+                CREATE TABLE ingest_jobs (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    kb_id INT NOT NULL,
+
+                    -- 工作參數
+                    file_ids JSON NOT NULL COMMENT '要處理的檔案 ID',
+                    rebuild BOOLEAN DEFAULT FALSE COMMENT '是否強制整體重建',
+
+                    -- 狀態與進度
+                    status ENUM('queued', 'running', 'completed', 'failed') DEFAULT 'queued',
+                    stage VARCHAR(50) DEFAULT NULL COMMENT '目前階段: extracting, indexing',
+                    mode VARCHAR(20) DEFAULT NULL COMMENT 'rebuild、incremental 或 remove (移除已刪除的檔案)',
+                    total_files INT DEFAULT 0,
+                    processed_files INT DEFAULT 0,
+                    failed_files INT DEFAULT 0,
+                    chunks_count INT DEFAULT 0,
+                    result JSON COMMENT '完成後的處理結果',
+                    error_message TEXT,
+
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    started_at TIMESTAMP NULL DEFAULT NULL,
+                    finished_at TIMESTAMP NULL DEFAULT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+
+                    FOREIGN KEY (kb_id) REFERENCES knowledge_bases(id) ON DELETE CASCADE,
+                    INDEX idx_kb_created (kb_id, created_at),
+                    INDEX idx_status (status)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                COMMENT='知識庫背景處理工作表'
+            """)
+            connection.commit()
+            print("✓ ingest_jobs 表創建成功")
+        else:
+            print("✓ ingest_jobs 表已存在,跳過")
+
+        cursor.close()
+        connection.close()
+
+        print("\n" + "=" * 60)
+        print("✓ 遷移完成!")
+        print("=" * 60)
+        return 0
+
+    except Exception as e:
+        print(f"\n✗ 遷移失敗: {str(e)}", file=sys.stderr)
+        import traceback
+        traceback.print_exc()
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(run_migration())
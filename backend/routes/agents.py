@@ -5,25 +5,15 @@ Agent API 路由
 from flask import Blueprint, request, jsonify
 import pymysql
 import json
-import os
+from services.db_pool import get_connection
 
 # 建立 Blueprint
 agents_bp = Blueprint('agents', __name__, url_prefix='/api/agents')
 
-# 資料庫連線設定
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'db'),
-    'port': int(os.getenv('DB_PORT', '3306')),
-    'user': os.getenv('DB_USER', 'mcp_user'),
-    'password': os.getenv('DB_PASSWORD', 'mcp_password'),
-    'database': os.getenv('DB_NAME', 'mcp_platform'),
-    'charset': 'utf8mb4'
-}
-
 
 def get_db_connection():
     """取得資料庫連線"""
-    return pymysql.connect(**DB_CONFIG)
+    return get_connection()
 
 
 @agents_bp.route('', methods=['GET'])
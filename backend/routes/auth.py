@@ -5,22 +5,12 @@
 from flask import Blueprint, request, jsonify
 import pymysql
 from services.auth_service import AuthService, require_auth
+from services.db_pool import get_connection
 from datetime import datetime
-import os
 
 # 建立 Blueprint
 auth_bp = Blueprint('auth', __name__, url_prefix='/api/auth')
 
-# 資料庫連線設定
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'db'),
-    'port': int(os.getenv('DB_PORT', '3306')),
-    'user': os.getenv('DB_USER', 'mcp_user'),
-    'password': os.getenv('DB_PASSWORD', 'mcp_password'),
-    'database': os.getenv('DB_NAME', 'mcp_platform'),
-    'charset': 'utf8mb4'
-}
-
 
 @auth_bp.route('/register', methods=['POST'])
 def register():
@@ -67,7 +57,7 @@ def register():
                 'error': 'Email 格式不正確'
             }), 400
         
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 檢查使用者名稱是否已存在
@@ -152,7 +142,7 @@ def login():
         username = data['username'].strip()
         password = data['password']
         
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 查詢使用者 (支援使用者名稱或 Email 登入)
@@ -243,7 +233,7 @@ def get_current_user():
     try:
         user_id = request.current_user['id']
         
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 查詢使用者資訊
@@ -316,7 +306,7 @@ def update_profile():
                 'error': 'Email 格式不正確'
             }), 400
         
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 檢查 Email 是否已被其他使用者使用
@@ -387,7 +377,7 @@ def change_password():
                 'error': '新密碼至少需要 8 個字元'
             }), 400
         
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 查詢使用者
@@ -2,32 +2,30 @@
 Chat API 路由
 提供 Chatbot 相關的 API 端點
 """
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 import pymysql
 import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from services.ai_client import AIClientFactory
 from services.mcp_client import mcp_client
 from services.rag_service import rag_service
 from services.auth_service import require_auth, require_permission
+from services.db_pool import get_connection
 
 # 建立 Blueprint
 chat_bp = Blueprint('chat', __name__, url_prefix='/api/chat')
 
-# 資料庫連線設定
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'db'),
-    'port': int(os.getenv('DB_PORT', '3306')),
-    'user': os.getenv('DB_USER', 'mcp_user'),
-    'password': os.getenv('DB_PASSWORD', 'mcp_password'),
-    'database': os.getenv('DB_NAME', 'mcp_platform'),
-    'charset': 'utf8mb4'
-}
+# 呼叫 AI 前並行執行 RAG 檢索與 MCP 工具列表的執行緒數 (所有請求共用)
+CHAT_CONTEXT_WORKERS = int(os.getenv('CHAT_CONTEXT_WORKERS', '8'))
+_context_executor = ThreadPoolExecutor(max_workers=max(1, CHAT_CONTEXT_WORKERS),
+                                       thread_name_prefix="chat-context")
 
 
 def get_db_connection():
     """取得資料庫連線"""
-    return pymysql.connect(**DB_CONFIG)
+    return get_connection()
 
 
 @chat_bp.route('/conversations', methods=['POST'])
@@ -62,7 +60,7 @@ def create_conversation():
             model_name = agent['model_name']
             system_prompt_id = agent['system_prompt_id']
             
-            # 載入 Agent 的知識庫 (取第一個)
+            # 載入 Agent 的知識庫 (對話記錄優先順序最高者;檢索時會查詢 Agent 的所有知識庫)
             cursor.execute("""
                 SELECT kb_id FROM agent_knowledge_bases
                 WHERE agent_id = %s
@@ -294,26 +292,66 @@ def get_conversation(conversation_id):
         }), 500
 
 
-@chat_bp.route('/conversations/<int:conversation_id>/messages', methods=['POST'])
-@require_permission('func_chat_create')
-def send_message(conversation_id):
-    """發送訊息並取得 AI 回應"""
+def _timed(fn, *args):
+    """執行 fn 並回傳 (結果, 耗時毫秒)"""
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def _retrieve_context(kb_ids, user_message):
+    """從知識庫檢索與使用者訊息相關的參考資料"""
+    print(f"[RAG] 正在從知識庫 {kb_ids} 檢索相關內容...")
+    if len(kb_ids) == 1:
+        return rag_service.query_kb(kb_ids[0], user_message)
+    return rag_service.query_kbs(kb_ids, user_message)
+
+
+def _list_mcp_tools(conversation):
+    """取得對話選中的 MCP servers 提供的工具列表 (失敗時返回 None)"""
+    try:
+        # 取得該對話選中的 MCP servers
+        mcp_servers = conversation.get('mcp_servers')
+        if isinstance(mcp_servers, str):
+            mcp_servers = json.loads(mcp_servers)
+        
+        print(f"[MCP] MCP 已啟用, 選中服務: {mcp_servers}, 正在取得工具列表...")
+        # 根據選中的 servers 過濾工具
+        tools = mcp_client.list_tools(server_ids=mcp_servers)
+        print(f"[MCP] 取得 {len(tools)} 個過濾後的工具")
+        if tools:
+            print(f"[MCP] 工具名稱: {[t.get('name', 'unknown') for t in tools]}")
+            print(f"[MCP] 工具詳情: {tools}")
+        else:
+            print(f"[MCP] 警告: 工具列表為空!")
+        return tools
+    except Exception as e:
+        print(f"[MCP] 取得工具失敗: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+
+def _prepare_messages(conversation_id, user_message):
+    """
+    儲存使用者訊息並組合送給 AI 的訊息 (對話歷史、RAG 參考資料與系統提示詞),取得 MCP 工具列表
+    
+    RAG 檢索與 MCP 工具列表在背景執行緒進行,同時在目前執行緒
+    儲存訊息、讀取歷史與系統提示詞,全部完成後才組合訊息;
+    資料庫連線只在讀寫期間持有,不跨過等待背景階段與 AI 呼叫
+    
+    Returns:
+        (對話設定, 訊息列表, 工具列表);對話不存在時返回 None
+    """
+    start = time.perf_counter()
+    
+    conn = get_db_connection()
     try:
-        data = request.get_json()
-        user_message = data.get('content', '')
-        
-        if not user_message:
-            return jsonify({
-                "success": False,
-                "error": "訊息內容不可為空"
-            }), 400
-        
-        conn = get_db_connection()
         cursor = conn.cursor(pymysql.cursors.DictCursor)
         
         # 取得對話設定
         cursor.execute("""
-            SELECT model_provider, model_name, mcp_enabled, mcp_servers, system_prompt_id, kb_id
+            SELECT model_provider, model_name, mcp_enabled, mcp_servers, system_prompt_id, kb_id, agent_id
             FROM conversations
             WHERE id = %s
         """, (conversation_id,))
@@ -321,10 +359,28 @@ def send_message(conversation_id):
         conversation = cursor.fetchone()
         
         if not conversation:
-            return jsonify({
-                "success": False,
-                "error": "對話不存在"
-            }), 404
+            return None
+        
+        # Agent 對話檢索 Agent 綁定的所有知識庫 (依優先順序)
+        kb_ids = []
+        if conversation.get('agent_id'):
+            cursor.execute("""
+                SELECT kb_id FROM agent_knowledge_bases
+                WHERE agent_id = %s
+                ORDER BY priority ASC
+            """, (conversation['agent_id'],))
+            kb_ids = [row['kb_id'] for row in cursor.fetchall()]
+        if not kb_ids and conversation['kb_id']:
+            kb_ids = [conversation['kb_id']]
+        
+        # 彼此獨立的階段並行執行: RAG 檢索、MCP 工具列表 (背景) 與資料庫讀寫 (目前執行緒)
+        rag_future = _context_executor.submit(_timed, _retrieve_context, kb_ids, user_message) if kb_ids else None
+        if conversation['mcp_enabled']:
+            tools_future = _context_executor.submit(_timed, _list_mcp_tools, conversation)
+        else:
+            tools_future = None
+            print(f"[MCP] MCP 未啟用")
+        db_start = time.perf_counter()
         
         # 儲存使用者訊息
         cursor.execute("""
@@ -344,19 +400,8 @@ def send_message(conversation_id):
         history = cursor.fetchall()
         messages = [{"role": msg["role"], "content": msg["content"]} for msg in history]
         
-        # 如果有知識庫，進行 RAG 檢索
-        if conversation['kb_id']:
-            print(f"[RAG] 正在從知識庫 {conversation['kb_id']} 檢索相關內容...")
-            context_chunks = rag_service.query_kb(conversation['kb_id'], user_message)
-            if context_chunks:
-                context_str = "\n".join(context_chunks)
-                rag_prompt = f"以下是相關的參考資料，請根據這些資料來回答使用者的問題：\n\n{context_str}\n\n"
-                # 將檢索到的資料插入到最後一則訊息之前 (或是作為 system prompt)
-                # 這裡選擇插入到最後一則訊息前
-                messages.insert(-1, {"role": "system", "content": rag_prompt})
-                print(f"[RAG] 已加入 {len(context_chunks)} 條參考資料")
-        
-        # 如果有系統提示詞，插入到訊息開頭
+        # 取得系統提示詞
+        system_prompt = None
         if conversation['system_prompt_id']:
             cursor.execute("""
                 SELECT content FROM system_prompts WHERE id = %s
@@ -364,8 +409,164 @@ def send_message(conversation_id):
             prompt_row = cursor.fetchone()
             if prompt_row:
                 system_prompt = prompt_row['content']
-                messages.insert(0, {"role": "system", "content": system_prompt})
-                print(f"[SYSTEM PROMPT] 使用系統提示詞: {system_prompt[:50]}...")
+        timings = {"db": (time.perf_counter() - db_start) * 1000}
+        cursor.close()
+    finally:
+        # 歸還連線後才等待背景階段,之後的 AI 呼叫也不佔用連線
+        conn.close()
+    
+    # 等待背景階段完成
+    context_chunks = None
+    if rag_future is not None:
+        context_chunks, timings["rag"] = rag_future.result()
+    tools = None
+    if tools_future is not None:
+        tools, timings["mcp_tools"] = tools_future.result()
+    
+    # 如果有知識庫，加入 RAG 檢索結果
+    if context_chunks:
+        context_str = "\n".join(context_chunks)
+        rag_prompt = f"以下是相關的參考資料，請根據這些資料來回答使用者的問題：\n\n{context_str}\n\n"
+        # 將檢索到的資料插入到最後一則訊息之前 (或是作為 system prompt)
+        # 這裡選擇插入到最後一則訊息前
+        messages.insert(-1, {"role": "system", "content": rag_prompt})
+        print(f"[RAG] 已加入 {len(context_chunks)} 條參考資料")
+    
+    # 如果有系統提示詞，插入到訊息開頭
+    if system_prompt:
+        messages.insert(0, {"role": "system", "content": system_prompt})
+        print(f"[SYSTEM PROMPT] 使用系統提示詞: {system_prompt[:50]}...")
+    
+    stages = ", ".join(f"{name}={ms:.0f}ms" for name, ms in timings.items())
+    print(f"[AI] 前置階段耗時: {stages}, 合計 {(time.perf_counter() - start) * 1000:.0f}ms")
+    return conversation, messages, tools
+
+
+def _run_tool_calls(tool_calls):
+    """執行 AI 要求的 MCP 工具調用,結果存入各 tool_call['result']"""
+    print(f"[MCP] 開始執行工具調用")
+    calls = []
+    for tool_call in tool_calls:
+        func_name = tool_call['function']['name']
+        func_args_str = tool_call['function']['arguments']
+        
+        print(f"[MCP] 工具名稱: {func_name}")
+        print(f"[MCP] 原始參數: {func_args_str}")
+        print(f"[MCP] 參數類型: {type(func_args_str)}")
+        
+        # 解析參數
+        try:
+            if isinstance(func_args_str, str):
+                func_args = json.loads(func_args_str)
+                print(f"[MCP] 成功解析參數字串: {func_args}")
+            elif isinstance(func_args_str, dict):
+                func_args = func_args_str
+                print(f"[MCP] 參數已是字典格式: {func_args}")
+            else:
+                print(f"[MCP] 警告: 未知的參數類型,嘗試轉換為字典")
+                func_args = dict(func_args_str) if func_args_str else {}
+        except json.JSONDecodeError as e:
+            print(f"[MCP] JSON 解析失敗: {str(e)}")
+            print(f"[MCP] 原始參數內容: {repr(func_args_str)}")
+            func_args = {}
+        except Exception as e:
+            print(f"[MCP] 參數解析異常: {str(e)}")
+            print(f"[MCP] 原始參數內容: {repr(func_args_str)}")
+            import traceback
+            traceback.print_exc()
+            func_args = {}
+        
+        # 驗證參數
+        if not func_args:
+            print(f"[MCP] 警告: 參數為空字典,可能導致工具調用失敗!")
+        
+        print(f"[MCP] 執行工具: {func_name}, 最終參數: {func_args}")
+        calls.append((func_name, func_args))
+    
+    # 並行呼叫 MCP 工具,結果依原順序儲存到各 tool_call
+    try:
+        results = mcp_client.invoke_tools(calls)
+    except Exception as e:
+        print(f"[MCP] 工具執行失敗: {str(e)}")
+        results = [{"error": str(e)}] * len(calls)
+    for tool_call, result in zip(tool_calls, results):
+        print(f"[MCP] 工具結果: {result}")
+        tool_call['result'] = result
+
+
+def _append_tool_messages(messages, ai_response):
+    """將 AI 的工具調用與各工具結果加入訊息歷史,供第二次呼叫 AI 整合"""
+    messages.append({
+        "role": "assistant",
+        "content": ai_response.get('content', ''),
+        "tool_calls": ai_response['tool_calls']
+    })
+    
+    # 加入工具結果訊息
+    for tool_call in ai_response['tool_calls']:
+        tool_message = {
+            "role": "tool",
+            "content": json.dumps(tool_call.get('result', {}))
+        }
+        
+        # OpenAI 要求 role='tool' 的訊息必須包含 tool_call_id
+        if 'id' in tool_call:
+            tool_message['tool_call_id'] = tool_call['id']
+        
+        # 某些 AI 供應商也需要 name 參數
+        if 'function' in tool_call and 'name' in tool_call['function']:
+            tool_message['name'] = tool_call['function']['name']
+        
+        messages.append(tool_message)
+
+
+def _save_assistant_message(conversation_id, ai_response):
+    """儲存 AI 回應 (包含工具調用結果),返回訊息 ID;AI 呼叫結束後才取用連線"""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO messages (conversation_id, role, content, tool_calls)
+                VALUES (%s, %s, %s, %s)
+            """, (
+                conversation_id,
+                'assistant',
+                ai_response['content'],
+                json.dumps(ai_response.get('tool_calls')) if ai_response.get('tool_calls') else None
+            ))
+            message_id = cursor.lastrowid
+        conn.commit()
+        return message_id
+    finally:
+        conn.close()
+
+
+def _sse(event, data):
+    """組成一個 Server-Sent Events 事件"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+@chat_bp.route('/conversations/<int:conversation_id>/messages', methods=['POST'])
+@require_permission('func_chat_create')
+def send_message(conversation_id):
+    """發送訊息並取得 AI 回應"""
+    try:
+        data = request.get_json()
+        user_message = data.get('content', '')
+        
+        if not user_message:
+            return jsonify({
+                "success": False,
+                "error": "訊息內容不可為空"
+            }), 400
+        
+        prepared = _prepare_messages(conversation_id, user_message)
+        if prepared is None:
+            return jsonify({
+                "success": False,
+                "error": "對話不存在"
+            }), 404
+        conversation, messages, tools = prepared
         
         # 準備 AI Client
         ai_client = AIClientFactory.create_client(
@@ -373,31 +574,6 @@ def send_message(conversation_id):
             conversation['model_name']
         )
         
-        # 如果啟用 MCP,取得工具列表
-        tools = None
-        if conversation['mcp_enabled']:
-            try:
-                # 取得該對話選中的 MCP servers
-                mcp_servers = conversation.get('mcp_servers')
-                if isinstance(mcp_servers, str):
-                    mcp_servers = json.loads(mcp_servers)
-                
-                print(f"[MCP] MCP 已啟用, 選中服務: {mcp_servers}, 正在取得工具列表...")
-                # 根據選中的 servers 過濾工具
-                tools = mcp_client.list_tools(server_ids=mcp_servers)
-                print(f"[MCP] 取得 {len(tools)} 個過濾後的工具")
-                if tools:
-                    print(f"[MCP] 工具名稱: {[t.get('name', 'unknown') for t in tools]}")
-                    print(f"[MCP] 工具詳情: {tools}")
-                else:
-                    print(f"[MCP] 警告: 工具列表為空!")
-            except Exception as e:
-                print(f"[MCP] 取得工具失敗: {str(e)}")
-                import traceback
-                traceback.print_exc()
-        else:
-            print(f"[MCP] MCP 未啟用")
-        
         # 呼叫 AI
         print(f"[AI] 呼叫 {conversation['model_provider']} - {conversation['model_name']}")
         print(f"[AI] 工具數量: {len(tools) if tools else 0}")
@@ -408,77 +584,11 @@ def send_message(conversation_id):
         
         # 處理工具調用
         if ai_response.get('tool_calls'):
-            print(f"[MCP] 開始執行工具調用")
             # 執行工具並取得結果
-            for tool_call in ai_response['tool_calls']:
-                func_name = tool_call['function']['name']
-                func_args_str = tool_call['function']['arguments']
-                
-                print(f"[MCP] 工具名稱: {func_name}")
-                print(f"[MCP] 原始參數: {func_args_str}")
-                print(f"[MCP] 參數類型: {type(func_args_str)}")
-                
-                # 解析參數
-                try:
-                    if isinstance(func_args_str, str):
-                        func_args = json.loads(func_args_str)
-                        print(f"[MCP] 成功解析參數字串: {func_args}")
-                    elif isinstance(func_args_str, dict):
-                        func_args = func_args_str
-                        print(f"[MCP] 參數已是字典格式: {func_args}")
-                    else:
-                        print(f"[MCP] 警告: 未知的參數類型,嘗試轉換為字典")
-                        func_args = dict(func_args_str) if func_args_str else {}
-                except json.JSONDecodeError as e:
-                    print(f"[MCP] JSON 解析失敗: {str(e)}")
-                    print(f"[MCP] 原始參數內容: {repr(func_args_str)}")
-                    func_args = {}
-                except Exception as e:
-                    print(f"[MCP] 參數解析異常: {str(e)}")
-                    print(f"[MCP] 原始參數內容: {repr(func_args_str)}")
-                    import traceback
-                    traceback.print_exc()
-                    func_args = {}
-                
-                # 驗證參數
-                if not func_args:
-                    print(f"[MCP] 警告: 參數為空字典,可能導致工具調用失敗!")
-                
-                print(f"[MCP] 執行工具: {func_name}, 最終參數: {func_args}")
-                
-                # 呼叫 MCP 工具
-                try:
-                    result = mcp_client.invoke_tool(func_name, func_args)
-                    print(f"[MCP] 工具結果: {result}")
-                    # 儲存結果到 tool_call
-                    tool_call['result'] = result
-                except Exception as e:
-                    print(f"[MCP] 工具執行失敗: {str(e)}")
-                    tool_call['result'] = {"error": str(e)}
+            _run_tool_calls(ai_response['tool_calls'])
             
             # 將工具結果加入訊息歷史
-            messages.append({
-                "role": "assistant",
-                "content": ai_response.get('content', ''),
-                "tool_calls": ai_response['tool_calls']
-            })
-            
-            # 加入工具結果訊息
-            for tool_call in ai_response['tool_calls']:
-                tool_message = {
-                    "role": "tool",
-                    "content": json.dumps(tool_call.get('result', {}))
-                }
-                
-                # OpenAI 要求 role='tool' 的訊息必須包含 tool_call_id
-                if 'id' in tool_call:
-                    tool_message['tool_call_id'] = tool_call['id']
-                
-                # 某些 AI 供應商也需要 name 參數
-                if 'function' in tool_call and 'name' in tool_call['function']:
-                    tool_message['name'] = tool_call['function']['name']
-                
-                messages.append(tool_message)
+            _append_tool_messages(messages, ai_response)
             
             # 再次呼叫 AI 以整合工具結果
             print(f"[AI] 整合工具結果,再次呼叫 AI")
@@ -489,21 +599,7 @@ def send_message(conversation_id):
             ai_response['content'] = final_response['content']
         
         # 儲存 AI 回應 (包含工具調用結果)
-        cursor.execute("""
-            INSERT INTO messages (conversation_id, role, content, tool_calls)
-            VALUES (%s, %s, %s, %s)
-        """, (
-            conversation_id,
-            'assistant',
-            ai_response['content'],
-            json.dumps(ai_response.get('tool_calls')) if ai_response.get('tool_calls') else None
-        ))
-        
-        message_id = cursor.lastrowid
-        conn.commit()
-        
-        cursor.close()
-        conn.close()
+        message_id = _save_assistant_message(conversation_id, ai_response)
         
         return jsonify({
             "success": True,
@@ -525,6 +621,122 @@ def send_message(conversation_id):
         }), 500
 
 
+@chat_bp.route('/conversations/<int:conversation_id>/messages/stream', methods=['POST'])
+@require_permission('func_chat_create')
+def stream_message(conversation_id):
+    """
+    發送訊息並以 SSE 串流 AI 回應
+    
+    事件 (data 為 JSON):
+        delta       - {"content": 新增的文字}
+        tool_call   - {"index", "id", "name", "arguments"} 工具調用片段 (arguments 為增量字串)
+        tool_result - {"id", "name", "result"} 工具執行結果
+        done        - {"message": 已儲存的完整訊息, "ttft_ms": 首個 token 時間}
+        error       - {"error": 錯誤訊息}
+    
+    工具執行後的第二次 AI 呼叫同樣串流;完整訊息只在結束時儲存一次
+    """
+    started = time.perf_counter()
+    try:
+        data = request.get_json()
+        user_message = data.get('content', '')
+        
+        if not user_message:
+            return jsonify({
+                "success": False,
+                "error": "訊息內容不可為空"
+            }), 400
+        
+        prepared = _prepare_messages(conversation_id, user_message)
+        if prepared is None:
+            return jsonify({
+                "success": False,
+                "error": "對話不存在"
+            }), 404
+        conversation, messages, tools = prepared
+        
+        ai_client = AIClientFactory.create_client(
+            conversation['model_provider'],
+            conversation['model_name']
+        )
+    except Exception as e:
+        print(f"[ERROR] 發送訊息失敗: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+    
+    def generate():
+        ttft_ms = None
+        try:
+            print(f"[AI] 串流呼叫 {conversation['model_provider']} - {conversation['model_name']}")
+            print(f"[AI] 工具數量: {len(tools) if tools else 0}")
+            
+            ai_response = None
+            for event in ai_client.chat_stream(messages, tools):
+                if event['type'] == 'done':
+                    ai_response = event['message']
+                    continue
+                if ttft_ms is None:
+                    ttft_ms = (time.perf_counter() - started) * 1000
+                    print(f"[AI] 首個 token 時間 (TTFT): {ttft_ms:.0f}ms")
+                if event['type'] == 'delta':
+                    yield _sse('delta', {"content": event['content']})
+                else:
+                    yield _sse('tool_call', {key: event[key] for key in ('index', 'id', 'name', 'arguments')})
+            
+            # 處理工具調用
+            if ai_response.get('tool_calls'):
+                _run_tool_calls(ai_response['tool_calls'])
+                for tool_call in ai_response['tool_calls']:
+                    yield _sse('tool_result', {
+                        "id": tool_call.get('id'),
+                        "name": tool_call['function']['name'],
+                        "result": tool_call.get('result')
+                    })
+                _append_tool_messages(messages, ai_response)
+                
+                # 再次呼叫 AI 以整合工具結果 (串流)
+                print("[AI] 整合工具結果,再次呼叫 AI")
+                content_parts = []
+                for event in ai_client.chat_stream(messages):
+                    if event['type'] == 'delta':
+                        content_parts.append(event['content'])
+                        yield _sse('delta', {"content": event['content']})
+                    elif event['type'] == 'done':
+                        content_parts = [event['message'].get('content', '')]
+                
+                # 更新回應內容,但保留 tool_calls
+                ai_response['content'] = "".join(content_parts)
+            
+            # 串流結束後儲存一次完整回應
+            message_id = _save_assistant_message(conversation_id, ai_response)
+            print(f"[AI] 串流完成: TTFT {ttft_ms or 0:.0f}ms, 總耗時 {(time.perf_counter() - started) * 1000:.0f}ms")
+            
+            yield _sse('done', {
+                "message": {
+                    "id": message_id,
+                    "role": "assistant",
+                    "content": ai_response['content'],
+                    "tool_calls": ai_response.get('tool_calls')
+                },
+                "ttft_ms": round(ttft_ms) if ttft_ms is not None else None
+            })
+        except Exception as e:
+            print(f"[ERROR] 串流回應失敗: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            yield _sse('error', {"error": str(e)})
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # 關閉反向代理 (nginx) 的回應緩衝,事件才能即時送達
+        'X-Accel-Buffering': 'no'
+    })
+
+
 @chat_bp.route('/conversations/<int:conversation_id>', methods=['PATCH'])
 @require_permission('func_chat_create')
 def update_conversation(conversation_id):
@@ -10,27 +10,18 @@ from services.line_client import create_line_client
 from services.ai_client import AIClientFactory
 from services.mcp_client import mcp_client
 from services.rag_service import rag_service
+from services.db_pool import get_connection
 
 # 建立 Blueprint
 line_bp = Blueprint('line', __name__, url_prefix='/api/line')
 
-# 資料庫連線設定
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'db'),
-    'port': int(os.getenv('DB_PORT', '3306')),
-    'user': os.getenv('DB_USER', 'mcp_user'),
-    'password': os.getenv('DB_PASSWORD', 'mcp_password'),
-    'database': os.getenv('DB_NAME', 'mcp_platform'),
-    'charset': 'utf8mb4'
-}
-
 # Webhook 基礎 URL
 WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL', 'http://localhost:5000')
 
 
 def get_db_connection():
     """取得資料庫連線"""
-    return pymysql.connect(**DB_CONFIG)
+    return get_connection()
 
 
 def get_line_credentials(bot_config: dict = None) -> tuple:
@@ -495,6 +486,8 @@ def get_ai_response(conversation_id: int, user_message: str, bot_config: dict) -
         
         if not conversation:
             print(f"[LINE BOT] 找不到對話: {conversation_id}")
+            cursor.close()
+            conn.close()
             return "抱歉,發生錯誤"
         
         print(f"[LINE BOT] 對話設定: MCP 啟用={conversation['mcp_enabled']}, MCP Servers={conversation['mcp_servers']}, KB ID={bot_config.get('kb_id')}")
@@ -519,7 +512,10 @@ def get_ai_response(conversation_id: int, user_message: str, bot_config: dict) -
                 "content": msg['content']
             })
         
-        # 如果有知識庫，進行 RAG 檢索
+        cursor.close()
+        conn.close()
+        
+        # 如果有知識庫，進行 RAG 檢索 (已歸還資料庫連線)
         kb_id = bot_config.get('kb_id')
         if kb_id:
             print(f"[LINE BOT RAG] 正在從知識庫 {kb_id} 檢索相關內容...")
@@ -530,9 +526,6 @@ def get_ai_response(conversation_id: int, user_message: str, bot_config: dict) -
                 messages.insert(-1, {"role": "system", "content": rag_prompt})
                 print(f"[LINE BOT RAG] 已加入 {len(context_chunks)} 條參考資料")
         
-        cursor.close()
-        conn.close()
-        
         print(f"[LINE BOT] 歷史訊息數量: {len(messages)}")
         if messages:
             print(f"[LINE BOT] 最近 3 則訊息:")
@@ -610,6 +603,8 @@ def get_ai_response(conversation_id: int, user_message: str, bot_config: dict) -
             tool_results = []
             print(f"[LINE BOT] tool_calls 結構: {json.dumps(response['tool_calls'], ensure_ascii=False, indent=2)}")
             
+            # 先解析所有工具參數,再並行調用 (結果依原順序組回)
+            calls = []
             for idx, tool_call in enumerate(response['tool_calls']):
                 print(f"[LINE BOT] 處理第 {idx + 1} 個 tool_call")
                 print(f"[LINE BOT] tool_call 類型: {type(tool_call)}")
@@ -641,23 +636,7 @@ def get_ai_response(conversation_id: int, user_message: str, bot_config: dict) -
                         continue
                     
                     print(f"[LINE BOT] 調用工具: {tool_name}, 參數: {tool_args}, ID: {tool_id}")
-                    
-                    result = mcp_client.invoke_tool(tool_name, tool_args)
-                    print(f"[LINE BOT] 工具調用結果: {result}")
-                    
-                    tool_results.append({
-                        "role": "tool",
-                        "content": json.dumps(result, ensure_ascii=False),
-                        "tool_call_id": tool_id
-                    })
-                    
-                    # ⚠️ 不儲存工具結果到資料庫,只在記憶體中處理
-                    # save_message(
-                    #     conversation_id, 
-                    #     'tool', 
-                    #     json.dumps(result, ensure_ascii=False),
-                    #     tool_call_id=tool_id
-                    # )
+                    calls.append((tool_name, tool_args, tool_id, None))
                 except Exception as tool_invoke_error:
                     print(f"[LINE BOT] 工具調用失敗: {str(tool_invoke_error)}")
                     import traceback
@@ -672,20 +651,23 @@ def get_ai_response(conversation_id: int, user_message: str, bot_config: dict) -
                             tool_id = tool_call.get('id', '')
                     except:
                         pass
-                    
-                    tool_results.append({
-                        "role": "tool",
-                        "content": json.dumps(error_result, ensure_ascii=False),
-                        "tool_call_id": tool_id
-                    })
-                    
-                    # ⚠️ 不儲存錯誤結果到資料庫
-                    # save_message(
-                    #     conversation_id, 
-                    #     'tool', 
-                    #     json.dumps(error_result, ensure_ascii=False),
-                    #     tool_call_id=tool_id
-                    # )
+                    calls.append((None, None, tool_id, error_result))
+            
+            # ⚠️ 不儲存工具結果 (含錯誤結果) 到資料庫,只在記憶體中處理
+            pending = [(tool_name, tool_args) for tool_name, tool_args, _, error in calls if error is None]
+            try:
+                invoked = iter(mcp_client.invoke_tools(pending))
+            except Exception as tool_invoke_error:
+                print(f"[LINE BOT] 工具調用失敗: {str(tool_invoke_error)}")
+                invoked = iter([{"error": str(tool_invoke_error)}] * len(pending))
+            for tool_name, _, tool_id, error in calls:
+                result = error if error is not None else next(invoked)
+                print(f"[LINE BOT] 工具調用結果: {result}")
+                tool_results.append({
+                    "role": "tool",
+                    "content": json.dumps(result, ensure_ascii=False),
+                    "tool_call_id": tool_id
+                })
             
             # 將工具結果加入訊息並再次呼叫 AI
             messages.append({
@@ -1013,29 +995,26 @@ def send_message_to_line(conversation_id):
                 "error": "訊息內容不可為空"
             }), 400
         
+        # 取得對話資訊 (連線用完即歸還,不跨過 LINE 推送與 AI 呼叫)
         conn = get_db_connection()
-        cursor = conn.cursor(pymysql.cursors.DictCursor)
-        
-        # 取得對話資訊
-        cursor.execute("""
-            SELECT line_user_id, source, model_provider, model_name
-            FROM conversations 
-            WHERE id = %s
-        """, (conversation_id,))
-        
-        conversation = cursor.fetchone()
+        try:
+            with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute("""
+                    SELECT line_user_id, source, model_provider, model_name
+                    FROM conversations 
+                    WHERE id = %s
+                """, (conversation_id,))
+                conversation = cursor.fetchone()
+        finally:
+            conn.close()
         
         if not conversation:
-            cursor.close()
-            conn.close()
             return jsonify({
                 "success": False,
                 "error": "對話不存在"
             }), 404
         
         if conversation['source'] != 'line':
-            cursor.close()
-            conn.close()
             return jsonify({
                 "success": False,
                 "error": "此對話不是 LINE 對話"
@@ -1044,8 +1023,6 @@ def send_message_to_line(conversation_id):
         line_user_id = conversation['line_user_id']
         
         if not line_user_id:
-            cursor.close()
-            conn.close()
             return jsonify({
                 "success": False,
                 "error": "找不到 LINE 使用者 ID"
@@ -1059,8 +1036,6 @@ def send_message_to_line(conversation_id):
         bot_config = get_active_line_bot_config()
         
         if not bot_config:
-            cursor.close()
-            conn.close()
             return jsonify({
                 "success": False,
                 "error": "找不到啟用的 LINE BOT 設定"
@@ -1070,8 +1045,6 @@ def send_message_to_line(conversation_id):
         channel_access_token, channel_secret = get_line_credentials(bot_config)
         
         if not channel_access_token or not channel_secret:
-            cursor.close()
-            conn.close()
             return jsonify({
                 "success": False,
                 "error": "LINE Bot Token 或 Secret 未配置"
@@ -1107,17 +1080,21 @@ def send_message_to_line(conversation_id):
             print(f"[WEB->LINE] LINE BOT 未綁定 MCP 工具,直接調用 AI")
             
             # 取得歷史訊息
-            cursor.execute("""
-                SELECT role, content
-                FROM messages 
-                WHERE conversation_id = %s 
-                AND role IN ('user', 'assistant')
-                AND (tool_calls IS NULL OR tool_calls = '')
-                AND content != ''
-                ORDER BY created_at ASC
-            """, (conversation_id,))
-            
-            messages = [{"role": msg['role'], "content": msg['content']} for msg in cursor.fetchall()]
+            conn = get_db_connection()
+            try:
+                with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                    cursor.execute("""
+                        SELECT role, content
+                        FROM messages 
+                        WHERE conversation_id = %s 
+                        AND role IN ('user', 'assistant')
+                        AND (tool_calls IS NULL OR tool_calls = '')
+                        AND content != ''
+                        ORDER BY created_at ASC
+                    """, (conversation_id,))
+                    messages = [{"role": msg['role'], "content": msg['content']} for msg in cursor.fetchall()]
+            finally:
+                conn.close()
             
             # 建立 AI 客戶端並調用
             ai_client = AIClientFactory.create_client(
@@ -1128,8 +1105,6 @@ def send_message_to_line(conversation_id):
             ai_response = response.get('content', '抱歉,我無法回答')
         
         if not ai_response:
-            cursor.close()
-            conn.close()
             return jsonify({
                 "success": False,
                 "error": "AI 處理失敗"
@@ -1152,8 +1127,6 @@ def send_message_to_line(conversation_id):
             update_last_message_sync_status(conversation_id, 'synced')
             print(f"[WEB->LINE] 訊息發送成功")
             
-            cursor.close()
-            conn.close()
             
             return jsonify({
                 "success": True,
@@ -1163,8 +1136,6 @@ def send_message_to_line(conversation_id):
             update_last_message_sync_status(conversation_id, 'failed')
             print(f"[WEB->LINE] 訊息發送失敗: {result.get('error')}")
             
-            cursor.close()
-            conn.close()
             
             return jsonify({
                 "success": False,
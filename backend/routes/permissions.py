@@ -5,21 +5,11 @@
 from flask import Blueprint, request, jsonify
 import pymysql
 from services.auth_service import require_role
-import os
+from services.db_pool import get_connection
 
 # 建立 Blueprint
 permissions_bp = Blueprint('permissions', __name__, url_prefix='/api/permissions')
 
-# 資料庫連線設定
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'db'),
-    'port': int(os.getenv('DB_PORT', '3306')),
-    'user': os.getenv('DB_USER', 'mcp_user'),
-    'password': os.getenv('DB_PASSWORD', 'mcp_password'),
-    'database': os.getenv('DB_NAME', 'mcp_platform'),
-    'charset': 'utf8mb4'
-}
-
 
 @permissions_bp.route('', methods=['GET'])
 @require_role('超級管理員')
@@ -28,7 +18,7 @@ def get_permissions():
     try:
         permission_type = request.args.get('type', '').strip()
         
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 建立查詢條件
@@ -82,7 +72,7 @@ def get_permissions():
 def get_permissions_tree():
     """取得權限樹狀結構"""
     try:
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 查詢所有頁面權限
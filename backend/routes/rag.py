@@ -1,24 +1,19 @@
 from flask import Blueprint, request, jsonify
 import os
+import json
 import pymysql
 from werkzeug.utils import secure_filename
 from services.rag_service import rag_service
+from services.ingest_queue import ingest_queue
+from services.db_pool import get_connection
 
 rag_bp = Blueprint('rag', __name__)
 
-# 資料庫連線設定
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'db'),
-    'port': int(os.getenv('DB_PORT', '3306')),
-    'user': os.getenv('DB_USER', 'mcp_user'),
-    'password': os.getenv('DB_PASSWORD', 'mcp_password'),
-    'database': os.getenv('DB_NAME', 'mcp_platform'),
-    'charset': 'utf8mb4',
-    'cursorclass': pymysql.cursors.DictCursor
-}
-
 def get_db_connection():
-    return pymysql.connect(**DB_CONFIG)
+    return get_connection(pymysql.cursors.DictCursor)
+
+# 批次檢索單次請求的查詢數上限
+SEARCH_MAX_QUERIES = 10000
 
 @rag_bp.route('/api/rag/kb', methods=['GET'])
 def list_knowledge_bases():
@@ -85,6 +80,7 @@ def delete_knowledge_base(kb_id):
             cursor.execute("DELETE FROM knowledge_bases WHERE id = %s", (kb_id,))
         conn.commit()
         conn.close()
+        rag_service.delete_kb_index(kb_id)
         return jsonify({"success": True, "message": "已刪除知識庫"})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
@@ -97,7 +93,7 @@ def list_kb_files(kb_id):
         with conn.cursor() as cursor:
             # 透過連結表 kb_files 取得該知識庫的檔案
             sql = """
-                SELECT f.* 
+                SELECT f.*, kf.tags 
                 FROM files f
                 JOIN kb_files kf ON f.id = kf.file_id
                 WHERE kf.kb_id = %s
@@ -106,6 +102,8 @@ def list_kb_files(kb_id):
             cursor.execute(sql, (kb_id,))
             files = cursor.fetchall()
         conn.close()
+        for f in files:
+            f['tags'] = rag_service.parse_tags(f.get('tags'))
         return jsonify({"success": True, "data": files})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
@@ -123,6 +121,31 @@ def list_files():
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+@rag_bp.route('/api/rag/kb/<int:kb_id>/files/<int:file_id>/tags', methods=['PUT'])
+def update_kb_file_tags(kb_id, file_id):
+    """設定知識庫中檔案的標籤 (檢索時可依標籤過濾,不需重建索引)"""
+    data = request.get_json(silent=True) or {}
+    tags = data.get('tags')
+    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+        return jsonify({"success": False, "error": "tags 必須為字串陣列"}), 400
+    tags = sorted({tag.strip() for tag in tags} - {""})
+    
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM kb_files WHERE kb_id = %s AND file_id = %s", (kb_id, file_id))
+            if not cursor.fetchone():
+                conn.close()
+                return jsonify({"success": False, "error": "檔案不屬於此知識庫"}), 404
+            cursor.execute("UPDATE kb_files SET tags = %s WHERE kb_id = %s AND file_id = %s",
+                           (json.dumps(tags, ensure_ascii=False), kb_id, file_id))
+        conn.commit()
+        conn.close()
+        rag_service.refresh_file_tags(kb_id)
+        return jsonify({"success": True, "data": {"file_id": file_id, "tags": tags}})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
 @rag_bp.route('/api/rag/files/delete', methods=['POST'])
 def delete_files():
     """批次刪除檔案"""
@@ -135,21 +158,30 @@ def delete_files():
     try:
         conn = get_db_connection()
         with conn.cursor() as cursor:
-            # 取得檔案路徑以從磁碟刪除
             cursor.execute("SELECT file_path FROM files WHERE id IN %s", (tuple(file_ids),))
             files = cursor.fetchall()
-            
-            for f in files:
-                if f['file_path'] and os.path.exists(f['file_path']):
-                    try:
-                        os.remove(f['file_path'])
-                    except:
-                        pass
-            
-            # 從資料庫中刪除
+            cursor.execute("SELECT kb_id, file_id FROM kb_files WHERE file_id IN %s", (tuple(file_ids),))
+            kb_file_map = {}
+            for row in cursor.fetchall():
+                kb_file_map.setdefault(row['kb_id'], []).append(row['file_id'])
+
+            # 先從資料庫中刪除並提交,檔案不再被列出或加入新的處理工作
             cursor.execute("DELETE FROM files WHERE id IN %s", (tuple(file_ids),))
         conn.commit()
         conn.close()
+
+        # 從相關知識庫的索引中移除這些檔案的向量 (背景工作,可能需要重新計算 Embedding)
+        for linked_kb_id, linked_file_ids in kb_file_map.items():
+            ingest_queue.submit_removal(linked_kb_id, linked_file_ids)
+
+        # 最後才從磁碟刪除 (索引移除只使用知識庫自己的 chunk 儲存,不需讀取原始檔案)
+        for f in files:
+            if f['file_path'] and os.path.exists(f['file_path']):
+                try:
+                    os.remove(f['file_path'])
+                except:
+                    pass
+
         return jsonify({"success": True, "message": f"已刪除 {len(file_ids)} 個檔案"})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
@@ -226,88 +258,61 @@ def upload_file():
 
 @rag_bp.route('/api/rag/kb/<int:kb_id>/process', methods=['POST'])
 def process_kb_files(kb_id):
-    """處理知識庫中待處理的檔案並建立索引"""
+    """
+    將知識庫檔案的處理排入背景工作,立即回傳 job id
+    
+    預設為增量更新,只重新 Embedding 選取的檔案;
+    索引不存在、配置已變更或指定 rebuild=true 時,會重新處理知識庫內所有檔案。
+    進度請以 GET /api/rag/jobs/<job_id> 查詢。
+    """
     data = request.get_json()
     file_ids = data.get('file_ids', [])
+    rebuild = bool(data.get('rebuild', False))
     
     if not file_ids:
         return jsonify({"success": False, "error": "請選擇要處理的檔案"}), 400
     
     try:
-        # 獲取知識庫配置
-        kb_config = rag_service.get_kb_config(kb_id)
-        chunk_strategy = kb_config.get('chunk_strategy', 'character')
-        chunk_size = kb_config.get('chunk_size', 500)
-        chunk_overlap = kb_config.get('chunk_overlap', 50)
-        
-        print(f"[RAG] 處理配置 - 策略: {chunk_strategy}, 大小: {chunk_size}, 重疊: {chunk_overlap}")
-        
         conn = get_db_connection()
-        all_chunks = []
-        
         with conn.cursor() as cursor:
             # 建立 KB 與檔案的關聯 (如果尚未建立)
             for f_id in file_ids:
                 cursor.execute("INSERT IGNORE INTO kb_files (kb_id, file_id) VALUES (%s, %s)", (kb_id, f_id))
-            
-            # 取得檔案路徑
-            cursor.execute("SELECT id, file_path, name FROM files WHERE id IN %s", (tuple(file_ids),))
-            files = cursor.fetchall()
-            
-            for f in files:
-                try:
-                    # 更新狀態為處理中
-                    cursor.execute("UPDATE files SET status = 'processing' WHERE id = %s", (f['id'],))
-                    conn.commit()
-                    
-                    print(f"[RAG] 處理檔案: {f['name']}")
-                    
-                    # 提取文字
-                    text = rag_service.extract_text(f['file_path'])
-                    print(f"[RAG] 提取文字長度: {len(text)} 字元")
-                    
-                    # 使用配置的策略切分
-                    chunks = rag_service.split_text(
-                        text, 
-                        strategy=chunk_strategy,
-                        chunk_size=chunk_size,
-                        chunk_overlap=chunk_overlap
-                    )
-                    print(f"[RAG] 切分完成,產生 {len(chunks)} 個 chunks")
-                    
-                    all_chunks.extend(chunks)
-                    
-                    # 更新狀態為已完成
-                    cursor.execute("UPDATE files SET status = 'completed' WHERE id = %s", (f['id'],))
-                except Exception as ex:
-                    print(f"[RAG] 處理檔案失敗: {str(ex)}")
-                    cursor.execute("UPDATE files SET status = 'failed', error_message = %s WHERE id = %s", 
-                                   (str(ex), f['id']))
-            
-            # 建立向量索引
-            if all_chunks:
-                print(f"[RAG] 開始建立向量索引,共 {len(all_chunks)} 個 chunks")
-                rag_service.create_kb_index(kb_id, all_chunks)
-                print(f"[RAG] 向量索引建立完成")
-                
         conn.commit()
         conn.close()
+        
+        job_id = ingest_queue.submit(kb_id, file_ids, rebuild)
         return jsonify({
-            "success": True, 
-            "message": "檔案處理與索引建立完成",
-            "chunks_count": len(all_chunks),
-            "config": {
-                "strategy": chunk_strategy,
-                "chunk_size": chunk_size,
-                "chunk_overlap": chunk_overlap
-            }
-        })
+            "success": True,
+            "message": "已排入背景處理",
+            "data": {"job_id": job_id, "status": "queued"}
+        }), 202
     except Exception as e:
-        print(f"[RAG] 處理失敗: {str(e)}")
+        print(f"[RAG] 建立處理工作失敗: {str(e)}")
         import traceback
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
 
+@rag_bp.route('/api/rag/jobs/<int:job_id>', methods=['GET'])
+def get_ingest_job(job_id):
+    """取得背景處理工作的狀態、進度與各檔案狀態"""
+    try:
+        job = ingest_queue.get_job(job_id)
+        if not job:
+            return jsonify({"success": False, "error": "找不到工作"}), 404
+        return jsonify({"success": True, "data": job})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@rag_bp.route('/api/rag/kb/<int:kb_id>/jobs', methods=['GET'])
+def list_ingest_jobs(kb_id):
+    """列出知識庫最近的背景處理工作"""
+    try:
+        limit = min(int(request.args.get('limit', 20)), 100)
+        return jsonify({"success": True, "data": ingest_queue.list_jobs(kb_id, limit)})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
 @rag_bp.route('/api/rag/kb/<int:kb_id>/config', methods=['GET'])
 def get_kb_config_api(kb_id):
     """獲取知識庫配置"""
@@ -362,6 +367,14 @@ def update_kb_config_api(kb_id):
                     update_fields.append("index_type = %s")
                     values.append(data['index_type'])
                 
+                if 'similarity_threshold' in data:
+                    update_fields.append("similarity_threshold = %s")
+                    values.append(data['similarity_threshold'])
+                
+                if 'index_params' in data:
+                    update_fields.append("index_params = %s")
+                    values.append(json.dumps(data['index_params'] or {}))
+                
                 if update_fields:
                     values.append(kb_id)
                     sql = f"UPDATE kb_configs SET {', '.join(update_fields)} WHERE kb_id = %s"
@@ -371,8 +384,9 @@ def update_kb_config_api(kb_id):
                 cursor.execute("""
                     INSERT INTO kb_configs 
                     (kb_id, chunk_strategy, chunk_size, chunk_overlap, 
-                     embedding_provider, embedding_model, index_type, retrieval_top_k)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                     embedding_provider, embedding_model, index_type, retrieval_top_k,
+                     similarity_threshold, index_params)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 """, (
                     kb_id,
                     data.get('chunk_strategy', 'character'),
@@ -381,11 +395,77 @@ def update_kb_config_api(kb_id):
                     data.get('embedding_provider', 'openai'),
                     data.get('embedding_model', 'text-embedding-3-small'),
                     data.get('index_type', 'flat'),
-                    data.get('retrieval_top_k', 3)
+                    data.get('retrieval_top_k', 3),
+                    data.get('similarity_threshold', 0.0),
+                    json.dumps(data.get('index_params') or {})
                 ))
         
         conn.commit()
         conn.close()
+        rag_service.invalidate_kb_config(kb_id)
         return jsonify({"success": True, "message": "配置已更新"})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
+
+@rag_bp.route('/api/rag/kb/<int:kb_id>/search', methods=['POST'])
+def search_kb_api(kb_id):
+    """
+    批次檢索知識庫
+    
+    Body: {"queries": ["...", ...], "top_k": 5}  (也可傳單一 "query")
+          可選 "filters": {"file_ids": [...], "tags": [...], "pages": [起始頁, 結束頁]}
+    回傳每個查詢的 chunks 與 L2 距離、相似度、檔案與頁碼
+    """
+    data = request.get_json(silent=True) or {}
+    queries = data.get('queries')
+    if queries is None and data.get('query'):
+        queries = [data['query']]
+    if not isinstance(queries, list) or not queries or not all(isinstance(q, str) and q.strip() for q in queries):
+        return jsonify({"success": False, "error": "queries 必須為非空字串陣列"}), 400
+    if len(queries) > SEARCH_MAX_QUERIES:
+        return jsonify({"success": False, "error": f"單次最多 {SEARCH_MAX_QUERIES} 個查詢"}), 400
+
+    try:
+        top_k = data.get('top_k')
+        results = rag_service.search_many(kb_id, queries, int(top_k) if top_k else None,
+                                          filters=data.get('filters'))
+
+        # 補上檔案名稱
+        file_ids = {hit['file_id'] for hits in results for hit in hits if hit['file_id'] >= 0}
+        file_names = {}
+        if file_ids:
+            conn = get_db_connection()
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT id, name FROM files WHERE id IN %s", (tuple(file_ids),))
+                file_names = {row['id']: row['name'] for row in cursor.fetchall()}
+            conn.close()
+        for hits in results:
+            for hit in hits:
+                hit['file_name'] = file_names.get(hit['file_id'])
+
+        return jsonify({
+            "success": True,
+            "data": [{"query": q, "results": hits} for q, hits in zip(queries, results)]
+        })
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@rag_bp.route('/api/rag/kb/<int:kb_id>/tune', methods=['POST'])
+def tune_kb_search_params(kb_id):
+    """自動調校知識庫檢索參數 (nprobe / efSearch),以達到目標 recall 的最低成本設定"""
+    data = request.get_json(silent=True) or {}
+    
+    try:
+        result = rag_service.autotune_search_params(
+            kb_id,
+            target_recall=float(data.get('target_recall', 0.95)),
+            sample_size=int(data.get('sample_size', 200)),
+            top_k=data.get('top_k')
+        )
+        return jsonify({"success": True, "data": result})
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
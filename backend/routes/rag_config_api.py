@@ -71,6 +71,7 @@ def update_kb_config(kb_id):
         
         conn.commit()
         conn.close()
+        rag_service.invalidate_kb_config(kb_id)
         return jsonify({"success": True, "message": "配置已更新"})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
@@ -4,29 +4,19 @@
 """
 from flask import Blueprint, request, jsonify
 import pymysql
-from services.auth_service import require_role, require_permission, require_auth
-import os
+from services.auth_service import AuthService, require_role, require_permission, require_auth
+from services.db_pool import get_connection
 
 # 建立 Blueprint
 roles_bp = Blueprint('roles', __name__, url_prefix='/api/roles')
 
-# 資料庫連線設定
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'db'),
-    'port': int(os.getenv('DB_PORT', '3306')),
-    'user': os.getenv('DB_USER', 'mcp_user'),
-    'password': os.getenv('DB_PASSWORD', 'mcp_password'),
-    'database': os.getenv('DB_NAME', 'mcp_platform'),
-    'charset': 'utf8mb4'
-}
-
 
 @roles_bp.route('', methods=['GET'])
 @require_permission('func_role_view')
 def get_roles():
     """取得角色列表"""
     try:
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         cursor.execute("""
@@ -68,7 +58,7 @@ def get_roles():
 def get_role(role_id):
     """取得角色詳細資料"""
     try:
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 查詢角色
@@ -142,7 +132,7 @@ def create_role():
                 'error': '角色名稱至少需要 2 個字元'
             }), 400
         
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 檢查角色名稱是否已存在
@@ -204,7 +194,7 @@ def update_role(role_id):
                 'error': '缺少必填欄位'
             }), 400
         
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 檢查角色是否存在
@@ -267,6 +257,8 @@ def update_role(role_id):
         """
         cursor.execute(update_query, params)
         connection.commit()
+        # 角色名稱影響角色判斷 (例如超級管理員)
+        AuthService.invalidate_permissions()
         
         return jsonify({
             'success': True,
@@ -289,7 +281,7 @@ def update_role(role_id):
 def delete_role(role_id):
     """刪除角色"""
     try:
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 檢查角色是否存在
@@ -325,6 +317,7 @@ def delete_role(role_id):
         # 刪除角色 (會自動刪除關聯的 role_permissions)
         cursor.execute("DELETE FROM roles WHERE id = %s", (role_id,))
         connection.commit()
+        AuthService.invalidate_permissions()
         
         return jsonify({
             'success': True,
@@ -347,7 +340,7 @@ def delete_role(role_id):
 def get_role_permissions(role_id):
     """取得角色權限"""
     try:
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 檢查角色是否存在
@@ -406,7 +399,7 @@ def update_role_permissions(role_id):
         
         permission_ids = data['permission_ids']
         
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 檢查角色是否存在
@@ -428,6 +421,8 @@ def update_role_permissions(role_id):
             """, (role_id, permission_id))
         
         connection.commit()
+        # 擁有此角色的使用者權限都已改變
+        AuthService.invalidate_permissions()
         
         return jsonify({
             'success': True,
@@ -5,21 +5,11 @@
 from flask import Blueprint, request, jsonify
 import pymysql
 from services.auth_service import AuthService, require_auth, require_role, require_permission
-import os
+from services.db_pool import get_connection
 
 # 建立 Blueprint
 users_bp = Blueprint('users', __name__, url_prefix='/api/users')
 
-# 資料庫連線設定
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'db'),
-    'port': int(os.getenv('DB_PORT', '3306')),
-    'user': os.getenv('DB_USER', 'mcp_user'),
-    'password': os.getenv('DB_PASSWORD', 'mcp_password'),
-    'database': os.getenv('DB_NAME', 'mcp_platform'),
-    'charset': 'utf8mb4'
-}
-
 
 @users_bp.route('', methods=['GET'])
 @require_auth
@@ -42,7 +32,7 @@ def get_users():
         status = request.args.get('status', '').strip()
         role_id = request.args.get('role_id', '').strip()
         
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 建立查詢條件
@@ -128,7 +118,7 @@ def get_users():
 def get_user(user_id):
     """取得使用者詳細資料"""
     try:
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 查詢使用者
@@ -213,7 +203,7 @@ def create_user():
                 'error': '密碼至少需要 8 個字元'
             }), 400
         
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 檢查使用者名稱是否已存在
@@ -295,7 +285,7 @@ def update_user(user_id):
                 'error': '缺少必填欄位'
             }), 400
         
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 檢查使用者是否存在
@@ -379,7 +369,7 @@ def delete_user(user_id):
                 'error': '不能刪除自己的帳號'
             }), 400
         
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 檢查使用者是否存在
@@ -393,6 +383,7 @@ def delete_user(user_id):
         # 刪除使用者 (會自動刪除關聯的 user_roles)
         cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
         connection.commit()
+        AuthService.invalidate_permissions(user_id)
         
         return jsonify({
             'success': True,
@@ -432,7 +423,7 @@ def update_user_roles(user_id):
         
         role_ids = data['role_ids']
         
-        connection = pymysql.connect(**DB_CONFIG)
+        connection = get_connection()
         cursor = connection.cursor(pymysql.cursors.DictCursor)
         
         # 檢查使用者是否存在
@@ -454,6 +445,7 @@ def update_user_roles(user_id):
             """, (user_id, role_id))
         
         connection.commit()
+        AuthService.invalidate_permissions(user_id)
         
         return jsonify({
             'success': True,
@@ -0,0 +1,10 @@
+"""
+Backend API 啟動入口
+
+文件解析行程池的 worker 啟動時會重新匯入 __main__ 模組;
+本模組只在 __main__ 區塊內匯入 app,worker 匯入時不會載入 Flask、路由與各項服務
+"""
+
+if __name__ == '__main__':
+    from app import main
+    main()
@@ -3,7 +3,8 @@ AI Client Service - 支援多家 AI 供應商的統一介面
 支援: OpenAI, Google Gemini, Anthropic Claude
 """
 import os
-from typing import List, Dict, Any, Optional
+import json
+from typing import List, Dict, Any, Optional, Iterator
 from abc import ABC, abstractmethod
 
 
@@ -23,6 +24,24 @@ class AIClient(ABC):
             AI 回應
         """
         pass
+    
+    def chat_stream(self, messages: List[Dict[str, str]], tools: Optional[List[Dict]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        串流對話,依序產生事件:
+            {"type": "delta", "content": 文字片段}
+            {"type": "tool_call", "index", "id", "name", "arguments"}  工具調用片段 (arguments 為增量字串)
+            {"type": "done", "message": 完整回應 (格式同 chat())}
+        
+        預設實作呼叫 chat() 後一次輸出,供應商用戶端覆寫為真正的串流
+        """
+        result = self.chat(messages, tools)
+        if result.get("content"):
+            yield {"type": "delta", "content": result["content"]}
+        for index, tool_call in enumerate(result.get("tool_calls") or []):
+            arguments = tool_call["function"]["arguments"]
+            yield {"type": "tool_call", "index": index, "id": tool_call.get("id"), "name": tool_call["function"]["name"],
+                   "arguments": arguments if isinstance(arguments, str) else json.dumps(arguments, ensure_ascii=False)}
+        yield {"type": "done", "message": result}
 
 
 class OpenAIClient(AIClient):
@@ -85,6 +104,49 @@ class OpenAIClient(AIClient):
         except Exception as e:
             raise Exception(f"OpenAI API 錯誤: {str(e)}")
     
+    def chat_stream(self, messages: List[Dict[str, str]], tools: Optional[List[Dict]] = None) -> Iterator[Dict[str, Any]]:
+        """使用 OpenAI API 串流對話 (工具調用的參數以片段陸續送達,依 index 組合)"""
+        params = {
+            "model": self.model_name,
+            "messages": messages,
+            "stream": True
+        }
+        if tools:
+            params["tools"] = self._convert_tools_to_openai_format(tools)
+        
+        content_parts = []
+        tool_calls = {}
+        try:
+            for chunk in self.client.chat.completions.create(**params):
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content_parts.append(delta.content)
+                    yield {"type": "delta", "content": delta.content}
+                for tc in delta.tool_calls or []:
+                    call = tool_calls.setdefault(tc.index, {
+                        "id": None,
+                        "type": "function",
+                        "function": {"name": "", "arguments": ""}
+                    })
+                    name = tc.function.name if tc.function else None
+                    arguments = (tc.function.arguments if tc.function else None) or ""
+                    if tc.id:
+                        call["id"] = tc.id
+                    if name:
+                        call["function"]["name"] = name
+                    call["function"]["arguments"] += arguments
+                    yield {"type": "tool_call", "index": tc.index, "id": tc.id, "name": name, "arguments": arguments}
+        except Exception as e:
+            raise Exception(f"OpenAI API 錯誤: {str(e)}")
+        
+        yield {"type": "done", "message": {
+            "role": "assistant",
+            "content": "".join(content_parts),
+            "tool_calls": [tool_calls[index] for index in sorted(tool_calls)]
+        }}
+    
     def _convert_tools_to_openai_format(self, tools: List[Dict]) -> List[Dict]:
         """將 MCP 工具格式轉換為 OpenAI 格式"""
         return [
@@ -190,7 +252,44 @@ class GeminiClient(AIClient):
             import traceback
             traceback.print_exc()
             raise Exception(f"Gemini API 錯誤: {str(e)}")
-
+    
+    def chat_stream(self, messages: List[Dict[str, str]], tools: Optional[List[Dict]] = None) -> Iterator[Dict[str, Any]]:
+        """使用 Google Gemini API 串流對話 (function call 以完整的 part 送達)"""
+        prompt = self._convert_messages_to_prompt(messages)
+        kwargs = {"stream": True}
+        if tools:
+            kwargs["tools"] = self._convert_tools_to_gemini_format(tools)
+        
+        content_parts = []
+        tool_calls = []
+        try:
+            for chunk in self.model.generate_content(prompt, **kwargs):
+                if not chunk.candidates:
+                    continue
+                for part in chunk.candidates[0].content.parts:
+                    function_call = getattr(part, 'function_call', None)
+                    if function_call and function_call.name:
+                        print(f"[Gemini] 偵測到工具調用: {function_call.name}")
+                        arguments = json.dumps(dict(function_call.args), ensure_ascii=False, default=str)
+                        tool_calls.append({
+                            "id": f"gemini_tool_call_{len(tool_calls)}",
+                            "type": "function",
+                            "function": {"name": function_call.name, "arguments": arguments}
+                        })
+                        yield {"type": "tool_call", "index": len(tool_calls) - 1, "id": tool_calls[-1]["id"],
+                               "name": function_call.name, "arguments": arguments}
+                    elif getattr(part, 'text', None):
+                        content_parts.append(part.text)
+                        yield {"type": "delta", "content": part.text}
+        except Exception as e:
+            print(f"[Gemini] API 錯誤: {str(e)}")
+            raise Exception(f"Gemini API 錯誤: {str(e)}")
+        
+        yield {"type": "done", "message": {
+            "role": "assistant",
+            "content": "".join(content_parts),
+            "tool_calls": tool_calls
+        }}
     
     def _convert_messages_to_prompt(self, messages: List[Dict[str, str]]) -> str:
         """將訊息列表轉換為 Gemini 提示詞"""
@@ -292,6 +391,48 @@ class ClaudeClient(AIClient):
         except Exception as e:
             raise Exception(f"Claude API 錯誤: {str(e)}")
     
+    def chat_stream(self, messages: List[Dict[str, str]], tools: Optional[List[Dict]] = None) -> Iterator[Dict[str, Any]]:
+        """使用 Anthropic Claude API 串流對話 (tool_use 區塊的輸入以 JSON 片段送達,完成後取最終訊息)"""
+        params = {
+            "model": self.model_name,
+            "max_tokens": 4096,
+            "messages": messages
+        }
+        if tools:
+            params["tools"] = self._convert_tools_to_claude_format(tools)
+        
+        try:
+            with self.client.messages.stream(**params) as stream:
+                for event in stream:
+                    if event.type == "content_block_start" and event.content_block.type == "tool_use":
+                        yield {"type": "tool_call", "index": event.index, "id": event.content_block.id,
+                               "name": event.content_block.name, "arguments": ""}
+                    elif event.type == "content_block_delta":
+                        if event.delta.type == "text_delta":
+                            yield {"type": "delta", "content": event.delta.text}
+                        elif event.delta.type == "input_json_delta":
+                            yield {"type": "tool_call", "index": event.index, "id": None, "name": None,
+                                   "arguments": event.delta.partial_json}
+                final = stream.get_final_message()
+        except Exception as e:
+            raise Exception(f"Claude API 錯誤: {str(e)}")
+        
+        yield {"type": "done", "message": {
+            "role": "assistant",
+            "content": "".join(block.text for block in final.content if block.type == "text"),
+            "tool_calls": [
+                {
+                    "id": block.id,
+                    "type": "function",
+                    "function": {
+                        "name": block.name,
+                        "arguments": block.input
+                    }
+                }
+                for block in final.content if block.type == "tool_use"
+            ]
+        }}
+    
     def _convert_tools_to_claude_format(self, tools: List[Dict]) -> List[Dict]:
         """將 MCP 工具格式轉換為 Claude 格式"""
         return [
@@ -3,27 +3,41 @@
 提供密碼雜湊、JWT Token 生成與驗證、權限檢查等功能
 """
 import os
+import threading
 import jwt
 import bcrypt
 from datetime import datetime, timedelta
 from functools import wraps
 from flask import request, jsonify
 import pymysql
+from services.db_pool import get_connection
+from services.cache_utils import TTLCache, SingleFlight
 
 # JWT 設定
 JWT_SECRET = os.getenv('JWT_SECRET', 'your-super-secret-jwt-key-change-this-in-production')
 JWT_ALGORITHM = os.getenv('JWT_ALGORITHM', 'HS256')
 JWT_EXPIRATION_HOURS = int(os.getenv('JWT_EXPIRATION_HOURS', '24'))
 
-# 資料庫連線設定
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'db'),
-    'port': int(os.getenv('DB_PORT', '3306')),
-    'user': os.getenv('DB_USER', 'mcp_user'),
-    'password': os.getenv('DB_PASSWORD', 'mcp_password'),
-    'database': os.getenv('DB_NAME', 'mcp_platform'),
-    'charset': 'utf8mb4'
-}
+# 使用者權限快取 (存活秒數、使用者數上限);角色或權限異動時由路由主動失效
+AUTH_PERMISSION_CACHE_TTL = float(os.getenv('AUTH_PERMISSION_CACHE_TTL', '60'))
+AUTH_PERMISSION_CACHE_SIZE = int(os.getenv('AUTH_PERMISSION_CACHE_SIZE', '1024'))
+
+SUPER_ADMIN_ROLE = '超級管理員'
+
+_permission_cache = TTLCache(AUTH_PERMISSION_CACHE_SIZE, AUTH_PERMISSION_CACHE_TTL)
+_permission_loads = SingleFlight()
+# 每次失效遞增;查詢期間發生失效時不寫入快取,避免存回舊的權限
+_permission_lock = threading.Lock()
+_permission_generation = 0
+
+
+def _empty_permissions() -> dict:
+    return {
+        'roles': [],
+        'permissions': [],
+        'pages': [],
+        'functions': []
+    }
 
 
 class AuthService:
@@ -101,7 +115,7 @@ class AuthService:
     @staticmethod
     def get_user_permissions(user_id: int) -> dict:
         """
-        取得使用者的所有權限
+        取得使用者的所有權限 (有快取,回傳的字典為共用物件,請勿修改)
         
         Args:
             user_id: 使用者 ID
@@ -114,10 +128,53 @@ class AuthService:
                 'functions': [...]
             }
         """
+        return AuthService._resolve_permissions(user_id)['permissions']
+    
+    @staticmethod
+    def invalidate_permissions(user_id: int = None):
+        """
+        使權限快取失效 (修改使用者角色、角色權限後呼叫)
+        
+        Args:
+            user_id: 使用者 ID;未指定時清除所有使用者 (角色異動會影響多位使用者)
+        """
+        global _permission_generation
+        with _permission_lock:
+            _permission_generation += 1
+            if user_id is None:
+                _permission_cache.clear()
+            else:
+                _permission_cache.pop(user_id)
+    
+    @staticmethod
+    def _resolve_permissions(user_id: int) -> dict:
+        """
+        取得使用者權限與預先整理的角色名稱、權限代碼集合
+        
+        同一使用者的並行查詢合併為一次;資料庫錯誤時回傳空權限且不快取
+        """
+        entry = _permission_cache.get(user_id)
+        if entry is not None:
+            return entry
+        
+        generation = _permission_generation
+        try:
+            entry = _permission_loads.do((user_id, generation), lambda: AuthService._load_permissions(user_id))
+        except Exception as e:
+            print(f"取得使用者權限失敗: {str(e)}")
+            return {'permissions': _empty_permissions(), 'role_names': frozenset(), 'codes': frozenset()}
+        
+        with _permission_lock:
+            if generation == _permission_generation:
+                _permission_cache.set(user_id, entry)
+        return entry
+    
+    @staticmethod
+    def _load_permissions(user_id: int) -> dict:
+        """從資料庫查詢使用者權限"""
+        connection = get_connection()
+        cursor = connection.cursor(pymysql.cursors.DictCursor)
         try:
-            connection = pymysql.connect(**DB_CONFIG)
-            cursor = connection.cursor(pymysql.cursors.DictCursor)
-            
             # 取得使用者角色
             cursor.execute("""
                 SELECT r.id, r.name, r.description
@@ -128,12 +185,7 @@ class AuthService:
             roles = cursor.fetchall()
             
             if not roles:
-                return {
-                    'roles': [],
-                    'permissions': [],
-                    'pages': [],
-                    'functions': []
-                }
+                return {'permissions': _empty_permissions(), 'role_names': frozenset(), 'codes': frozenset()}
             
             role_ids = [role['id'] for role in roles]
             
@@ -176,24 +228,18 @@ class AuthService:
                 functions = []
             
             return {
-                'roles': roles,
-                'permissions': permissions,
-                'pages': pages,
-                'functions': functions
-            }
-            
-        except Exception as e:
-            print(f"取得使用者權限失敗: {str(e)}")
-            return {
-                'roles': [],
-                'permissions': [],
-                'pages': [],
-                'functions': []
+                'permissions': {
+                    'roles': roles,
+                    'permissions': permissions,
+                    'pages': pages,
+                    'functions': functions
+                },
+                'role_names': frozenset(r['name'] for r in roles),
+                'codes': frozenset(p['code'] for p in permissions)
             }
         finally:
-            if 'connection' in locals():
-                cursor.close()
-                connection.close()
+            cursor.close()
+            connection.close()
     
     @staticmethod
     def has_permission(user_id: int, permission_code: str) -> bool:
@@ -207,12 +253,9 @@ class AuthService:
         Returns:
             是否擁有權限
         """
+        entry = AuthService._resolve_permissions(user_id)
         # 超級管理員擁有所有權限
-        if AuthService.has_role(user_id, '超級管理員'):
-            return True
-            
-        permissions = AuthService.get_user_permissions(user_id)
-        return any(p['code'] == permission_code for p in permissions['permissions'])
+        return SUPER_ADMIN_ROLE in entry['role_names'] or permission_code in entry['codes']
     
     @staticmethod
     def has_role(user_id: int, role_name: str) -> bool:
@@ -226,8 +269,7 @@ class AuthService:
         Returns:
             是否擁有角色
         """
-        permissions = AuthService.get_user_permissions(user_id)
-        return any(r['name'] == role_name for r in permissions['roles'])
+        return role_name in AuthService._resolve_permissions(user_id)['role_names']
 
 
 # 認證裝飾器
@@ -0,0 +1,199 @@
+"""
+Chunk 儲存服務 - 欄式、以 mmap 開啟的 chunk 文字與 metadata 儲存
+取代將整個 chunk 列表序列化為單一 pickle 的作法,查詢時只讀取需要的位元組
+"""
+import os
+import mmap
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+# 每個 chunk 一列,依 id 排序以便二分搜尋
+CHUNK_DTYPE = np.dtype([
+    ('id', '<i8'),        # chunk ID ((file_id << 32) | 序號)
+    ('start', '<u8'),     # 在 blob 中的起始位元組
+    ('length', '<u4'),    # UTF-8 位元組長度
+    ('file_id', '<i4'),   # 來源檔案 ID
+    ('page', '<i4'),      # 來源頁碼 (未知為 -1)
+    ('offset', '<i8'),    # 在原始文件中的字元位置 (未知為 -1)
+])
+
+# (chunk_id, 文字或 UTF-8 位元組, file_id, page, offset)
+ChunkRecord = Tuple[int, Union[str, bytes, memoryview], int, int, int]
+# 頁碼範圍 (起始頁, 結束頁),含兩端,None 表示不限
+PageRange = Tuple[Optional[int], Optional[int]]
+
+
+def _page_mask(page: np.ndarray, pages: PageRange) -> np.ndarray:
+    """頁碼落在範圍內的列 (頁碼未知者不符合)"""
+    keep = page >= 0
+    if pages[0] is not None:
+        keep &= page >= pages[0]
+    if pages[1] is not None:
+        keep &= page <= pages[1]
+    return keep
+
+
+class ChunkStore:
+    """
+    唯讀的 chunk 儲存
+
+    檔案配置 (prefix 為路徑前綴):
+        {prefix}.blob     - 所有 chunk 文字的 UTF-8 串接
+        {prefix}.meta.npy - CHUNK_DTYPE 結構化陣列,依 id 排序
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.meta = np.load(prefix + ".meta.npy", mmap_mode='r')
+        self._blob_file = open(prefix + ".blob", "rb")
+        if os.fstat(self._blob_file.fileno()).st_size:
+            self.blob = mmap.mmap(self._blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.blob = b""
+
+    @staticmethod
+    def exists(prefix: str) -> bool:
+        return os.path.exists(prefix + ".meta.npy") and os.path.exists(prefix + ".blob")
+
+    @staticmethod
+    def write(prefix: str, records: Iterable[ChunkRecord]):
+        """
+        寫入 chunk 儲存 (先寫暫存檔再以 os.replace 取代)
+
+        records 的文字可為 str 或已編碼的 bytes,後者用於在增量更新時直接複製舊資料
+        """
+        rows = []
+        position = 0
+        with open(prefix + ".blob.tmp", "wb") as blob:
+            for chunk_id, text, file_id, page, offset in records:
+                data = text.encode('utf-8') if isinstance(text, str) else text
+                blob.write(data)
+                rows.append((chunk_id, position, len(data), file_id, page, offset))
+                position += len(data)
+        meta = np.array(rows, dtype=CHUNK_DTYPE)
+        meta.sort(order='id')
+        with open(prefix + ".meta.npy.tmp", "wb") as f:
+            np.save(f, meta)
+        os.replace(prefix + ".blob.tmp", prefix + ".blob")
+        os.replace(prefix + ".meta.npy.tmp", prefix + ".meta.npy")
+
+    @staticmethod
+    def remove(prefix: str):
+        for suffix in (".blob", ".meta.npy"):
+            if os.path.exists(prefix + suffix):
+                os.remove(prefix + suffix)
+
+    def __len__(self) -> int:
+        return len(self.meta)
+
+    @property
+    def nbytes(self) -> int:
+        """metadata 陣列大小 (文字 blob 只有被讀取的頁面才會常駐)"""
+        return self.meta.nbytes
+
+    def _rows(self, ids: Iterable[int]) -> List[Optional[int]]:
+        """chunk ID -> 列號 (找不到為 None)"""
+        ids = np.asarray(list(ids), dtype='int64')
+        positions = np.searchsorted(self.meta['id'], ids)
+        rows = []
+        for chunk_id, pos in zip(ids.tolist(), positions.tolist()):
+            rows.append(pos if pos < len(self.meta) and self.meta['id'][pos] == chunk_id else None)
+        return rows
+
+    def _text(self, row: int) -> str:
+        start = int(self.meta['start'][row])
+        return self.blob[start:start + int(self.meta['length'][row])].decode('utf-8')
+
+    def get_texts(self, ids: Iterable[int]) -> List[Optional[str]]:
+        """依 chunk ID 取得文字"""
+        return [None if row is None else self._text(row) for row in self._rows(ids)]
+
+    def get_many(self, ids: Iterable[int]) -> List[Optional[Dict[str, Any]]]:
+        """依 chunk ID 取得文字與 metadata"""
+        results = []
+        for row in self._rows(ids):
+            if row is None:
+                results.append(None)
+                continue
+            rec = self.meta[row]
+            results.append({
+                "id": int(rec['id']),
+                "text": self._text(row),
+                "file_id": int(rec['file_id']),
+                "page": int(rec['page']),
+                "offset": int(rec['offset'])
+            })
+        return results
+
+    def records(self, keep: Optional[np.ndarray] = None) -> Iterable[ChunkRecord]:
+        """以原始位元組列舉 chunk (keep 為布林遮罩),供重寫儲存時複製"""
+        rows = np.flatnonzero(keep) if keep is not None else range(len(self.meta))
+        for row in rows:
+            rec = self.meta[row]
+            start = int(rec['start'])
+            yield (int(rec['id']), self.blob[start:start + int(rec['length'])],
+                   int(rec['file_id']), int(rec['page']), int(rec['offset']))
+
+    def file_mask(self, file_ids: Iterable[int]) -> np.ndarray:
+        """屬於指定檔案的列"""
+        return np.isin(self.meta['file_id'], np.asarray(list(file_ids), dtype='int32'))
+
+    def select_ids(self, ranges: Optional[Sequence[Tuple[int, int]]] = None,
+                   pages: Optional[PageRange] = None) -> np.ndarray:
+        """
+        符合過濾條件的 chunk ID (已排序)
+
+        ranges 為 chunk ID 區間 [lo, hi) (每個檔案一段),以二分搜尋取得列範圍,不掃描整個 metadata;
+        再依 pages 過濾頁碼
+        """
+        ids = self.meta['id']
+        if ranges is None:
+            rows = np.arange(len(ids))
+        else:
+            parts = [np.arange(*np.searchsorted(ids, [lo, hi])) for lo, hi in sorted(ranges)]
+            rows = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+        if pages is not None:
+            rows = rows[_page_mask(np.asarray(self.meta['page'][rows]), pages)]
+        return np.asarray(ids[rows], dtype=np.int64)
+
+
+class InMemoryChunks:
+    """舊版 pickle chunks 的相容包裝 (列表依位置定址,字典依 chunk ID 定址)"""
+
+    def __init__(self, chunks: Union[List[str], Dict[int, str]]):
+        self.chunks = chunks
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    @property
+    def nbytes(self) -> int:
+        values = self.chunks.values() if isinstance(self.chunks, dict) else self.chunks
+        return sum(len(c) for c in values) * 3
+
+    def get_texts(self, ids: Iterable[int]) -> List[Optional[str]]:
+        if isinstance(self.chunks, dict):
+            return [self.chunks.get(int(i)) for i in ids]
+        return [self.chunks[i] if 0 <= i < len(self.chunks) else None for i in ids]
+
+    def get_many(self, ids: Iterable[int]) -> List[Optional[Dict[str, Any]]]:
+        ids = list(ids)
+        return [
+            None if text is None else {"id": int(i), "text": text, "file_id": -1, "page": -1, "offset": -1}
+            for i, text in zip(ids, self.get_texts(ids))
+        ]
+
+    def select_ids(self, ranges: Optional[Sequence[Tuple[int, int]]] = None,
+                   pages: Optional[PageRange] = None) -> np.ndarray:
+        """舊版格式沒有頁碼,指定 pages 時沒有符合的 chunk"""
+        keys = self.chunks.keys() if isinstance(self.chunks, dict) else range(len(self.chunks))
+        ids = np.array(sorted(keys), dtype=np.int64)
+        if pages is not None:
+            return ids[:0]
+        if ranges is not None:
+            keep = np.zeros(len(ids), dtype=bool)
+            for lo, hi in ranges:
+                keep |= (ids >= lo) & (ids < hi)
+            ids = ids[keep]
+        return ids
@@ -0,0 +1,127 @@
+"""
+文字切分 - 四種切分策略的線性時間實作
+所有切分函式只回傳 (start, end) 字元區間,由呼叫端決定是否複製成字串
+(語義切分的 chunk 文字需以 semantic_text 產生)
+"""
+import re
+import bisect
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+Span = Tuple[int, int]
+
+# 語義切分的句子: 句尾符號 (。！？.!? 與換行) 之間的文字,不含前後空白
+_SENTENCE_RE = re.compile(r'[^。！？.!?\s](?:[^。！？.!?\n]*[^。！？.!?\s])?')
+# 遞歸切分依序嘗試的分隔符號 ("" 表示退回固定長度切分)
+RECURSIVE_SEPARATORS = ["\n\n", "\n", "。", ".", " ", ""]
+_SEPARATOR_RES = [re.compile(re.escape(sep)) if sep else None for sep in RECURSIVE_SEPARATORS]
+
+
+def character_spans(text: str, chunk_size: int, chunk_overlap: int,
+                    start: int = 0, end: Optional[int] = None) -> List[Span]:
+    """固定長度切分,相鄰區間重疊 chunk_overlap 個字元"""
+    end = len(text) if end is None else end
+    step = max(chunk_size - chunk_overlap, 1)
+    return [(i, min(i + chunk_size, end)) for i in range(start, end, step)]
+
+
+def token_spans(text: str, encoding, chunk_size: int, chunk_overlap: int) -> List[Span]:
+    """
+    Token 切分: 每個區間包含 chunk_size 個 token
+
+    token 邊界以 UTF-8 位元組位置換算成字元位置;
+    落在多位元組字元中間的邊界會擴大到完整字元,不會產生半個字
+    """
+    tokens = encoding.encode_ordinary(text)
+    if not tokens:
+        return []
+    data = np.frombuffer(text.encode('utf-8'), dtype=np.uint8)
+    # 每個位元組所屬的字元編號 (UTF-8 後續位元組為 10xxxxxx)
+    char_of_byte = np.cumsum((data & 0xC0) != 0x80) - 1
+    char_of_byte = np.append(char_of_byte, len(text))
+    is_continuation = np.append((data & 0xC0) == 0x80, False)
+
+    token_bytes = np.fromiter((len(b) for b in encoding.decode_tokens_bytes(tokens)),
+                              dtype=np.int64, count=len(tokens))
+    bounds = np.concatenate(([0], np.cumsum(token_bytes)))
+
+    step = max(chunk_size - chunk_overlap, 1)
+    starts = np.arange(0, len(tokens), step)
+    ends = np.minimum(starts + chunk_size, len(tokens))
+    start_bytes, end_bytes = bounds[starts], bounds[ends]
+    span_starts = char_of_byte[start_bytes]
+    span_ends = char_of_byte[end_bytes] + is_continuation[end_bytes]
+    return list(zip(span_starts.tolist(), span_ends.tolist()))
+
+
+def semantic_spans(text: str, max_size: int) -> List[Span]:
+    """
+    語義切分: 以句子為單位合併,直到超過 max_size
+
+    句子以句尾標點分隔並去除前後空白,只有空白的句子略過;長度以 semantic_text 的輸出
+    (每句補上 "。") 計算,切分位置與舊版字串累加實作相同。單一句子超過 max_size 時自成一個 chunk。
+    區間從第一句的起點到最後一句的終點,最後一個區間延伸到文字結尾 (串流切分時必須留待重切)
+    """
+    sentences = np.array([m.span() for m in _SENTENCE_RE.finditer(text)], dtype=np.int64).reshape(-1, 2)
+    starts, ends = sentences[:, 0], sentences[:, 1]
+    # totals[k]: 前 k 句輸出後的長度
+    totals = np.concatenate(([0], np.cumsum(ends - starts + 1)))
+
+    spans = []
+    i = 0
+    while i < len(starts):
+        # 第 j 句可加入的條件: 加入前的長度 + 句長 <= max_size,即 totals[j + 1] - 1 - totals[i] <= max_size
+        j = max(int(np.searchsorted(totals, totals[i] + max_size + 1, side='right')) - 2, i)
+        spans.append((int(starts[i]), int(ends[j])))
+        i = j + 1
+    if spans:
+        spans[-1] = (spans[-1][0], len(text))
+    return spans
+
+
+def semantic_text(text: str, start: int, end: int) -> str:
+    """語義切分區間的 chunk 文字: 各句去除前後空白後補上 "。" 串接 (與舊版輸出格式相同)"""
+    return "".join(sentence + "。" for sentence in _SENTENCE_RE.findall(text, start, end))
+
+
+def recursive_spans(text: str, chunk_size: int, chunk_overlap: int,
+                    restarts: Optional[List[int]] = None) -> List[Span]:
+    """
+    遞歸切分 (LangChain 風格)
+
+    依序以分隔符號切段 (分隔符號保留在前一段結尾) 並合併到 chunk_size;
+    單段仍過長時改用下一個分隔符號,最後退回固定長度切分。每一層只掃描一次
+
+    Args:
+        restarts: 提供時加入最上層每次合併的起點;只有從這些位置重新切分,
+                  之後的結果才與整份切分一致 (串流切分用)
+    """
+    def split(start: int, end: int, level: int) -> List[Span]:
+        sep = RECURSIVE_SEPARATORS[level]
+        if not sep:
+            return character_spans(text, chunk_size, chunk_overlap, start, end)
+
+        # 各段的終點 (含分隔符號),最後一段到 end 為止
+        piece_ends = [m.end() for m in _SEPARATOR_RES[level].finditer(text, start, end)]
+        if not piece_ends or piece_ends[-1] < end:
+            piece_ends.append(end)
+
+        spans = []
+        position = start
+        i = 0
+        while i < len(piece_ends):
+            if level == 0 and restarts is not None:
+                restarts.append(position)
+            j = bisect.bisect_right(piece_ends, position + chunk_size, i) - 1
+            if j >= i:
+                spans.append((position, piece_ends[j]))
+                i = j + 1
+            else:
+                # 單段就超過 chunk_size,改用下一個分隔符號
+                spans.extend(split(position, piece_ends[i], level + 1))
+                i += 1
+            position = piece_ends[i - 1]
+        return spans
+
+    return split(0, len(text), 0)
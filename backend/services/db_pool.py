@@ -0,0 +1,267 @@
+"""
+資料庫連線池 - 後端所有路由與服務共用的 pymysql 連線
+
+取出的連線與 pymysql 連線用法相同,close() 時歸還連線池而非中斷 TCP 連線;
+歸還時 rollback 未提交的交易,行為與原本關閉連線一致
+"""
+import os
+import time
+import threading
+from collections import deque
+from typing import Any, Dict
+
+import pymysql
+
+# 資料庫連線設定
+DB_CONFIG = {
+    'host': os.getenv('DB_HOST', 'db'),
+    'port': int(os.getenv('DB_PORT', '3306')),
+    'user': os.getenv('DB_USER', 'mcp_user'),
+    'password': os.getenv('DB_PASSWORD', 'mcp_password'),
+    'database': os.getenv('DB_NAME', 'mcp_platform'),
+    'charset': 'utf8mb4'
+}
+
+# 連線數上限與連線用盡時等待的秒數
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '20'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+# 連線建立超過此秒數即汰換 (低於 MySQL wait_timeout)
+DB_POOL_RECYCLE = float(os.getenv('DB_POOL_RECYCLE', '3600'))
+# 閒置超過此秒數的連線取出前先 ping 檢查 (0 表示每次取出都檢查)
+DB_POOL_PING_AFTER = float(os.getenv('DB_POOL_PING_AFTER', '5'))
+
+
+class PoolTimeoutError(pymysql.err.OperationalError):
+    """等待可用連線逾時"""
+
+
+class PooledConnection:
+    """
+    從連線池取出的連線
+
+    其餘屬性與方法 (commit、rollback、insert_id...) 直接轉給 pymysql 連線;
+    未呼叫 close() 就被回收 (例如例外路徑) 時同樣歸還連線池
+    """
+
+    def __init__(self, pool: "ConnectionPool", conn, cursorclass):
+        self._pool = pool
+        self._conn = conn
+        self._cursorclass = cursorclass
+
+    def cursor(self, cursor=None):
+        if self._conn is None:
+            raise pymysql.err.InterfaceError("連線已歸還連線池")
+        return self._conn.cursor(cursor or self._cursorclass)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool._release(conn)
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get('_conn')
+        if conn is None:
+            raise pymysql.err.InterfaceError("連線已歸還連線池")
+        return getattr(conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        conn, self._conn = self.__dict__.get('_conn'), None
+        if conn is not None:
+            self._pool._release(conn, leaked=True)
+
+
+class ConnectionPool:
+    """
+    有上限的 pymysql 連線池 (執行緒安全)
+
+    閒置連線以 LIFO 取用,常用的連線保持熱的;連線數達上限時等待其他請求歸還,
+    超過 timeout 拋出 PoolTimeoutError
+    """
+
+    def __init__(self, config: Dict[str, Any], max_size: int = DB_POOL_MAX_SIZE,
+                 timeout: float = DB_POOL_TIMEOUT, recycle: float = DB_POOL_RECYCLE,
+                 ping_after: float = DB_POOL_PING_AFTER):
+        self.config = config
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        # 閒置連線: (連線, 建立時間, 歸還時間)
+        self._idle: "deque[tuple]" = deque()
+        self._created_at: Dict[int, float] = {}
+        self._size = 0
+        self._pid = os.getpid()
+        self._waiting = 0
+        self._peak_in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_seconds = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        self._created = 0
+        self._recycled = 0
+        self._ping_failures = 0
+        self._leaked = 0
+
+    def connection(self, cursorclass=None) -> PooledConnection:
+        """
+        取出一條連線
+
+        Args:
+            cursorclass: conn.cursor() 未指定時使用的游標類別 (預設為 tuple 游標)
+        """
+        conn = self._acquire()
+        return PooledConnection(self, conn, cursorclass or pymysql.cursors.Cursor)
+
+    def _acquire(self):
+        start = time.monotonic()
+        waited = False
+        with self._cond:
+            if self._pid != os.getpid():
+                # fork 後的子行程不可沿用父行程的 socket
+                self._reset()
+            self._checkouts += 1
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._idle:
+                        conn, created, returned = self._idle.pop()
+                        if time.monotonic() - created > self.recycle:
+                            self._recycled += 1
+                            self._discard(conn)
+                            conn = None
+                            continue
+                        break
+                    if self._size < self.max_size:
+                        # 預先佔用名額,在鎖外建立新連線
+                        self._size += 1
+                        break
+                    remaining = start + self.timeout - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        print(f"[DB] 連線池已滿,等待逾時 (使用中 {self._size}/{self.max_size})")
+                        raise PoolTimeoutError(
+                            f"資料庫連線池已滿 ({self.max_size} 條),等待 {self.timeout:g} 秒逾時")
+                    if not waited:
+                        waited = True
+                        self._waits += 1
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+
+            if conn is not None:
+                # 健康檢查在鎖外進行,失敗的連線丟棄後重新取用
+                if time.monotonic() - returned >= self.ping_after and not self._ping(conn):
+                    continue
+                with self._cond:
+                    return self._checked_out(conn, waited, start)
+
+            try:
+                conn = pymysql.connect(**self.config)
+            except BaseException:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._created += 1
+                self._created_at[id(conn)] = time.monotonic()
+                return self._checked_out(conn, waited, start)
+
+    def _checked_out(self, conn, waited: bool, start: float):
+        """記錄取出統計 (呼叫端持有鎖)"""
+        if waited:
+            elapsed = time.monotonic() - start
+            self._wait_seconds += elapsed
+            self._max_wait = max(self._max_wait, elapsed)
+        self._peak_in_use = max(self._peak_in_use, self._size - len(self._idle))
+        return conn
+
+    def _ping(self, conn) -> bool:
+        """健康檢查;失敗的連線直接丟棄"""
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            with self._cond:
+                self._ping_failures += 1
+                self._discard(conn)
+            return False
+
+    def _discard(self, conn):
+        """關閉並移除連線 (呼叫端持有鎖)"""
+        self._size -= 1
+        self._created_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self._cond.notify()
+
+    def _release(self, conn, leaked: bool = False):
+        """歸還連線: 撤銷未提交的交易,失效或已到汰換時間的連線直接關閉"""
+        try:
+            healthy = conn.open
+            if healthy:
+                conn.rollback()
+        except Exception:
+            healthy = False
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            if leaked:
+                self._leaked += 1
+            created = self._created_at.get(id(conn), 0.0)
+            now = time.monotonic()
+            if not healthy or now - created > self.recycle:
+                if healthy:
+                    self._recycled += 1
+                self._discard(conn)
+                return
+            self._idle.append((conn, created, now))
+            self._cond.notify()
+
+    def stats(self) -> Dict[str, Any]:
+        """連線池統計資訊 (in_use 接近 max_size 且 waits 持續增加表示連線池飽和)"""
+        with self._cond:
+            in_use = self._size - len(self._idle)
+            return {
+                "max_size": self.max_size,
+                "size": self._size,
+                "in_use": in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "utilization": round(in_use / self.max_size, 3),
+                "peak_in_use": self._peak_in_use,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_seconds_total": round(self._wait_seconds, 3),
+                "max_wait_seconds": round(self._max_wait, 3),
+                "timeouts": self._timeouts,
+                "created": self._created,
+                "recycled": self._recycled,
+                "ping_failures": self._ping_failures,
+                "leaked": self._leaked
+            }
+
+
+# 建立全域連線池
+db_pool = ConnectionPool(DB_CONFIG)
+
+
+def get_connection(cursorclass=None) -> PooledConnection:
+    """從全域連線池取出連線"""
+    return db_pool.connection(cursorclass)
@@ -0,0 +1,249 @@
+"""
+近似重複 chunk 偵測 - 以 MinHash + LSH 在產生 Embedding 前合併近乎相同的段落
+(同一份規章的多個修訂版、重複上傳的文件等)
+
+以字元 shingle 計算 Jaccard 相似度,不依賴斷詞,中英文皆適用;
+相較 SimHash,MinHash 對短段落的局部修改估計較穩定。
+只差在型號、規格數字的段落 (DX-1800 / DX-2000 的同一份說明) Jaccard 仍很高,
+因此另外比對段落中含數字的詞,不同者不合併
+"""
+import os
+import re
+import hashlib
+import unicodedata
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# MinHash 雜湊函式數與 LSH 分帶 (16 帶 x 4 列,Jaccard 約 0.5 以上即成為候選,再以估計值確認)
+NUM_PERM = 64
+LSH_BANDS = 16
+SHINGLE_CHARS = 5
+# 每批計算簽章的 shingle 數上限 (限制暫存矩陣大小)
+SIGNATURE_BATCH_SHINGLES = 200_000
+
+_MAX_HASH = np.uint32(0xFFFFFFFF)
+_rng = np.random.default_rng(20240601)
+# (a * h + b) mod 2^32,a 為奇數時是 32-bit 空間上的一個排列
+_PERM_A = _rng.integers(0, 2 ** 31, size=NUM_PERM, dtype=np.uint32) * np.uint32(2) + np.uint32(1)
+_PERM_B = _rng.integers(0, 2 ** 32, size=NUM_PERM, dtype=np.uint32)
+_POLY = np.uint64(1099511628211)
+_BAND_MIX = np.uint64(0x9E3779B97F4A7C15)
+# 含數字的詞 (型號、規格、版本號): 英數字與 . _ - / 組成的連續字串
+_NUMBER_TOKEN_RE = re.compile(r'[0-9a-z][0-9a-z._/-]*')
+
+
+def _normalize(text: str) -> str:
+    """NFKC、小寫並合併空白,排版差異不影響相似度"""
+    return " ".join(unicodedata.normalize('NFKC', text).lower().split())
+
+
+def _shingle_hashes(text: str) -> np.ndarray:
+    """字元 shingle 的 32-bit 雜湊 (不去重,MinHash 取最小值不受重複影響)"""
+    codes = np.frombuffer(_normalize(text).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    if len(codes) <= SHINGLE_CHARS:
+        width = len(codes)
+        count = 1
+    else:
+        width = SHINGLE_CHARS
+        count = len(codes) - SHINGLE_CHARS + 1
+    hashes = np.zeros(count, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for j in range(width):
+            hashes = hashes * _POLY + codes[j:j + count]
+    return (hashes ^ (hashes >> np.uint64(32))).astype(np.uint32)
+
+
+def number_keys(texts: Sequence[str]) -> np.ndarray:
+    """
+    每段文字中含數字的詞集合的雜湊 (uint64)
+
+    最低位元固定為 1,舊版去重狀態沒有記錄此值 (0) 的代表段落不會與新 chunk 合併
+    """
+    keys = np.empty(len(texts), dtype=np.uint64)
+    for row, text in enumerate(texts):
+        tokens = sorted({token for token in _NUMBER_TOKEN_RE.findall(_normalize(text))
+                         if any(ch.isdigit() for ch in token)})
+        digest = hashlib.blake2b("\0".join(tokens).encode('utf-8'), digest_size=8).digest()
+        keys[row] = int.from_bytes(digest, 'little') | 1
+    return keys
+
+
+def minhash_signatures(texts: Sequence[str]) -> np.ndarray:
+    """計算每段文字的 MinHash 簽章 (n x NUM_PERM, uint32)"""
+    signatures = np.empty((len(texts), NUM_PERM), dtype=np.uint32)
+    batch, batch_rows, batch_size = [], [], 0
+
+    def flush():
+        hashes = np.concatenate(batch)
+        starts = np.cumsum([0] + [len(h) for h in batch[:-1]])
+        with np.errstate(over='ignore'):
+            # 以 (雜湊函式, shingle) 配置,reduceat 沿連續記憶體取每段最小值
+            permuted = _PERM_A[:, None] * hashes[None, :] + _PERM_B[:, None]
+        signatures[batch_rows] = np.minimum.reduceat(permuted, starts, axis=1).T
+
+    for row, text in enumerate(texts):
+        hashes = _shingle_hashes(text)
+        if len(hashes) == 0:
+            signatures[row] = _MAX_HASH
+            continue
+        batch.append(hashes)
+        batch_rows.append(row)
+        batch_size += len(hashes)
+        if batch_size >= SIGNATURE_BATCH_SHINGLES:
+            flush()
+            batch, batch_rows, batch_size = [], [], 0
+    if batch:
+        flush()
+    return signatures
+
+
+def _band_keys(signatures: np.ndarray) -> np.ndarray:
+    """每個簽章在各分帶的雜湊鍵 (n x LSH_BANDS, uint64)"""
+    rows = NUM_PERM // LSH_BANDS
+    bands = signatures.reshape(len(signatures), LSH_BANDS, rows).astype(np.uint64)
+    keys = np.zeros((len(signatures), LSH_BANDS), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for r in range(rows):
+            keys = keys * _POLY + bands[:, :, r]
+        keys ^= np.arange(LSH_BANDS, dtype=np.uint64) * _BAND_MIX
+    return keys
+
+
+class DedupIndex:
+    """
+    知識庫的去重狀態 (隨索引版本一起儲存)
+
+    ids / signatures - 已進入向量索引的 chunk (代表段落) 及其簽章
+    keys             - 代表段落含數字的詞集合雜湊 (number_keys),相同才可合併
+    band_keys / band_rows - LSH 分帶鍵 (已排序) 與其代表段落列號;一併儲存,增量加入時以 searchsorted
+                       查詢候選並就地插入,不必每次為整個知識庫重算
+    dup_ids / dup_of - 被合併的 chunk 與其對應的代表段落;文字仍保留在 chunk 儲存中,
+                       代表段落所屬檔案被移除時可重新提升為代表段落
+    """
+
+    def __init__(self, ids: Optional[np.ndarray] = None, signatures: Optional[np.ndarray] = None,
+                 dup_ids: Optional[np.ndarray] = None, dup_of: Optional[np.ndarray] = None,
+                 keys: Optional[np.ndarray] = None, band_keys: Optional[np.ndarray] = None,
+                 band_rows: Optional[np.ndarray] = None):
+        self.ids = ids if ids is not None else np.zeros(0, dtype=np.int64)
+        self.signatures = signatures if signatures is not None else np.zeros((0, NUM_PERM), dtype=np.uint32)
+        self.keys = keys if keys is not None else np.zeros(len(self.ids), dtype=np.uint64)
+        self.dup_ids = dup_ids if dup_ids is not None else np.zeros(0, dtype=np.int64)
+        self.dup_of = dup_of if dup_of is not None else np.zeros(0, dtype=np.int64)
+        if band_keys is None or band_rows is None:
+            # 舊版去重狀態沒有儲存分帶鍵: 由簽章一次算出
+            band_keys, band_rows = self._sorted_bands(_band_keys(self.signatures), np.arange(len(self.ids)))
+        self.band_keys, self.band_rows = band_keys, band_rows
+
+    @classmethod
+    def load(cls, path: str) -> Optional["DedupIndex"]:
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            optional = {name: data[name] for name in ("keys", "band_keys", "band_rows") if name in data.files}
+            return cls(data["ids"], data["signatures"], data["dup_ids"], data["dup_of"], **optional)
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            np.savez(f, ids=self.ids, signatures=self.signatures, dup_ids=self.dup_ids, dup_of=self.dup_of,
+                     keys=self.keys, band_keys=self.band_keys, band_rows=self.band_rows)
+
+    @property
+    def duplicate_count(self) -> int:
+        return len(self.dup_ids)
+
+    @staticmethod
+    def _sorted_bands(bands: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(列數 x LSH_BANDS) 的分帶鍵攤平後依鍵排序,回傳 (分帶鍵, 列號)"""
+        flat_keys = bands.ravel()
+        flat_rows = np.repeat(np.asarray(rows, dtype=np.int64), LSH_BANDS)
+        order = np.argsort(flat_keys, kind='stable')
+        return flat_keys[order], flat_rows[order]
+
+    def remove_ranges(self, ranges: Sequence[Tuple[int, int]]) -> np.ndarray:
+        """
+        移除 chunk ID 落在 ranges ([lo, hi)) 的段落
+
+        Returns:
+            代表段落被移除、本身仍存在的重複 chunk ID;呼叫端需將其重新加入 (add)
+        """
+        def in_ranges(values: np.ndarray) -> np.ndarray:
+            mask = np.zeros(len(values), dtype=bool)
+            for lo, hi in ranges:
+                mask |= (values >= lo) & (values < hi)
+            return mask
+
+        keep = ~in_ranges(self.ids)
+        self.ids, self.signatures, self.keys = self.ids[keep], self.signatures[keep], self.keys[keep]
+        # 分帶鍵維持排序,只需過濾並把列號改為移除後的位置
+        kept_bands = keep[self.band_rows]
+        self.band_keys = self.band_keys[kept_bands]
+        self.band_rows = (np.cumsum(keep) - 1)[self.band_rows[kept_bands]]
+
+        dropped_dup = in_ranges(self.dup_ids)
+        orphaned = ~dropped_dup & in_ranges(self.dup_of)
+        orphans = self.dup_ids[orphaned]
+        keep = ~dropped_dup & ~orphaned
+        self.dup_ids, self.dup_of = self.dup_ids[keep], self.dup_of[keep]
+        return orphans
+
+    def add(self, ids: Sequence[int], texts: Sequence[str], threshold: float) -> np.ndarray:
+        """
+        加入新的 chunks,估計 Jaccard 相似度達 threshold 且含數字的詞完全相同者,
+        合併到既有 (或同批較早) 的代表段落
+
+        threshold <= 0 時只記錄簽章、不合併。
+        既有代表段落的候選以已排序的分帶鍵查詢,Python 迴圈只走過本次加入的 chunks
+
+        Returns:
+            布林遮罩,True 表示該 chunk 為新的代表段落,需要產生 Embedding 並加入索引
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        signatures = minhash_signatures(texts)
+        keys = number_keys(texts)
+        bands = _band_keys(signatures)
+        keep = np.ones(len(ids), dtype=bool)
+        dup_of = np.full(len(ids), -1, dtype=np.int64)
+
+        if threshold > 0 and len(ids):
+            # 列號: 既有代表段落在前,本批第 i 個 chunk 為 existing + i
+            existing = len(self.ids)
+            matrix = np.vstack([self.signatures, signatures])
+            row_ids = np.concatenate([self.ids, ids])
+            row_keys = np.concatenate([self.keys, keys])
+            starts = np.searchsorted(self.band_keys, bands, side='left')
+            ends = np.searchsorted(self.band_keys, bands, side='right')
+            # 同批較早成為代表段落者: 分帶鍵 -> 列號
+            buckets: Dict[int, List[int]] = {}
+            for i, row_bands in enumerate(bands.tolist()):
+                parts = [self.band_rows[start:end] for start, end in zip(starts[i].tolist(), ends[i].tolist())
+                         if end > start]
+                batch_rows = {row for band in row_bands for row in buckets.get(band, ())}
+                if batch_rows:
+                    parts.append(np.fromiter(batch_rows, dtype=np.int64, count=len(batch_rows)))
+                if parts:
+                    rows = np.unique(np.concatenate(parts))
+                    rows = rows[row_keys[rows] == keys[i]]
+                    if len(rows):
+                        similarity = (matrix[rows] == signatures[i]).mean(axis=1)
+                        best = int(np.argmax(similarity))
+                        if similarity[best] >= threshold:
+                            keep[i] = False
+                            dup_of[i] = row_ids[rows[best]]
+                            continue
+                for band in row_bands:
+                    buckets.setdefault(band, []).append(existing + i)
+
+        # 新代表段落的分帶鍵依序插入 (列號為加入後的位置)
+        new_keys, new_rows = self._sorted_bands(bands[keep], len(self.ids) + np.arange(int(keep.sum())))
+        positions = np.searchsorted(self.band_keys, new_keys, side='right')
+        self.band_keys = np.insert(self.band_keys, positions, new_keys)
+        self.band_rows = np.insert(self.band_rows, positions, new_rows)
+
+        self.ids = np.concatenate([self.ids, ids[keep]])
+        self.signatures = np.vstack([self.signatures, signatures[keep]])
+        self.keys = np.concatenate([self.keys, keys[keep]])
+        self.dup_ids = np.concatenate([self.dup_ids, ids[~keep]])
+        self.dup_of = np.concatenate([self.dup_of, dup_of[~keep]])
+        return keep
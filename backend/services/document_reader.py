@@ -0,0 +1,115 @@
+"""
+文件讀取服務 - 以串流方式逐頁/逐段落提取文字
+PDF 的頁面分段交給共用的行程池並行解析,呼叫端依序取得各頁文字,不需先組出整份文件字串
+"""
+import os
+import math
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Optional, Tuple
+
+from pypdf import PdfReader
+from docx import Document
+
+from services.pdf_extract_worker import extract_pdf_pages
+
+# 解析 PDF 的行程數 (預設為 CPU 核心數,最多 4 個)
+RAG_EXTRACT_WORKERS = int(os.getenv('RAG_EXTRACT_WORKERS', str(min(4, os.cpu_count() or 1))))
+# 每個行程任務至少處理的頁數 (每個任務都要重新解析一次 PDF 結構,頁數太少時開銷大於並行的效益)
+PDF_PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', '64'))
+# 每個 worker 平均分到的任務數上限: 大檔案改為加大每個任務的頁數
+PDF_TASKS_PER_WORKER = 2
+# 純文字檔每次讀取的字元數
+TEXT_BLOCK_CHARS = 64 * 1024
+
+# (頁碼, 文字);頁碼從 1 開始,沒有頁面概念的格式為 -1
+Segment = Tuple[int, str]
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def get_extract_pool() -> Optional[ProcessPoolExecutor]:
+    """
+    共用的解析行程池 (懶建立)
+
+    不在已有執行緒 (Flask、背景工作、faiss/OpenMP) 的行程中 fork:
+    支援 forkserver 時由只預先載入 pdf_extract_worker 的 fork server 產生 worker,否則使用 spawn。
+    worker 仍會重新匯入 __main__ 模組,因此服務以輕量的 run.py 啟動
+    """
+    global _pool
+    if RAG_EXTRACT_WORKERS <= 1:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(['services.pdf_extract_worker'])
+            else:
+                context = multiprocessing.get_context('spawn')
+            _pool = ProcessPoolExecutor(max_workers=RAG_EXTRACT_WORKERS, mp_context=context)
+        return _pool
+
+
+def iter_pdf(file_path: str) -> Iterator[Segment]:
+    """逐頁產生 PDF 文字;頁數多時分段並行解析,同時在途的任務數有上限以限制記憶體"""
+    page_count = len(PdfReader(file_path).pages)
+    pool = get_extract_pool()
+    if pool is None or page_count <= PDF_PAGES_PER_TASK:
+        yield from zip(range(1, page_count + 1), extract_pdf_pages(file_path, 0, page_count))
+        return
+
+    pages_per_task = max(PDF_PAGES_PER_TASK, math.ceil(page_count / (RAG_EXTRACT_WORKERS * PDF_TASKS_PER_WORKER)))
+    ranges = deque((start, min(start + pages_per_task, page_count))
+                   for start in range(0, page_count, pages_per_task))
+    pending = deque()
+    max_in_flight = RAG_EXTRACT_WORKERS * 2
+    try:
+        while ranges or pending:
+            while ranges and len(pending) < max_in_flight:
+                start, end = ranges.popleft()
+                pending.append((start, pool.submit(extract_pdf_pages, file_path, start, end)))
+            start, future = pending.popleft()
+            for offset, text in enumerate(future.result()):
+                yield start + offset + 1, text
+    finally:
+        # 呼叫端提前停止或發生錯誤時,取消尚未開始的任務
+        for _, future in pending:
+            future.cancel()
+
+
+def iter_docx(file_path: str) -> Iterator[Segment]:
+    """逐段落產生 DOCX 文字"""
+    for para in Document(file_path).paragraphs:
+        yield -1, para.text
+
+
+def iter_text_file(file_path: str) -> Iterator[Segment]:
+    """分塊讀取純文字檔"""
+    with open(file_path, "r", encoding="utf-8") as f:
+        while True:
+            block = f.read(TEXT_BLOCK_CHARS)
+            if not block:
+                break
+            yield -1, block
+
+
+def iter_document(file_path: str) -> Iterator[Segment]:
+    """
+    依副檔名以串流方式提取文件文字
+
+    PDF 每頁、DOCX 每段落各為一個片段,片段之間以換行分隔;純文字檔則原樣分塊
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == ".pdf":
+        for page, text in iter_pdf(file_path):
+            yield page, text + "\n"
+    elif ext == ".docx":
+        for page, text in iter_docx(file_path):
+            yield page, text + "\n"
+    elif ext in [".txt", ".md"]:
+        yield from iter_text_file(file_path)
+    else:
+        raise ValueError(f"不支援的檔案格式: {ext}")
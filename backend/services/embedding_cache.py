@@ -0,0 +1,284 @@
+"""
+Embedding 快取服務 - 以內容定址的持久化向量快取
+鍵為 (provider, model, dimension, sha256(text)),跨知識庫與重建共用
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import List, Optional, Dict, Set
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows 開發環境沒有 fcntl,只做行程內鎖定
+    fcntl = None
+
+# 每個向量列額外佔用的空間: sha256 (32 bytes) + 最後使用時間 (8 bytes) + 變更紀錄 (4 bytes)
+_ROW_OVERHEAD = 44
+# 快取滿時一次淘汰的比例
+_EVICT_RATIO = 0.1
+# 讀取端累積的使用紀錄,每隔幾秒或累積幾筆寫回 stamps.bin
+_TOUCH_FLUSH_INTERVAL = 5.0
+_TOUCH_FLUSH_MAX = 1024
+
+_EMPTY_KEY = bytes(32)
+
+
+class _Namespace:
+    """
+    單一 (provider, model, dimension) 命名空間
+
+    檔案配置:
+        vectors.f32 - float32 矩陣 (capacity x dimension),以 mmap 存取
+        keys.bin    - 每列對應的 sha256 digest,全 0 表示空列
+        stamps.bin  - 每列最後使用時間 (ns),供淘汰時挑選最久未使用的列
+        changes.bin - 變更過的列號 (capacity 筆的環狀紀錄)
+        state.bin   - [generation],累計的變更筆數
+
+    所有寫入 (含 stamps.bin) 都在檔案鎖內進行。讀取端不持有檔案鎖:
+      - 以 keys.bin 作為 seqlock: 寫入端覆寫一列前先清除該列的 key,向量寫完後才寫回 key;
+        讀取端複製向量前後都確認 key 仍相符,否則視為未命中
+      - 雜湊索引依 changes.bin 只更新變更過的列;落後超過一整圈時才全部重建
+      - 命中時只記在行程內,之後取得檔案鎖時再寫回 stamps.bin (不與淘汰互相覆寫)
+    """
+
+    def __init__(self, path: str, dimension: int, capacity: int):
+        self.path = path
+        self.dimension = dimension
+        self.capacity = capacity
+        changes_path = os.path.join(path, "changes.bin")
+        if not os.path.exists(changes_path):
+            # 舊版命名空間沒有變更紀錄,補建 (第一次 refresh 會全部重建雜湊索引)
+            with open(changes_path, "wb") as f:
+                f.truncate(capacity * 4)
+        self.vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype='float32',
+                                 mode='r+', shape=(capacity, dimension))
+        self.keys = np.memmap(os.path.join(path, "keys.bin"), dtype='uint8', mode='r+', shape=(capacity, 32))
+        self.stamps = np.memmap(os.path.join(path, "stamps.bin"), dtype='uint64', mode='r+', shape=(capacity,))
+        self.changes = np.memmap(changes_path, dtype='uint32', mode='r+', shape=(capacity,))
+        self.state = np.memmap(os.path.join(path, "state.bin"), dtype='uint64', mode='r+', shape=(1,))
+        self.slots: Dict[bytes, int] = {}
+        self.slot_keys: Dict[int, bytes] = {}
+        self.free: Set[int] = set()
+        self.generation = None
+        self.touched: Dict[int, bytes] = {}
+        self.touched_at = time.monotonic()
+        self.pending: List[int] = []
+        self.refresh()
+
+    @classmethod
+    def create(cls, path: str, dimension: int, capacity: int) -> "_Namespace":
+        """建立新的命名空間檔案 (稀疏檔,不預先佔用磁碟)"""
+        os.makedirs(path, exist_ok=True)
+        for name, size in (("vectors.f32", capacity * dimension * 4), ("keys.bin", capacity * 32),
+                           ("stamps.bin", capacity * 8), ("changes.bin", capacity * 4), ("state.bin", 8)):
+            with open(os.path.join(path, name), "wb") as f:
+                f.truncate(size)
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"dimension": dimension, "capacity": capacity}, f)
+        return cls(path, dimension, capacity)
+
+    def refresh(self):
+        """套用其他行程的變更到 digest -> 列號 的雜湊索引"""
+        generation = int(self.state[0])
+        if generation == self.generation:
+            return
+        if self.generation is not None and generation - self.generation <= self.capacity:
+            slots = self.changes[np.arange(self.generation, generation) % self.capacity]
+            # 讀取期間寫入端可能已繞過一圈覆寫了這段紀錄,此時改為全部重建
+            if int(self.state[0]) - self.generation <= self.capacity:
+                for slot in set(slots.tolist()):
+                    self._reload_slot(slot)
+                self.generation = generation
+                return
+            generation = int(self.state[0])
+        self._rebuild()
+        self.generation = generation
+
+    def _rebuild(self):
+        used = np.flatnonzero(self.keys.any(axis=1))
+        self.slot_keys = {slot: bytes(self.keys[slot]) for slot in used.tolist()}
+        self.slots = {key: slot for slot, key in self.slot_keys.items()}
+        used_mask = np.zeros(self.capacity, dtype=bool)
+        used_mask[used] = True
+        self.free = set(np.flatnonzero(~used_mask).tolist())
+
+    def _reload_slot(self, slot: int):
+        old = self.slot_keys.pop(slot, None)
+        if old is not None and self.slots.get(old) == slot:
+            del self.slots[old]
+        key = bytes(self.keys[slot])
+        if key == _EMPTY_KEY:
+            self.free.add(slot)
+        else:
+            self.free.discard(slot)
+            self.slot_keys[slot] = key
+            self.slots[key] = slot
+
+    def lookup(self, digest: bytes) -> Optional[np.ndarray]:
+        slot = self.slots.get(digest)
+        if slot is None:
+            return None
+        # 雜湊索引可能已過時 (其他行程淘汰並重用了該列): 複製前後都須確認 key 相符
+        if bytes(self.keys[slot]) != digest:
+            return None
+        vector = np.array(self.vectors[slot])
+        if bytes(self.keys[slot]) != digest:
+            return None
+        self.touched[slot] = digest
+        return vector
+
+    def touch_due(self) -> bool:
+        return bool(self.touched) and (len(self.touched) >= _TOUCH_FLUSH_MAX or
+                                       time.monotonic() - self.touched_at >= _TOUCH_FLUSH_INTERVAL)
+
+    def apply_touches(self):
+        """將命中紀錄寫回 stamps.bin (須持有檔案鎖);期間被淘汰或重用的列略過"""
+        now = time.time_ns()
+        for slot, digest in self.touched.items():
+            if bytes(self.keys[slot]) == digest:
+                self.stamps[slot] = now
+        self.touched = {}
+        self.touched_at = time.monotonic()
+
+    def store(self, digest: bytes, vector: np.ndarray):
+        """寫入一列 (須持有檔案鎖,結束後呼叫 publish)"""
+        if digest in self.slots:
+            return
+        if not self.free:
+            self._evict()
+        slot = self.free.pop()
+        # 先讓該列失效,向量寫完才發布 key,讀取端不會拿到新舊混合的向量
+        self.keys[slot] = 0
+        self.vectors[slot] = vector
+        self.stamps[slot] = time.time_ns()
+        self.keys[slot] = np.frombuffer(digest, dtype='uint8')
+        self.slots[digest] = slot
+        self.slot_keys[slot] = digest
+        self.pending.append(slot)
+
+    def _evict(self):
+        """淘汰最久未使用的列"""
+        count = max(1, int(self.capacity * _EVICT_RATIO))
+        victims = np.argpartition(self.stamps, count - 1)[:count]
+        for slot in victims.tolist():
+            self.slots.pop(self.slot_keys.pop(slot, None), None)
+            self.stamps[slot] = 0
+            self.keys[slot] = 0
+            self.free.add(slot)
+            self.pending.append(slot)
+
+    def publish(self):
+        """寫入變更紀錄後遞增 generation,其他行程據此只更新變更過的列"""
+        generation = int(self.state[0])
+        # 同一批次內多次變更的列只需記錄一次 (因此一批最多 capacity 筆)
+        slots = np.array(list(dict.fromkeys(self.pending)), dtype='uint32')
+        self.changes[np.arange(generation, generation + len(slots)) % self.capacity] = slots
+        self.state[0] = generation + len(slots)
+        self.generation = int(self.state[0])
+        self.pending = []
+
+
+class EmbeddingCache:
+    """
+    持久化 Embedding 快取
+
+    每個 (provider, model, dimension) 命名空間以固定容量的 mmap 矩陣儲存,
+    容量由 max_bytes 決定,滿時以 LRU 方式淘汰。
+    """
+
+    def __init__(self, cache_path: str, max_bytes: int):
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self._namespaces: Dict[str, _Namespace] = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_path, exist_ok=True)
+
+    @staticmethod
+    def digest(text: str) -> bytes:
+        return hashlib.sha256(text.encode('utf-8')).digest()
+
+    def _namespace_dir(self, provider: str, model: str, dimension: Optional[int]) -> str:
+        name = f"{provider}__{model}__{dimension or 'native'}"
+        return os.path.join(self.cache_path, re.sub(r'[^A-Za-z0-9_.-]', '_', name))
+
+    def _open(self, provider: str, model: str, dimension: Optional[int],
+              vector_dim: Optional[int] = None) -> Optional[_Namespace]:
+        """開啟命名空間;不存在且提供 vector_dim 時建立"""
+        path = self._namespace_dir(provider, model, dimension)
+        ns = self._namespaces.get(path)
+        if ns is not None:
+            return ns
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            ns = _Namespace(path, meta["dimension"], meta["capacity"])
+        elif vector_dim:
+            capacity = max(1, self.max_bytes // (vector_dim * 4 + _ROW_OVERHEAD))
+            ns = _Namespace.create(path, vector_dim, capacity)
+        else:
+            return None
+        self._namespaces[path] = ns
+        return ns
+
+    @staticmethod
+    @contextmanager
+    def _file_lock(ns: _Namespace, blocking: bool = True):
+        """跨行程的命名空間檔案鎖;blocking=False 時鎖被佔用則 yield False"""
+        with open(os.path.join(ns.path, "lock"), "a") as lock_file:
+            if fcntl:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    yield False
+                    return
+            try:
+                yield True
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get_many(self, provider: str, model: str, dimension: Optional[int],
+                 texts: List[str]) -> List[Optional[np.ndarray]]:
+        """查詢多筆文字的快取向量,未命中的位置為 None"""
+        with self._lock:
+            try:
+                ns = self._open(provider, model, dimension)
+                if ns is None:
+                    return [None] * len(texts)
+                ns.refresh()
+                vectors = [ns.lookup(self.digest(t)) for t in texts]
+                if ns.touch_due():
+                    # 寫回使用時間不阻塞查詢: 鎖被寫入端佔用時留到下次
+                    with self._file_lock(ns, blocking=len(ns.touched) >= 4 * _TOUCH_FLUSH_MAX) as locked:
+                        if locked:
+                            ns.apply_touches()
+                return vectors
+            except Exception as e:
+                print(f"[RAG] Embedding 快取讀取失敗: {str(e)}")
+                return [None] * len(texts)
+
+    def put_many(self, provider: str, model: str, dimension: Optional[int],
+                 texts: List[str], vectors: np.ndarray):
+        """寫入多筆向量 (跨行程以檔案鎖保護)"""
+        if not texts:
+            return
+        with self._lock:
+            try:
+                ns = self._open(provider, model, dimension, vector_dim=vectors.shape[1])
+                if ns.dimension != vectors.shape[1]:
+                    return
+                with self._file_lock(ns):
+                    ns.refresh()
+                    ns.apply_touches()
+                    for text, vector in zip(texts, vectors):
+                        ns.store(self.digest(text), vector)
+                    ns.publish()
+            except Exception as e:
+                print(f"[RAG] Embedding 快取寫入失敗: {str(e)}")
@@ -0,0 +1,71 @@
+"""
+索引快取服務 - 以記憶體預算管理已載入的知識庫索引
+超過預算時淘汰最久未使用 (LRU) 的知識庫
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+class IndexCache:
+    """已載入索引的 LRU 快取"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._sizes: Dict[int, int] = {}
+        self._total_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, kb_id: int) -> Optional[Dict[str, Any]]:
+        """取得快取的索引,並標記為最近使用"""
+        with self._lock:
+            entry = self._entries.get(kb_id)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(kb_id)
+            self._hits += 1
+            return entry
+
+    def put(self, kb_id: int, entry: Dict[str, Any], size: int):
+        """
+        放入索引並淘汰超出預算的舊索引
+
+        剛放入的索引即使單獨超過預算也會保留,避免同一請求內重複載入
+        """
+        with self._lock:
+            self._discard(kb_id)
+            self._entries[kb_id] = entry
+            self._sizes[kb_id] = size
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+                self._evictions += 1
+                print(f"[RAG] 索引快取超出預算,淘汰知識庫 {oldest}")
+
+    def pop(self, kb_id: int):
+        """移除指定知識庫的快取 (索引更新後呼叫)"""
+        with self._lock:
+            self._discard(kb_id)
+
+    def _discard(self, kb_id: int):
+        if kb_id in self._entries:
+            del self._entries[kb_id]
+            self._total_bytes -= self._sizes.pop(kb_id)
+
+    def stats(self) -> Dict[str, Any]:
+        """快取統計資訊"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "total_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions
+            }
@@ -0,0 +1,354 @@
+"""
+知識庫背景處理服務 - 將檔案抽取、切分、Embedding 與索引建立移出 HTTP 請求
+工作狀態持久化於 ingest_jobs 表,由行程內的工作執行緒池依序處理
+"""
+import os
+import json
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Dict, List, Optional
+
+import pymysql
+
+from services.rag_service import rag_service, IndexRebuildRequired
+from services.db_pool import get_connection
+
+# 同時處理的工作數 (同一知識庫的工作仍會依序寫入索引)
+RAG_INGEST_WORKERS = int(os.getenv('RAG_INGEST_WORKERS', '2'))
+# 每個工作同時提取與切分的檔案數 (PDF 頁面的解析行程數另由 RAG_EXTRACT_WORKERS 設定)
+RAG_INGEST_FILE_CONCURRENCY = int(os.getenv('RAG_INGEST_FILE_CONCURRENCY', '4'))
+
+
+def get_db_connection():
+    return get_connection(pymysql.cursors.DictCursor)
+
+
+class IngestQueue:
+    """
+    知識庫處理工作佇列
+
+    工作流程: queued -> running -> completed / failed
+    每個檔案處理時即時更新 files.status 與工作進度,前端以 GET /api/rag/jobs/<id> 輪詢
+    """
+
+    def __init__(self, max_workers: int = RAG_INGEST_WORKERS):
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        啟動工作執行緒池,並接續上次服務停止時未完成的工作
+
+        處理可重複執行 (增量更新會先移除檔案舊向量),因此中斷的工作直接重新排入佇列
+        """
+        with self._lock:
+            if self._executor is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="rag-ingest")
+
+        try:
+            conn = get_db_connection()
+            with conn.cursor() as cursor:
+                cursor.execute("UPDATE ingest_jobs SET status = 'queued', stage = NULL WHERE status = 'running'")
+                cursor.execute("SELECT id FROM ingest_jobs WHERE status = 'queued' ORDER BY id")
+                pending = [row['id'] for row in cursor.fetchall()]
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print(f"[RAG] 讀取未完成的背景工作失敗: {str(e)}")
+            return
+
+        if pending:
+            print(f"[RAG] 接續 {len(pending)} 個未完成的背景工作")
+        for job_id in pending:
+            self._executor.submit(self._run, job_id)
+
+    def submit(self, kb_id: int, file_ids: List[int], rebuild: bool = False) -> int:
+        """建立工作並排入佇列,回傳 job id"""
+        self.start()
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO ingest_jobs (kb_id, file_ids, rebuild, total_files) VALUES (%s, %s, %s, %s)",
+                    (kb_id, json.dumps(file_ids), rebuild, len(file_ids))
+                )
+                job_id = cursor.lastrowid
+                cursor.execute("UPDATE files SET status = 'pending', error_message = NULL WHERE id IN %s",
+                               (tuple(file_ids),))
+            conn.commit()
+        finally:
+            conn.close()
+
+        self._executor.submit(self._run, job_id)
+        print(f"[RAG] 背景工作 {job_id} 已排入佇列 (知識庫 {kb_id},{len(file_ids)} 個檔案)")
+        return job_id
+
+    def submit_removal(self, kb_id: int, file_ids: List[int]) -> int:
+        """
+        建立移除工作: 將已刪除檔案的向量與 chunks 移出知識庫索引,回傳 job id
+
+        呼叫前檔案記錄應已刪除並提交;移除可能需要為補位的重複段落計算 Embedding,
+        因此與新增檔案相同,交給背景工作處理
+        """
+        self.start()
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO ingest_jobs (kb_id, file_ids, mode, total_files) VALUES (%s, %s, 'remove', %s)",
+                    (kb_id, json.dumps(file_ids), len(file_ids))
+                )
+                job_id = cursor.lastrowid
+            conn.commit()
+        finally:
+            conn.close()
+
+        self._executor.submit(self._run, job_id)
+        print(f"[RAG] 移除工作 {job_id} 已排入佇列 (知識庫 {kb_id},{len(file_ids)} 個檔案)")
+        return job_id
+
+    def get_job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """取得工作狀態與各檔案的處理狀態"""
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT * FROM ingest_jobs WHERE id = %s", (job_id,))
+                job = cursor.fetchone()
+                if not job:
+                    return None
+                job = self._decode(job)
+                job['files'] = []
+                if job['file_ids']:
+                    cursor.execute("SELECT id, name, status, error_message FROM files WHERE id IN %s",
+                                   (tuple(job['file_ids']),))
+                    job['files'] = cursor.fetchall()
+            return job
+        finally:
+            conn.close()
+
+    def list_jobs(self, kb_id: int, limit: int = 20) -> List[Dict[str, Any]]:
+        """列出知識庫最近的工作"""
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT * FROM ingest_jobs WHERE kb_id = %s ORDER BY id DESC LIMIT %s",
+                               (kb_id, limit))
+                return [self._decode(job) for job in cursor.fetchall()]
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _decode(job: Dict[str, Any]) -> Dict[str, Any]:
+        for key in ('file_ids', 'result'):
+            if isinstance(job.get(key), str):
+                job[key] = json.loads(job[key])
+        job['rebuild'] = bool(job.get('rebuild'))
+        return job
+
+    @staticmethod
+    def _execute(*statements) -> int:
+        """
+        以一條短暫取用的連線執行並提交 (sql, args) 語句,回傳最後一句影響的列數
+
+        工作可能執行數分鐘 (抽取、Embedding),只在寫入狀態時取用連線,不長期佔用連線池
+        """
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                affected = 0
+                for sql, args in statements:
+                    affected = cursor.execute(sql, args)
+            conn.commit()
+            return affected
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _fetchall(sql: str, args=None) -> List[Dict[str, Any]]:
+        """以短暫取用的連線查詢"""
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, args)
+                return cursor.fetchall()
+        finally:
+            conn.close()
+
+    def _run(self, job_id: int):
+        """工作執行緒進入點: 認領工作並處理,任何例外都記錄為工作失敗"""
+        try:
+            # 以條件更新認領,避免同一工作被重複執行
+            claimed = self._execute((
+                "UPDATE ingest_jobs SET status = 'running', started_at = NOW() WHERE id = %s AND status = 'queued'",
+                (job_id,)
+            ))
+            if not claimed:
+                return
+            job = self._decode(self._fetchall("SELECT * FROM ingest_jobs WHERE id = %s", (job_id,))[0])
+
+            if job.get('mode') == 'remove':
+                self._remove(job)
+            else:
+                self._process(job)
+        except Exception as e:
+            print(f"[RAG] 背景工作 {job_id} 失敗: {str(e)}")
+            traceback.print_exc()
+            try:
+                self._execute(
+                    ("UPDATE ingest_jobs SET status = 'failed', error_message = %s, finished_at = NOW() WHERE id = %s",
+                     (str(e), job_id)),
+                    # 尚未完成的檔案一併標記為失敗
+                    ("UPDATE files f JOIN ingest_jobs j ON JSON_CONTAINS(j.file_ids, CAST(f.id AS JSON)) "
+                     "SET f.status = 'failed', f.error_message = %s "
+                     "WHERE j.id = %s AND f.status IN ('pending', 'processing')",
+                     (str(e), job_id))
+                )
+            except Exception as ex:
+                print(f"[RAG] 更新工作狀態失敗: {str(ex)}")
+
+    def _remove(self, job: Dict[str, Any]):
+        """
+        從索引移除已刪除的檔案
+
+        舊版格式的索引無法就地移除時,以知識庫剩餘的檔案整體重建 (沒有剩餘檔案則刪除索引)
+        """
+        job_id, kb_id, file_ids = job['id'], job['kb_id'], job['file_ids']
+        self._execute(("UPDATE ingest_jobs SET stage = 'indexing' WHERE id = %s", (job_id,)))
+        try:
+            rag_service.remove_files_from_index(kb_id, file_ids)
+        except IndexRebuildRequired:
+            if self._fetchall("SELECT file_id FROM kb_files WHERE kb_id = %s LIMIT 1", (kb_id,)):
+                print(f"[RAG] 移除工作 {job_id} 的索引無法就地移除,改以剩餘檔案整體重建")
+                return self._process(dict(job, file_ids=[], rebuild=True))
+            print(f"[RAG] 移除工作 {job_id}: 知識庫 {kb_id} 已沒有檔案,刪除索引")
+            rag_service.delete_kb_index(kb_id)
+        self._execute((
+            "UPDATE ingest_jobs SET status = 'completed', stage = NULL, processed_files = %s, "
+            "finished_at = NOW() WHERE id = %s",
+            (len(file_ids), job_id)
+        ))
+        print(f"[RAG] 移除工作 {job_id} 完成 (知識庫 {kb_id},{len(file_ids)} 個檔案)")
+
+    def _process(self, job: Dict[str, Any]):
+        """抽取、切分並建立/更新索引 (原 /process 請求內的同步流程)"""
+        job_id, kb_id = job['id'], job['kb_id']
+        file_ids = job['file_ids']
+
+        kb_config = rag_service.get_kb_config(kb_id)
+        chunk_strategy = kb_config.get('chunk_strategy', 'character')
+        chunk_size = kb_config.get('chunk_size', 500)
+        chunk_overlap = kb_config.get('chunk_overlap', 50)
+
+        print(f"[RAG] 背景工作 {job_id} 開始 - 策略: {chunk_strategy}, 大小: {chunk_size}, 重疊: {chunk_overlap}")
+
+        file_chunks = {}
+        # 無法增量更新時,改為重新處理整個知識庫,避免遺失先前的檔案
+        full_rebuild = job['rebuild'] or not rag_service.is_index_compatible(kb_id, kb_config)
+        if full_rebuild:
+            rows = self._fetchall("SELECT file_id FROM kb_files WHERE kb_id = %s", (kb_id,))
+            file_ids = sorted({row['file_id'] for row in rows} | set(file_ids))
+            print(f"[RAG] 整體重建索引,共 {len(file_ids)} 個檔案")
+
+        self._execute((
+            "UPDATE ingest_jobs SET stage = 'extracting', mode = %s, file_ids = %s, total_files = %s WHERE id = %s",
+            ("rebuild" if full_rebuild else "incremental", json.dumps(file_ids), len(file_ids), job_id)
+        ))
+
+        files = self._fetchall("SELECT id, file_path, name FROM files WHERE id IN %s", (tuple(file_ids),))
+
+        # 多個檔案同時提取與切分 (PDF 頁面再交給共用行程池解析);資料庫只在本執行緒更新
+        processed = failed = 0
+        pending_files = iter(files)
+        in_flight = {}
+        concurrency = max(1, min(len(files), RAG_INGEST_FILE_CONCURRENCY))
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            def submit_next():
+                f = next(pending_files, None)
+                if f is None:
+                    return
+                self._execute(("UPDATE files SET status = 'processing' WHERE id = %s", (f['id'],)))
+                print(f"[RAG] 處理檔案: {f['name']}")
+                future = executor.submit(rag_service.chunk_document, f['file_path'],
+                                         chunk_strategy, chunk_size, chunk_overlap)
+                in_flight[future] = f
+
+            for _ in range(concurrency):
+                submit_next()
+
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    f = in_flight.pop(future)
+                    statements = []
+                    try:
+                        chunks = future.result()
+                        print(f"[RAG] {f['name']} 切分完成,產生 {len(chunks)} 個 chunks")
+                        file_chunks[f['id']] = chunks
+                    except Exception as ex:
+                        print(f"[RAG] 處理檔案失敗: {str(ex)}")
+                        failed += 1
+                        statements.append(("UPDATE files SET status = 'failed', error_message = %s WHERE id = %s",
+                                           (str(ex), f['id'])))
+                    processed += 1
+                    statements.append((
+                        "UPDATE ingest_jobs SET processed_files = %s, failed_files = %s, chunks_count = %s "
+                        "WHERE id = %s",
+                        (processed, failed, sum(len(c) for c in file_chunks.values()), job_id)
+                    ))
+                    self._execute(*statements)
+                    submit_next()
+
+        # 建立/更新向量索引
+        chunks_count = sum(len(c) for c in file_chunks.values())
+        index_stats = None
+        statements = []
+        if file_chunks:
+            self._execute(("UPDATE ingest_jobs SET stage = 'indexing' WHERE id = %s", (job_id,)))
+            print(f"[RAG] 開始{'建立' if full_rebuild else '更新'}向量索引,共 {chunks_count} 個 chunks")
+            if full_rebuild:
+                index_stats = rag_service.create_kb_index(kb_id, file_chunks, kb_config)
+            else:
+                try:
+                    index_stats = rag_service.update_kb_index(kb_id, file_chunks, kb_config)
+                except IndexRebuildRequired:
+                    # 抽取期間配置被修改或其他工作重建了索引: 改以知識庫所有檔案重新處理
+                    print(f"[RAG] 背景工作 {job_id} 的索引已不相容,改為整體重建")
+                    return self._process(dict(job, rebuild=True))
+            print("[RAG] 向量索引更新完成")
+
+            # 索引寫入後檔案才可被檢索
+            statements.append(("UPDATE files SET status = 'completed' WHERE id IN %s",
+                               (tuple(file_chunks.keys()),)))
+
+            # 同步檔案標籤快照 (儲存目錄重建後仍可依標籤過濾)
+            try:
+                rag_service.refresh_file_tags(kb_id)
+            except Exception as e:
+                print(f"[RAG] 同步檔案標籤失敗: {str(e)}")
+
+        result = {
+            "chunks_count": chunks_count,
+            "mode": "rebuild" if full_rebuild else "incremental",
+            "index_stats": index_stats,
+            "config": {
+                "strategy": chunk_strategy,
+                "chunk_size": chunk_size,
+                "chunk_overlap": chunk_overlap
+            }
+        }
+        # 沒有任何檔案處理成功時視為失敗 (部分失敗仍為完成,失敗數記錄在 failed_files)
+        status = 'failed' if files and failed == len(files) else 'completed'
+        statements.append((
+            "UPDATE ingest_jobs SET status = %s, stage = NULL, result = %s, error_message = %s, "
+            "finished_at = NOW() WHERE id = %s",
+            (status, json.dumps(result), "所有檔案處理失敗" if status == 'failed' else None, job_id)
+        ))
+        self._execute(*statements)
+        print(f"[RAG] 背景工作 {job_id} {'失敗' if status == 'failed' else '完成'}")
+
+
+# 建立全域實例
+ingest_queue = IngestQueue()
@@ -0,0 +1,315 @@
+"""
+關鍵字索引服務 - 每個知識庫一份持久化的倒排索引,提供 BM25 檢索
+中文 (CJK) 以字元 bigram 切詞,英數字串 (產品代碼、型號) 保留為完整詞彙
+"""
+import os
+import re
+import json
+import mmap
+import bisect
+import unicodedata
+from collections import Counter
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# 英數詞彙 (可含 - _ . 連接,例如 gpt-4o、A1-203) 或連續的 CJK 字元
+_TOKEN_RE = re.compile(
+    r'[a-z0-9]+(?:[-_.][a-z0-9]+)*'
+    r'|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+'
+)
+_SUBWORD_RE = re.compile(r'[-_.]')
+# 過長的英數詞彙只保留前綴
+MAX_TERM_CHARS = 64
+
+LEXICAL_FORMAT_VERSION = 1
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    切詞 (建索引與查詢共用)
+
+    NFKC 正規化 (全形轉半形) 並轉小寫;CJK 連續字元輸出相鄰兩字的 bigram,單獨一字則輸出該字;
+    含連接符號的英數詞彙同時輸出各段,讓「A1-203」也能以「203」查到
+    """
+    text = unicodedata.normalize('NFKC', text).lower()
+    tokens = []
+    for match in _TOKEN_RE.finditer(text):
+        token = match.group()
+        if token[0] >= '\u3040':
+            if len(token) == 1:
+                tokens.append(token)
+            else:
+                tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+        else:
+            tokens.append(token[:MAX_TERM_CHARS])
+            if _SUBWORD_RE.search(token):
+                tokens.extend(part for part in _SUBWORD_RE.split(token) if part)
+    return tokens
+
+
+class _SortedTerms(Sequence):
+    """以 UTF-8 blob + 位移陣列儲存的已排序詞彙表,可直接以 bisect 二分搜尋"""
+
+    def __init__(self, blob, offsets: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i) -> bytes:
+        return bytes(self.blob[int(self.offsets[i]):int(self.offsets[i + 1])])
+
+    def find(self, term: bytes) -> int:
+        i = bisect.bisect_left(self, term)
+        return i if i < len(self) and self[i] == term else -1
+
+
+class LexicalIndex:
+    """
+    BM25 倒排索引 (唯讀,以 mmap 開啟)
+
+    目錄配置:
+        terms.blob / terms.offsets.npy - 已排序的詞彙表
+        indptr.npy                     - 詞彙 i 的 postings 位於 [indptr[i], indptr[i+1])
+        postings.npy / tf.npy          - 每筆 posting 的 chunk ID 與詞頻
+        docs.npy / doc_len.npy         - 已排序的 chunk ID 與其詞彙數
+        meta.json                      - 文件數與平均長度
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.doc_count = meta["doc_count"]
+        self.avg_doc_len = meta["avg_doc_len"] or 1.0
+
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode='r')
+        self._blob_file = open(os.path.join(path, "terms.blob"), "rb")
+        blob = (mmap.mmap(self._blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+                if os.fstat(self._blob_file.fileno()).st_size else b"")
+        self.terms = _SortedTerms(blob, load("terms.offsets.npy"))
+        self.indptr = load("indptr.npy")
+        self.postings = load("postings.npy")
+        self.tf = load("tf.npy")
+        self.docs = load("docs.npy")
+        self.doc_len = load("doc_len.npy")
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, "meta.json"))
+
+    @staticmethod
+    def remove(path: str):
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                os.remove(os.path.join(path, name))
+            os.rmdir(path)
+
+    @property
+    def nbytes(self) -> int:
+        """常駐記憶體估算 (postings 以 mmap 讀取,只計文件陣列)"""
+        return self.docs.nbytes + self.doc_len.nbytes
+
+    def search(self, query_terms: Iterable[str], k: int, k1: float = 1.2, b: float = 0.75,
+               allowed: Optional[np.ndarray] = None) -> List[Tuple[int, float, int]]:
+        """
+        BM25 檢索
+
+        allowed 為已排序的候選 chunk ID (metadata 過濾),不在其中的 postings 在計分前即略過
+
+        Returns:
+            [(chunk_id, 分數, 命中的查詢詞彙數), ...] 依分數由高到低
+        """
+        ids, scores = [], []
+        for term in set(query_terms):
+            t = self.terms.find(term.encode('utf-8'))
+            if t < 0:
+                continue
+            lo, hi = int(self.indptr[t]), int(self.indptr[t + 1])
+            if lo == hi:
+                continue
+            chunk_ids = np.asarray(self.postings[lo:hi])
+            tf = np.asarray(self.tf[lo:hi], dtype=np.float32)
+            if allowed is not None:
+                keep = self._member(chunk_ids, allowed)
+                chunk_ids, tf = chunk_ids[keep], tf[keep]
+                if not len(chunk_ids):
+                    continue
+            dl = np.asarray(self.doc_len[np.searchsorted(self.docs, chunk_ids)], dtype=np.float32)
+            idf = np.log(1.0 + (self.doc_count - (hi - lo) + 0.5) / ((hi - lo) + 0.5))
+            ids.append(chunk_ids)
+            scores.append(idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / self.avg_doc_len)))
+        if not ids:
+            return []
+
+        unique_ids, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(scores))
+        matched = np.bincount(inverse)
+        k = min(k, len(unique_ids))
+        top = np.argpartition(-totals, k - 1)[:k]
+        top = top[np.argsort(-totals[top], kind='stable')]
+        return [(int(unique_ids[i]), float(totals[i]), int(matched[i])) for i in top]
+
+    @staticmethod
+    def _member(values: np.ndarray, sorted_ids: np.ndarray) -> np.ndarray:
+        """values 中出現在已排序陣列 sorted_ids 的元素"""
+        if not len(sorted_ids):
+            return np.zeros(len(values), dtype=bool)
+        positions = np.minimum(np.searchsorted(sorted_ids, values), len(sorted_ids) - 1)
+        return sorted_ids[positions] == values
+
+    @classmethod
+    def build(cls, path: str, chunk_ids: Sequence[int], texts: Sequence[str],
+              base: Optional["LexicalIndex"] = None,
+              drop_ranges: Sequence[Tuple[int, int]] = ()) -> "LexicalIndex":
+        """
+        建立索引並寫入 path
+
+        提供 base 時以其內容為基礎: 先移除 chunk ID 落在 drop_ranges ([lo, hi)) 的文件,
+        再把新 chunks 的 postings 合併進去 (見 _merge),只需切詞新增的文字
+        """
+        vocab, term_ids, post_ids, post_tf, docs, doc_len = cls._collect(chunk_ids, texts)
+        if base is not None:
+            blob, lengths, indptr, post_ids, post_tf, docs, doc_len = cls._merge(
+                base, drop_ranges, vocab, term_ids, post_ids, post_tf, docs, doc_len)
+        else:
+            blob = b"".join(vocab)
+            lengths = np.array([len(t) for t in vocab], dtype=np.int64)
+            order = np.lexsort((post_ids, term_ids))
+            counts = np.bincount(term_ids, minlength=len(vocab))
+            indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+            post_ids, post_tf = post_ids[order], post_tf[order]
+            doc_order = np.argsort(docs, kind='stable')
+            docs, doc_len = docs[doc_order], doc_len[doc_order]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+        # 寫入暫存目錄後整個換上,查詢不會讀到新舊混合的檔案 (已開啟的舊檔仍可透過 mmap 讀取)
+        tmp_path = path + ".tmp"
+        cls.remove(tmp_path)
+        os.makedirs(tmp_path)
+        cls._write(tmp_path, "terms.blob", blob)
+        for name, array in (("terms.offsets.npy", offsets), ("indptr.npy", indptr),
+                            ("postings.npy", post_ids), ("tf.npy", post_tf),
+                            ("docs.npy", docs), ("doc_len.npy", doc_len)):
+            cls._write(tmp_path, name, array)
+        cls._write(tmp_path, "meta.json", json.dumps({
+            "version": LEXICAL_FORMAT_VERSION,
+            "doc_count": int(len(docs)),
+            "avg_doc_len": float(doc_len.mean()) if len(doc_len) else 0.0,
+            "terms": int(len(lengths))
+        }).encode('utf-8'))
+
+        old_path = path + ".old"
+        cls.remove(old_path)
+        if os.path.isdir(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        cls.remove(old_path)
+        return cls(path)
+
+    @staticmethod
+    def _collect(chunk_ids: Sequence[int], texts: Sequence[str]):
+        """
+        切詞並收集 postings
+
+        Returns:
+            (已排序詞彙表, 各 posting 的詞彙編號, chunk ID, 詞頻, 文件 chunk ID, 文件詞彙數)
+        """
+        local_vocab = {}
+        new_terms, new_docs, new_tf, new_len = [], [], [], []
+        for chunk_id, text in zip(chunk_ids, texts):
+            counts = Counter(tokenize(text))
+            new_len.append(sum(counts.values()))
+            for term, count in counts.items():
+                new_terms.append(local_vocab.setdefault(term.encode('utf-8'), len(local_vocab)))
+                new_docs.append(chunk_id)
+                new_tf.append(count)
+        vocab = sorted(local_vocab)
+        rank = np.empty(len(vocab), dtype=np.int64)
+        rank[[local_vocab[term] for term in vocab]] = np.arange(len(vocab))
+        term_ids = rank[np.array(new_terms, dtype=np.int64)]
+        return (vocab, term_ids, np.array(new_docs, dtype=np.int64), np.array(new_tf, dtype=np.uint32),
+                np.array(list(chunk_ids), dtype=np.int64), np.array(new_len, dtype=np.uint32))
+
+    @classmethod
+    def _merge(cls, base: "LexicalIndex", drop_ranges: Sequence[Tuple[int, int]], vocab: List[bytes],
+               term_ids: np.ndarray, post_ids: np.ndarray, post_tf: np.ndarray,
+               docs: np.ndarray, doc_len: np.ndarray):
+        """
+        把新 chunks 合併進 base (先移除 drop_ranges 的文件)
+
+        只有新 chunks 的詞彙以 bisect 在 base 詞彙表中定位,base 的詞彙與 postings 不經過 Python 迴圈:
+        合併後的位置由 searchsorted 算出,再以陣列操作搬移。同一詞彙的 postings 排在 base 之後
+
+        Returns:
+            (詞彙 blob, 各詞彙位元組長度, indptr, postings, tf, 已排序文件 chunk ID, 文件詞彙數)
+        """
+        base_count = len(base.terms)
+        base_offsets = np.asarray(base.terms.offsets, dtype=np.int64)
+        base_lengths = np.diff(base_offsets)
+
+        # 新詞彙在 base 中的位置;不存在者插入在該位置之前 (vocab 已排序,插入位置不遞減)
+        positions = [bisect.bisect_left(base.terms, term) for term in vocab]
+        found = np.array([pos < base_count and base.terms[pos] == term for term, pos in zip(vocab, positions)],
+                         dtype=bool)
+        positions = np.array(positions, dtype=np.int64)
+        insert_at = positions[~found]
+        base_map = np.arange(base_count) + np.searchsorted(insert_at, np.arange(base_count), side='right')
+        new_map = np.empty(len(vocab), dtype=np.int64)
+        new_map[found] = base_map[positions[found]]
+        new_map[~found] = insert_at + np.arange(len(insert_at))
+        total_terms = base_count + len(insert_at)
+
+        missing = [term for term, hit in zip(vocab, found) if not hit]
+        lengths = np.insert(base_lengths, insert_at, [len(t) for t in missing])
+        blob = np.insert(np.frombuffer(base.terms.blob, dtype=np.uint8),
+                         np.repeat(base_offsets[insert_at], [len(t) for t in missing]),
+                         np.frombuffer(b"".join(missing), dtype=np.uint8))
+
+        # base postings (依詞彙排列) 與新 postings (排序後) 依合併後的詞彙編號穩定合併
+        keep_post = cls._keep_mask(base.postings, drop_ranges)
+        base_terms = base_map[np.repeat(np.arange(base_count), np.diff(base.indptr))][keep_post]
+        new_terms = new_map[term_ids]
+        order = np.lexsort((post_ids, new_terms))
+        new_terms, post_ids, post_tf = new_terms[order], post_ids[order], post_tf[order]
+        base_dest = np.arange(len(base_terms)) + np.searchsorted(new_terms, base_terms, side='left')
+        new_dest = np.arange(len(new_terms)) + np.searchsorted(base_terms, new_terms, side='right')
+        merged_ids = np.empty(len(base_terms) + len(new_terms), dtype=np.int64)
+        merged_tf = np.empty(len(merged_ids), dtype=np.uint32)
+        merged_ids[base_dest] = np.asarray(base.postings)[keep_post]
+        merged_tf[base_dest] = np.asarray(base.tf)[keep_post]
+        merged_ids[new_dest], merged_tf[new_dest] = post_ids, post_tf
+
+        # 丟棄已沒有 posting 的詞彙
+        counts = np.bincount(base_terms, minlength=total_terms) + np.bincount(new_terms, minlength=total_terms)
+        used = counts > 0
+        if not used.all():
+            blob = blob[np.repeat(used, lengths)]
+            lengths, counts = lengths[used], counts[used]
+        indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+        keep_doc = cls._keep_mask(base.docs, drop_ranges)
+        doc_order = np.argsort(docs, kind='stable')
+        docs, doc_len = docs[doc_order], doc_len[doc_order]
+        kept_docs = np.asarray(base.docs)[keep_doc]
+        doc_positions = np.searchsorted(kept_docs, docs)
+        return (blob.tobytes(), lengths, indptr, merged_ids, merged_tf,
+                np.insert(kept_docs, doc_positions, docs),
+                np.insert(np.asarray(base.doc_len)[keep_doc], doc_positions, doc_len))
+
+    @staticmethod
+    def _keep_mask(chunk_ids: np.ndarray, drop_ranges: Sequence[Tuple[int, int]]) -> np.ndarray:
+        keep = np.ones(len(chunk_ids), dtype=bool)
+        for lo, hi in drop_ranges:
+            keep &= ~((chunk_ids >= lo) & (chunk_ids < hi))
+        return keep
+
+    @staticmethod
+    def _write(path: str, name: str, data):
+        with open(os.path.join(path, name), "wb") as f:
+            if isinstance(data, np.ndarray):
+                np.save(f, data)
+            else:
+                f.write(data)
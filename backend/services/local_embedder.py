@@ -0,0 +1,425 @@
+"""
+本地 Embedding 服務 - 由單一行程持有 SentenceTransformer 模型,將並行請求合併成批次推論
+
+各 Flask worker / 背景處理行程透過 Unix socket 連線到同一個模型行程,模型只載入一次;
+短時間窗口內 (LOCAL_EMBEDDING_BATCH_WINDOW_MS) 到達的查詢合併成一次 encode,提高 CPU 吞吐量。
+模型行程不存在時由第一個用戶端自動啟動,也可獨立執行:
+
+    python -m services.local_embedder
+
+socket 與連線金鑰放在只有目前使用者可存取 (0700) 的目錄;沒有 fcntl 的平台 (Windows)、
+目錄權限不安全或模型行程沒有回應時,改在目前行程內載入模型計算
+"""
+import os
+import sys
+import time
+import queue
+import secrets
+import tempfile
+import threading
+import subprocess
+from multiprocessing.connection import Client, Listener
+from typing import Dict, List, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows 開發環境沒有 fcntl,只在行程內載入模型
+    fcntl = None
+
+# 是否使用共用的模型行程 (false 時在目前行程內載入模型,同樣做微批次)
+LOCAL_EMBEDDING_SERVER = os.getenv('LOCAL_EMBEDDING_SERVER', 'true').lower() == 'true'
+# socket、鎖與連線金鑰所在的私有目錄
+LOCAL_EMBEDDING_SOCKET_DIR = os.getenv(
+    'LOCAL_EMBEDDING_SOCKET_DIR',
+    os.path.join(tempfile.gettempdir(), f"mcp_local_embedder-{os.getuid() if hasattr(os, 'getuid') else 0}"))
+# 連線金鑰 (未設定時自動產生並存放在私有目錄,僅同一使用者的行程可讀取)
+LOCAL_EMBEDDING_AUTHKEY = os.getenv('LOCAL_EMBEDDING_AUTHKEY', '')
+# 等待模型行程回應的秒數,逾時改在目前行程內計算
+LOCAL_EMBEDDING_TIMEOUT = float(os.getenv('LOCAL_EMBEDDING_TIMEOUT', '120'))
+# 模型行程沒有收到請求超過此秒數即結束 (0 表示不結束)
+LOCAL_EMBEDDING_IDLE_EXIT = float(os.getenv('LOCAL_EMBEDDING_IDLE_EXIT', '900'))
+# 微批次: 收集請求的等待時間 (毫秒) 與每批文字數上限
+LOCAL_EMBEDDING_BATCH_WINDOW_MS = float(os.getenv('LOCAL_EMBEDDING_BATCH_WINDOW_MS', '5'))
+LOCAL_EMBEDDING_MAX_BATCH = int(os.getenv('LOCAL_EMBEDDING_MAX_BATCH', '64'))
+# torch 運算執行緒數 (0 表示使用 torch 預設值)
+LOCAL_EMBEDDING_THREADS = int(os.getenv('LOCAL_EMBEDDING_THREADS', '0'))
+LOCAL_EMBEDDING_INTEROP_THREADS = int(os.getenv('LOCAL_EMBEDDING_INTEROP_THREADS', '0'))
+
+# 模型行程啟動後等待 socket 可連線的秒數
+SERVER_START_TIMEOUT = 30
+# 模型行程無法使用後,暫停嘗試連線的秒數
+SERVER_RETRY_AFTER = 60
+
+# 未指定具體模型時使用的多語言模型
+DEFAULT_LOCAL_MODEL = "paraphrase-multilingual-MiniLM-L12-v2"
+
+
+def resolve_model_name(model: str) -> str:
+    """使用者沒指定具體模型 (例如只填 local) 時使用預設的多語言模型"""
+    return model if '/' in model or '-' in model else DEFAULT_LOCAL_MODEL
+
+
+def prepare_socket_dir(path: str = LOCAL_EMBEDDING_SOCKET_DIR) -> bool:
+    """建立 0700 的私有目錄;目錄屬於其他使用者或開放給他人時返回 False"""
+    if fcntl is None:
+        return False
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        st = os.lstat(path)
+    except OSError as e:
+        print(f"[RAG] 無法建立本地 Embedding 服務目錄 {path}: {str(e)}")
+        return False
+    if not os.path.isdir(path) or os.path.islink(path) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        print(f"[RAG] 本地 Embedding 服務目錄 {path} 權限不安全 (需為目前使用者擁有且權限 0700),改在行程內計算")
+        return False
+    return True
+
+
+def load_authkey(path: str = LOCAL_EMBEDDING_SOCKET_DIR) -> bytes:
+    """取得連線金鑰: 環境變數優先,否則讀取 (或建立) 私有目錄中的金鑰檔"""
+    if LOCAL_EMBEDDING_AUTHKEY:
+        return LOCAL_EMBEDDING_AUTHKEY.encode('utf-8')
+    key_path = os.path.join(path, "authkey")
+    if not os.path.exists(key_path):
+        # 先寫入暫存檔再以 link 發布,並行建立時只有一個會成功,其他行程讀到完整內容
+        tmp_path = f"{key_path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(secrets.token_hex(32).encode('ascii'))
+        try:
+            os.link(tmp_path, key_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(key_path, "rb") as f:
+        return f.read().strip()
+
+
+class _Request:
+    """等待批次推論結果的單一請求"""
+
+    def __init__(self, model: str, texts: List[str]):
+        self.model = model
+        self.texts = texts
+        self.result: Optional[np.ndarray] = None
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """
+    持有模型並把並行請求合併成批次
+
+    第一個請求到達後最多再等 window 秒,或累積到 max_batch 筆文字就送出;
+    同一批內依模型分組,每組呼叫一次 encode
+    """
+
+    def __init__(self, window: float = LOCAL_EMBEDDING_BATCH_WINDOW_MS / 1000,
+                 max_batch: int = LOCAL_EMBEDDING_MAX_BATCH):
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._models: Dict[str, object] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+
+    def encode(self, texts: List[str], model: str) -> np.ndarray:
+        self._ensure_started()
+        request = _Request(resolve_model_name(model), list(texts))
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="local-embedder", daemon=True)
+                self._thread.start()
+
+    def _load_model(self, model_name: str):
+        model = self._models.get(model_name)
+        if model is None:
+            import torch
+            from sentence_transformers import SentenceTransformer
+            if LOCAL_EMBEDDING_THREADS > 0:
+                torch.set_num_threads(LOCAL_EMBEDDING_THREADS)
+            if LOCAL_EMBEDDING_INTEROP_THREADS > 0:
+                try:
+                    torch.set_num_interop_threads(LOCAL_EMBEDDING_INTEROP_THREADS)
+                except RuntimeError:
+                    # 只能在第一次平行運算前設定
+                    pass
+            print(f"[RAG] 正在載入本地模型: {model_name} (torch 執行緒: {torch.get_num_threads()})")
+            model = self._models[model_name] = SentenceTransformer(model_name)
+        return model
+
+    def _collect(self) -> List[_Request]:
+        batch = [self._queue.get()]
+        size = len(batch[0].texts)
+        deadline = time.monotonic() + self.window
+        while size < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.texts)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            groups: Dict[str, List[_Request]] = {}
+            for request in batch:
+                groups.setdefault(request.model, []).append(request)
+            for model_name, requests in groups.items():
+                try:
+                    model = self._load_model(model_name)
+                    texts = [text for request in requests for text in request.texts]
+                    embeddings = np.asarray(
+                        model.encode(texts, batch_size=self.max_batch, convert_to_numpy=True), dtype='float32')
+                    start = 0
+                    for request in requests:
+                        request.result = embeddings[start:start + len(request.texts)]
+                        start += len(request.texts)
+                except BaseException as e:
+                    for request in requests:
+                        request.error = e
+                finally:
+                    for request in requests:
+                        request.done.set()
+            self.batches += 1
+            self.requests += len(batch)
+
+
+class LocalEmbedder:
+    """
+    本地 Embedding 用戶端
+
+    每個執行緒各自持有一條連線,請求在模型行程端合併批次;
+    連線失敗時自動啟動模型行程並重試,模型行程無法使用或逾時未回應時改在目前行程內計算
+    """
+
+    def __init__(self, socket_dir: str = LOCAL_EMBEDDING_SOCKET_DIR, use_server: bool = LOCAL_EMBEDDING_SERVER):
+        self.socket_dir = socket_dir
+        self.socket_path = os.path.join(socket_dir, "embedder.sock")
+        self.use_server = use_server and fcntl is not None
+        self._authkey: Optional[bytes] = None
+        self._local = threading.local()
+        self._batcher: Optional[MicroBatcher] = None
+        self._spawn_lock = threading.Lock()
+        self._last_spawn = 0.0
+        self._retry_at = 0.0
+
+    def encode(self, texts: List[str], model: str) -> np.ndarray:
+        """產生 Embeddings (n x d, float32)"""
+        if not texts:
+            return np.zeros((0, 0), dtype='float32')
+        if not self.use_server or time.monotonic() < self._retry_at:
+            return self._encode_in_process(texts, model)
+
+        for attempt in range(2):
+            try:
+                conn = self._connection()
+            except RuntimeError as e:
+                return self._fallback(texts, model, str(e))
+            try:
+                conn.send((model, list(texts)))
+                if not conn.poll(LOCAL_EMBEDDING_TIMEOUT):
+                    # 丟棄連線,避免之後讀到這次請求遲到的回應
+                    self._close()
+                    return self._fallback(texts, model, f"模型行程 {LOCAL_EMBEDDING_TIMEOUT:g} 秒未回應")
+                status, payload = conn.recv()
+                break
+            except (EOFError, OSError):
+                # 模型行程重啟或連線中斷,重新連線後再試一次
+                self._close()
+                if attempt:
+                    raise
+        if status == 'ok':
+            return payload
+        error_type, message = payload
+        raise ImportError(message) if error_type == 'ImportError' else RuntimeError(message)
+
+    def _encode_in_process(self, texts: List[str], model: str) -> np.ndarray:
+        if self._batcher is None:
+            with self._spawn_lock:
+                if self._batcher is None:
+                    self._batcher = MicroBatcher()
+        return self._batcher.encode(texts, model)
+
+    def _fallback(self, texts: List[str], model: str, reason: str) -> np.ndarray:
+        """模型行程無法使用: 暫停連線一段時間,這段期間在目前行程內計算"""
+        print(f"[RAG] 本地 Embedding 服務無法使用 ({reason}),{SERVER_RETRY_AFTER} 秒內改在目前行程內計算")
+        self._retry_at = time.monotonic() + SERVER_RETRY_AFTER
+        return self._encode_in_process(texts, model)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _close(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def _connect(self):
+        if self._authkey is None:
+            if not prepare_socket_dir(self.socket_dir):
+                self.use_server = False
+                raise RuntimeError(f"私有目錄無法使用 ({self.socket_dir})")
+            self._authkey = load_authkey(self.socket_dir)
+        try:
+            return Client(self.socket_path, 'AF_UNIX', authkey=self._authkey)
+        except (FileNotFoundError, ConnectionRefusedError):
+            self._spawn_server()
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while True:
+            try:
+                return Client(self.socket_path, 'AF_UNIX', authkey=self._authkey)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"本地 Embedding 服務未能啟動 ({self.socket_path})")
+                time.sleep(0.1)
+
+    def _spawn_server(self):
+        """啟動模型行程 (多個行程同時啟動時只有取得檔案鎖的那個會繼續執行)"""
+        with self._spawn_lock:
+            if time.monotonic() - self._last_spawn < SERVER_START_TIMEOUT:
+                return
+            self._last_spawn = time.monotonic()
+            backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            print(f"[RAG] 啟動本地 Embedding 服務: {self.socket_path}")
+            subprocess.Popen([sys.executable, "-m", "services.local_embedder", "--socket-dir", self.socket_dir,
+                              "--parent-pid", str(os.getpid())], cwd=backend_dir, start_new_session=True)
+
+
+class _Activity:
+    """模型行程的最後請求時間 (供閒置結束判斷)"""
+
+    def __init__(self):
+        self.last = time.monotonic()
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def begin(self):
+        with self.lock:
+            self.active += 1
+
+    def end(self):
+        with self.lock:
+            self.active -= 1
+            self.last = time.monotonic()
+
+    def idle_for(self) -> float:
+        with self.lock:
+            return 0.0 if self.active else time.monotonic() - self.last
+
+
+def _handle(conn, batcher: MicroBatcher, activity: _Activity):
+    """每條連線一個執行緒: 依序接收請求並等待所屬批次完成"""
+    try:
+        while True:
+            model, texts = conn.recv()
+            activity.begin()
+            try:
+                conn.send(('ok', batcher.encode(texts, model)))
+            except Exception as e:
+                error_type = 'ImportError' if isinstance(e, ImportError) else type(e).__name__
+                conn.send(('error', (error_type, str(e))))
+            finally:
+                activity.end()
+    except (EOFError, OSError):
+        pass
+    finally:
+        conn.close()
+
+
+def _parent_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _watchdog(socket_path: str, activity: _Activity, parent_pid: Optional[int]):
+    """啟動者結束或閒置超過 LOCAL_EMBEDDING_IDLE_EXIT 秒時結束模型行程"""
+    while True:
+        time.sleep(5)
+        reason = None
+        if parent_pid and not _parent_alive(parent_pid):
+            reason = f"啟動行程 {parent_pid} 已結束"
+        elif LOCAL_EMBEDDING_IDLE_EXIT > 0 and activity.idle_for() > LOCAL_EMBEDDING_IDLE_EXIT:
+            reason = f"閒置超過 {LOCAL_EMBEDDING_IDLE_EXIT:g} 秒"
+        if reason:
+            print(f"[RAG] 本地 Embedding 服務結束: {reason}")
+            try:
+                os.remove(socket_path)
+            except OSError:
+                pass
+            os._exit(0)
+
+
+def serve(socket_dir: str = LOCAL_EMBEDDING_SOCKET_DIR, parent_pid: Optional[int] = None):
+    """模型行程進入點"""
+    if not prepare_socket_dir(socket_dir):
+        print("[RAG] 本地 Embedding 服務無法在此平台或目錄啟動")
+        return
+    socket_path = os.path.join(socket_dir, "embedder.sock")
+    lock_file = open(os.path.join(socket_dir, "server.lock"), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        # 已有其他模型行程在執行
+        return
+    if os.path.exists(socket_path):
+        # 取得鎖代表先前的行程已結束,socket 檔為殘留
+        os.remove(socket_path)
+
+    batcher = MicroBatcher()
+    activity = _Activity()
+    listener = Listener(socket_path, 'AF_UNIX', authkey=load_authkey(socket_dir))
+    os.chmod(socket_path, 0o600)
+    threading.Thread(target=_watchdog, args=(socket_path, activity, parent_pid), daemon=True).start()
+    print(f"[RAG] 本地 Embedding 服務已啟動 (批次窗口 {LOCAL_EMBEDDING_BATCH_WINDOW_MS}ms, "
+          f"每批上限 {LOCAL_EMBEDDING_MAX_BATCH})")
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as e:
+            # 包含金鑰驗證失敗的連線
+            print(f"[RAG] 本地 Embedding 服務連線失敗: {str(e)}")
+            continue
+        threading.Thread(target=_handle, args=(conn, batcher, activity), daemon=True).start()
+
+
+# 建立全域實例
+local_embedder = LocalEmbedder()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="本地 Embedding 服務")
+    parser.add_argument('--socket-dir', default=LOCAL_EMBEDDING_SOCKET_DIR)
+    parser.add_argument('--parent-pid', type=int, default=None, help="此行程結束時一併結束")
+    args = parser.parse_args()
+    serve(args.socket_dir, args.parent_pid)
@@ -3,8 +3,15 @@ MCP Client Service - 封裝 MCP 連線與工具呼叫邏輯
 透過 HTTP API 與 MCP Server 互動
 """
 import os
+import time
 import requests
-from typing import Dict, List, Any
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, List, Any, Tuple
+
+# 單次工具呼叫的 HTTP 逾時秒數
+MCP_TOOL_TIMEOUT = float(os.getenv('MCP_TOOL_TIMEOUT', '10'))
+# 同一輪多個工具呼叫的並行上限 (每一輪使用自己的執行緒池,不會排在其他請求的呼叫之後)
+MCP_TOOL_CONCURRENCY = int(os.getenv('MCP_TOOL_CONCURRENCY', '4'))
 
 
 class MCPClientService:
@@ -104,7 +111,7 @@ class MCPClientService:
             response = requests.post(
                 f"{self.base_url}/tools/{tool_name}/invoke",
                 json=payload,
-                timeout=10
+                timeout=MCP_TOOL_TIMEOUT
             )
             
             print(f"[MCP Client] HTTP 狀態碼: {response.status_code}")
@@ -131,6 +138,73 @@ class MCPClientService:
                 "tool_name": tool_name
             }
 
+    
+    def invoke_tools(self, calls: List[Tuple[str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """
+        並行呼叫同一輪的多個 MCP 工具
+        
+        Args:
+            calls: [(工具名稱, 工具參數), ...]
+        
+        Returns:
+            工具執行結果,順序與 calls 相同;逾時的呼叫回傳錯誤結果
+        """
+        if len(calls) <= 1:
+            return [self.invoke_tool(name, arguments) for name, arguments in calls]
+        
+        start = time.perf_counter()
+        # HTTP 逾時只涵蓋連線與讀取,另為每個呼叫設定期限;期限從該呼叫實際開始執行時起算,
+        # 排隊等待同一輪前面的呼叫不計入
+        limit = MCP_TOOL_TIMEOUT + 1
+        workers = max(1, min(len(calls), MCP_TOOL_CONCURRENCY))
+        # 前面的呼叫卡住而遲遲無法開始時,最多等到所有批次都用滿期限為止
+        queue_deadline = start + limit * -(-len(calls) // workers)
+        started: Dict[int, float] = {}
+        
+        def run(i: int, name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+            started[i] = time.perf_counter()
+            return self.invoke_tool(name, arguments)
+        
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mcp-tool")
+        try:
+            futures = [executor.submit(run, i, name, arguments) for i, (name, arguments) in enumerate(calls)]
+            results = []
+            for i, ((name, _), future) in enumerate(zip(calls, futures)):
+                try:
+                    while True:
+                        begun = started.get(i)
+                        if begun is None:
+                            remaining = min(limit, queue_deadline - time.perf_counter())
+                        else:
+                            remaining = begun + limit - time.perf_counter()
+                        try:
+                            results.append(future.result(timeout=max(0.0, remaining)))
+                            break
+                        except FutureTimeoutError:
+                            # 仍在排隊,或等待期間才開始執行: 依實際開始時間重新計算
+                            begun, now = started.get(i), time.perf_counter()
+                            if (now < begun + limit) if begun is not None else (now < queue_deadline):
+                                continue
+                            raise
+                except FutureTimeoutError:
+                    print(f"[MCP Client] 工具調用逾時: {name}")
+                    results.append({
+                        "success": False,
+                        "error": f"工具調用逾時 ({MCP_TOOL_TIMEOUT:g} 秒)",
+                        "tool_name": name
+                    })
+                except Exception as e:
+                    results.append({
+                        "success": False,
+                        "error": str(e),
+                        "tool_name": name
+                    })
+        finally:
+            # 逾時的呼叫不等待,其執行緒在 HTTP 逾時後自行結束;尚未開始的呼叫直接取消
+            executor.shutdown(wait=False, cancel_futures=True)
+        print(f"[MCP Client] 並行調用 {len(calls)} 個工具,耗時 {(time.perf_counter() - start) * 1000:.0f}ms")
+        return results
+
 
 # 建立全域 MCP Client 實例
 mcp_client = MCPClientService()
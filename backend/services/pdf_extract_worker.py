@@ -0,0 +1,15 @@
+"""
+PDF 解析行程池的工作模組
+
+行程池的 worker 只會載入本模組 (與 pypdf),不會重新匯入 app.py 與 Flask、faiss、模型等重量級依賴;
+請勿在此匯入其他 services 模組
+"""
+from typing import List
+
+from pypdf import PdfReader
+
+
+def extract_pdf_pages(file_path: str, start: int, end: int) -> List[str]:
+    """解析 [start, end) 頁的文字"""
+    reader = PdfReader(file_path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
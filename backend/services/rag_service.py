@@ -1,243 +1,562 @@
 import os
+import shutil
 import faiss
 import numpy as np
 import pickle
-from typing import List, Dict, Any, Optional
-from pypdf import PdfReader
-from docx import Document
+import itertools
+import functools
+import bisect
+from typing import List, Dict, Any, Optional, Tuple, Union, Iterable, Iterator
 import tiktoken
-from services.ai_client import AIClientFactory
+from services.embedding_cache import EmbeddingCache
+from services.index_cache import IndexCache
+from services.chunk_store import ChunkStore, ChunkRecord, InMemoryChunks
+from services.cache_utils import TTLCache, SingleFlight
+from services.document_reader import iter_document
+from services.lexical_index import LexicalIndex, tokenize
+from services.dedup import DedupIndex
+from services.local_embedder import local_embedder
+from services.db_pool import get_connection, PoolTimeoutError
+from services import chunking
 import pymysql
 import json
+import time
+import random
+import unicodedata
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
 
 logger = logging.getLogger(__name__)
 
+# chunk ID = (file_id << FILE_ID_SHIFT) | 檔案內序號,每個檔案擁有獨立的 ID 區間
+FILE_ID_SHIFT = 32
+# Embedding 批次限制: 每批最多文字數、token 數 (None 表示不計 token) 與並行批次數
+EMBEDDING_CONCURRENCY = int(os.getenv('EMBEDDING_CONCURRENCY', '4'))
+EMBEDDING_BATCH_LIMITS = {
+    'openai': {"max_items": 2048, "max_tokens": int(os.getenv('EMBEDDING_BATCH_MAX_TOKENS', '250000')),
+               "concurrency": EMBEDDING_CONCURRENCY},
+    'google': {"max_items": 100, "max_tokens": int(os.getenv('EMBEDDING_BATCH_MAX_TOKENS', '250000')),
+               "concurrency": EMBEDDING_CONCURRENCY},
+    # 本地模型共用同一個行程內模型,分批但不並行
+    'local': {"max_items": 256, "max_tokens": None, "concurrency": 1},
+}
+EMBEDDING_MAX_RETRIES = int(os.getenv('EMBEDDING_MAX_RETRIES', '5'))
+EMBEDDING_RETRY_BASE_DELAY = 1.0
+
+# 知識庫預設配置
+DEFAULT_KB_CONFIG = {
+    'chunk_strategy': 'character',
+    'chunk_size': 500,
+    'chunk_overlap': 50,
+    'embedding_provider': 'openai',
+    'embedding_model': 'text-embedding-3-small',
+    'embedding_dimension': 1536,
+    'index_type': 'flat',
+    'retrieval_top_k': 3,
+    'similarity_threshold': 0.0
+}
+
+# 知識庫配置快取的最長存活秒數 (正常情況由世代檔失效,此為保險)
+KB_CONFIG_CACHE_TTL = float(os.getenv('KB_CONFIG_CACHE_TTL', '300'))
+
+# 檢索參數預設值 (可由 kb_configs.index_params 覆寫)
+DEFAULT_NPROBE = 10
+DEFAULT_EF_SEARCH = 64
+# 自動調校的候選值 (由低成本到高成本)
+NPROBE_CANDIDATES = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+EF_SEARCH_CANDIDATES = [16, 32, 64, 128, 256, 512]
+
+# 混合檢索 (BM25 + 向量) 參數 (可由 kb_configs.index_params 覆寫)
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60
+# 融合前每一路取 top_k 的幾倍候選
+HYBRID_FETCH_FACTOR = 4
+# 關鍵字第一名分數達第二名幾倍時略過向量檢索
+FAST_PATH_RATIO = 2.0
+
+# MMR 多樣化重排 (index_params.mmr_enabled 開啟): 相關性權重與候選數
+MMR_LAMBDA = 0.7
+MMR_MIN_FETCH_K = 20
+
+# 跨知識庫檢索: 並行執行緒數,以及優先順序每降一位分數乘上的權重
+RAG_SEARCH_WORKERS = int(os.getenv('RAG_SEARCH_WORKERS', '8'))
+RAG_PRIORITY_DECAY = float(os.getenv('RAG_PRIORITY_DECAY', '0.9'))
+
+# 索引版本: 保留的已發布版本數,以及未發布版本目錄視為中斷殘留前的等待秒數
+RAG_INDEX_KEEP_VERSIONS = int(os.getenv('RAG_INDEX_KEEP_VERSIONS', '2'))
+RAG_INDEX_GC_GRACE = float(os.getenv('RAG_INDEX_GC_GRACE', '3600'))
+
+# 近似重複 chunk 合併門檻 (MinHash 估計的 Jaccard 相似度,0 表示停用;可由 index_params.dedup_threshold 覆寫)
+RAG_DEDUP_THRESHOLD = float(os.getenv('RAG_DEDUP_THRESHOLD', '0.9'))
+
+# 批次檢索每次 FAISS search 的查詢數
+SEARCH_BATCH_SIZE = 1024
+
+# metadata 過濾: 候選 chunk 不超過此數時還原向量精確計算距離,超過時以 FAISS ID 選擇器在搜尋中過濾
+# (可由 index_params.filter_exact_max 覆寫)
+FILTER_EXACT_MAX = 2048
+
+# tiktoken 編碼器載入失敗後,多久再重試 (秒)
+ENCODING_RETRY_INTERVAL = 300
+
+# 串流切分時每個視窗累積的字元數
+STREAM_WINDOW_CHARS = 64 * 1024
+
+# IVF-PQ 訓練所需的最少向量數 (8-bit 碼本需 256 個聚類中心)
+PQ_MIN_TRAINING_POINTS = 1024
+
+# metadata 格式版本 (3: chunk ID 定址的索引 + mmap chunk 儲存;4: IVF 索引直接以 chunk ID 加入,不包 IndexIDMap2)
+METADATA_VERSION = 4
+# IVF 類索引: 版本 3 包在 IndexIDMap2 內,移除向量後內層編號與 id_map 錯位,不可增量更新
+IVF_INDEX_TYPES = ('ivf', 'ivf_pq')
+
+# 傳入索引的 chunk: 純文字,或含 text/page/offset 的字典
+ChunkInput = Union[str, Dict[str, Any]]
+
+
+class IndexRebuildRequired(Exception):
+    """索引不存在或與目前配置不相容,無法增量更新"""
+
+
 class RAGService:
     def __init__(self, storage_path: str = "storage/rag"):
         self.storage_path = storage_path
         self.index_path = os.path.join(storage_path, "indices")
         self.files_path = os.path.join(storage_path, "files")
+        self.config_gen_path = os.path.join(storage_path, "config_gen")
         
         # 確保目錄存在
         os.makedirs(self.index_path, exist_ok=True)
         os.makedirs(self.files_path, exist_ok=True)
+        os.makedirs(self.config_gen_path, exist_ok=True)
         
-        # 模型與供應商快取 (懶載入)
-        self._local_model = None
+        # 供應商用戶端快取 (懶載入)
         self._google_api_key = os.getenv('GOOGLE_API_KEY')
         self._openai_client = None
+        self._encoding = None
+        self._encoding_error = None
         
-        # 快取已載入的索引
-        self._indices = {}
-        
-        # 資料庫配置
-        self.db_config = {
-            'host': os.getenv('DB_HOST', 'db'),
-            'port': int(os.getenv('DB_PORT', '3306')),
-            'user': os.getenv('DB_USER', 'mcp_user'),
-            'password': os.getenv('DB_PASSWORD', 'mcp_password'),
-            'database': os.getenv('DB_NAME', 'mcp_platform'),
-            'charset': 'utf8mb4',
-            'cursorclass': pymysql.cursors.DictCursor
-        }
+        # 快取已載入的索引 (依記憶體預算 LRU 淘汰)
+        self._index_cache = IndexCache(int(os.getenv('RAG_INDEX_CACHE_MB', '1024')) * 1024 * 1024)
+        
+        # 查詢 Embedding 快取與請求合併
+        self._query_cache = TTLCache(
+            int(os.getenv('QUERY_EMBEDDING_CACHE_SIZE', '2048')),
+            float(os.getenv('QUERY_EMBEDDING_CACHE_TTL', '3600'))
+        )
+        self._query_flight = SingleFlight()
+        # 每個知識庫一把寫入鎖,避免背景處理與刪除檔案同時改寫同一個索引
+        self._kb_locks: Dict[int, threading.RLock] = {}
+        self._kb_locks_guard = threading.Lock()
+        self._search_pool: Optional[ThreadPoolExecutor] = None
+        # 知識庫配置快取: kb_id -> (世代戳記, 載入時間, 配置)
+        self._config_cache: Dict[int, Tuple[Optional[Tuple[int, int]], float, Dict[str, Any]]] = {}
+        # 檔案標籤快取: kb_id -> (tags.json 戳記, {file_id: [標籤]})
+        self._tags_cache: Dict[int, Tuple[Tuple[int, int], Dict[int, List[str]]]] = {}
+        
+        # 持久化 Embedding 快取 (跨知識庫與重建共用)
+        self.embedding_cache = None
+        if os.getenv('EMBEDDING_CACHE_ENABLED', 'true').lower() == 'true':
+            self.embedding_cache = EmbeddingCache(
+                os.path.join(storage_path, "embedding_cache"),
+                int(os.getenv('EMBEDDING_CACHE_MAX_MB', '512')) * 1024 * 1024
+            )
 
     def get_kb_config(self, kb_id: int) -> Dict[str, Any]:
-        """獲取知識庫配置"""
+        """
+        獲取知識庫配置 (index_params 會解析為字典)
+
+        配置快取在行程內,以 config_gen/kb_{id}.gen 的 stat 結果作為世代戳記;
+        任一 worker 修改配置後更新世代檔 (invalidate_kb_config),其他 worker 下次讀取時即重新查詢
+        """
+        stamp = self._config_stamp(kb_id)
+        cached = self._config_cache.get(kb_id)
+        if cached and cached[0] == stamp and time.monotonic() - cached[1] < KB_CONFIG_CACHE_TTL:
+            return self._copy_config(cached[2])
+
         try:
-            conn = pymysql.connect(**self.db_config)
-            with conn.cursor() as cursor:
-                cursor.execute("""
-                    SELECT * FROM kb_configs WHERE kb_id = %s
-                """, (kb_id,))
-                config = cursor.fetchone()
-            conn.close()
+            conn = get_connection(pymysql.cursors.DictCursor)
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        SELECT * FROM kb_configs WHERE kb_id = %s
+                    """, (kb_id,))
+                    config = cursor.fetchone()
+            finally:
+                conn.close()
             
             if config:
-                return config
+                config['index_params'] = self._parse_index_params(config.get('index_params'))
             else:
                 # 如果沒有配置,返回預設值
-                return {
-                    'chunk_strategy': 'character',
-                    'chunk_size': 500,
-                    'chunk_overlap': 50,
-                    'embedding_provider': 'openai',
-                    'embedding_model': 'text-embedding-3-small',
-                    'embedding_dimension': 1536,
-                    'index_type': 'flat',
-                    'retrieval_top_k': 3,
-                    'similarity_threshold': 0.0
-                }
+                config = dict(DEFAULT_KB_CONFIG, index_params={})
+        except PoolTimeoutError:
+            # 連線池忙碌不代表沒有配置: 交由呼叫端重試,避免以預設值建立或查詢索引
+            raise
         except Exception as e:
             print(f"獲取配置失敗: {str(e)}")
-            # 返回預設配置
-            return {
-                'chunk_strategy': 'character',
-                'chunk_size': 500,
-                'chunk_overlap': 50,
-                'embedding_provider': 'openai',
-                'embedding_model': 'text-embedding-3-small',
-                'embedding_dimension': 1536,
-                'index_type': 'flat',
-                'retrieval_top_k': 3,
-                'similarity_threshold': 0.0
-            }
+            # 返回預設配置 (不快取,資料庫恢復後重新讀取)
+            return dict(DEFAULT_KB_CONFIG, index_params={})
+
+        # 以查詢前取得的戳記快取: 查詢期間若有更新,下次讀取時戳記不符會重新查詢
+        self._config_cache[kb_id] = (stamp, time.monotonic(), config)
+        return self._copy_config(config)
+
+    def invalidate_kb_config(self, kb_id: int):
+        """配置已修改: 更新世代檔讓所有 worker 的快取失效 (須在資料庫寫入提交後呼叫)"""
+        self._config_cache.pop(kb_id, None)
+        path = self._config_gen_file(kb_id)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(str(time.time_ns()))
+            # 新檔案取代舊檔案,inode 與 mtime 皆改變
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"[RAG] 更新配置世代失敗 (KB {kb_id}): {str(e)}")
+
+    def _config_gen_file(self, kb_id: int) -> str:
+        return os.path.join(self.config_gen_path, f"kb_{kb_id}.gen")
+
+    def _config_stamp(self, kb_id: int) -> Optional[Tuple[int, int]]:
+        """世代檔的 (inode, mtime);尚未有任何修改時為 None"""
+        try:
+            st = os.stat(self._config_gen_file(kb_id))
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    @staticmethod
+    def _copy_config(config: Dict[str, Any]) -> Dict[str, Any]:
+        """回傳快取配置的副本,呼叫端修改不影響快取"""
+        return dict(config, index_params=dict(config.get('index_params') or {}))
+
+    @staticmethod
+    def _parse_index_params(value) -> Dict[str, Any]:
+        """kb_configs.index_params (JSON 欄位) -> 字典"""
+        if not value:
+            return {}
+        if isinstance(value, dict):
+            return value
+        try:
+            return json.loads(value) or {}
+        except (TypeError, ValueError):
+            return {}
+
+    def update_index_params(self, kb_id: int, params: Dict[str, Any]):
+        """合併寫入 kb_configs.index_params"""
+        merged = dict(self.get_kb_config(kb_id).get('index_params') or {}, **params)
+        conn = get_connection(pymysql.cursors.DictCursor)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT id FROM kb_configs WHERE kb_id = %s", (kb_id,))
+                if cursor.fetchone():
+                    cursor.execute("UPDATE kb_configs SET index_params = %s WHERE kb_id = %s",
+                                   (json.dumps(merged), kb_id))
+                else:
+                    cursor.execute("INSERT INTO kb_configs (kb_id, index_params) VALUES (%s, %s)",
+                                   (kb_id, json.dumps(merged)))
+            conn.commit()
+        finally:
+            conn.close()
+        self.invalidate_kb_config(kb_id)
 
     def extract_text(self, file_path: str) -> str:
         """從不同格式的文件中提取文字"""
-        ext = os.path.splitext(file_path)[1].lower()
-        text = ""
-        
-        if ext == ".pdf":
-            reader = PdfReader(file_path)
-            for page in reader.pages:
-                text += page.extract_text() + "\n"
-        elif ext == ".docx":
-            doc = Document(file_path)
-            for para in doc.paragraphs:
-                text += para.text + "\n"
-        elif ext in [".txt", ".md"]:
-            with open(file_path, "r", encoding="utf-8") as f:
-                text = f.read()
-        else:
-            raise ValueError(f"不支援的檔案格式: {ext}")
-            
-        return text
+        return "".join(text for _, text in iter_document(file_path))
+
+    def chunk_document(self, file_path: str, strategy: str = 'character',
+                       chunk_size: int = 500, chunk_overlap: int = 50) -> List[Dict[str, Any]]:
+        """以串流方式提取並切分文件,回傳含 text/page/offset 的 chunk 列表"""
+        return list(self.chunk_stream(iter_document(file_path), strategy, chunk_size, chunk_overlap))
+
+    def chunk_stream(self, segments: Iterable[Tuple[int, str]], strategy: str = 'character',
+                     chunk_size: int = 500, chunk_overlap: int = 50) -> Iterator[Dict[str, Any]]:
+        """
+        切分 (頁碼, 文字) 片段串流
+        
+        片段累積到視窗大小後切分,結尾落在視窗末端 (可能被視窗截斷) 的 chunks 從第一個的起點
+        留到下一個視窗重切,因此只需保留一個視窗的文字,不必先組出整份文件;
+        有重疊時末端可能有不只一個 chunk 被截斷。切分結果與 split_text 整份切分一致
+        (遞歸切分需每個視窗內有段落分隔)
+        """
+        window = max(STREAM_WINDOW_CHARS, chunk_size * 64)
+        parts: List[str] = []
+        pages: List[Tuple[int, int]] = []  # (視窗內位置, 頁碼)
+        size = 0
+        base = 0  # 視窗起點在原始文件中的字元位置
+
+        for page, text in segments:
+            if not text:
+                continue
+            pages.append((size, page))
+            parts.append(text)
+            size += len(text)
+            if size < window:
+                continue
+
+            buffer = "".join(parts)
+            restarts = [] if strategy == 'recursive' else None
+            spans = self.split_spans(buffer, strategy, chunk_size, chunk_overlap, restarts)
+            keep_from = next((start for start, end in spans if end >= len(buffer)), len(buffer))
+            if restarts:
+                # 遞歸切分只能從最上層區段的起點重新切分才與整份切分一致;
+                # 整個視窗沒有段落分隔時 (只剩視窗起點) 仍從截斷處重切,避免視窗無限成長
+                restart = restarts[bisect.bisect_right(restarts, keep_from) - 1]
+                if restart > restarts[0]:
+                    keep_from = restart
+            # 沒有可輸出的 chunk 時 (例如沒有句尾的超長段落) 直接全部輸出,避免視窗無限成長
+            if spans and keep_from <= spans[0][0]:
+                keep_from = len(buffer)
+            for start, end in spans:
+                if start >= keep_from:
+                    break
+                yield {"text": self._span_text(buffer, start, end, strategy),
+                       "page": self._page_at(pages, start), "offset": base + start}
+
+            rest = buffer[keep_from:]
+            pages = [(0, self._page_at(pages, keep_from))] + \
+                [(pos - keep_from, pg) for pos, pg in pages if pos > keep_from]
+            parts = [rest] if rest else []
+            size = len(rest)
+            base += keep_from
+
+        if parts:
+            buffer = "".join(parts)
+            for start, end in self.split_spans(buffer, strategy, chunk_size, chunk_overlap):
+                yield {"text": self._span_text(buffer, start, end, strategy),
+                       "page": self._page_at(pages, start), "offset": base + start}
+
+    @staticmethod
+    def _page_at(pages: List[Tuple[int, int]], position: int) -> int:
+        index = bisect.bisect_right(pages, (position, float('inf'))) - 1
+        return pages[max(index, 0)][1]
 
     def split_text(self, text: str, strategy: str = 'character', 
                    chunk_size: int = 500, chunk_overlap: int = 50) -> List[str]:
         """將長文本切分成較小的區塊 (Chunks)"""
-        if strategy == 'character':
-            return self._character_split(text, chunk_size, chunk_overlap)
-        elif strategy == 'token':
-            return self._token_split(text, chunk_size, chunk_overlap)
+        return [self._span_text(text, start, end, strategy)
+                for start, end in self.split_spans(text, strategy, chunk_size, chunk_overlap)]
+
+    @staticmethod
+    def _span_text(text: str, start: int, end: int, strategy: str) -> str:
+        """區間對應的 chunk 文字;語義切分沿用舊版格式 (各句補上 "。"),其餘策略為原文"""
+        if strategy == 'semantic':
+            return chunking.semantic_text(text, start, end)
+        return text[start:end]
+
+    def split_spans(self, text: str, strategy: str = 'character',
+                    chunk_size: int = 500, chunk_overlap: int = 50,
+                    restarts: Optional[List[int]] = None) -> List[Tuple[int, int]]:
+        """
+        切分文本,回傳各 chunk 的 (start, end) 字元區間
+
+        restarts 只用於遞歸切分,見 chunking.recursive_spans
+        """
+        if strategy == 'token':
+            try:
+                return chunking.token_spans(text, self._get_encoding(), chunk_size, chunk_overlap)
+            except Exception as e:
+                print(f"Token 切分失敗,回退到字符切分: {str(e)}")
+                return chunking.character_spans(text, chunk_size * 4, chunk_overlap * 4)
         elif strategy == 'semantic':
-            return self._semantic_split(text, chunk_size)
+            return chunking.semantic_spans(text, chunk_size)
         elif strategy == 'recursive':
-            return self._recursive_split(text, chunk_size, chunk_overlap)
+            return chunking.recursive_spans(text, chunk_size, chunk_overlap, restarts)
         else:
             # 預設使用字符切分
-            return self._character_split(text, chunk_size, chunk_overlap)
-
-    def _character_split(self, text: str, chunk_size: int, chunk_overlap: int) -> List[str]:
-        """字符切分"""
-        chunks = []
-        start = 0
-        while start < len(text):
-            end = start + chunk_size
-            chunks.append(text[start:end])
-            start = end - chunk_overlap
-        return chunks
-
-    def _token_split(self, text: str, chunk_size: int, chunk_overlap: int) -> List[str]:
-        """Token 切分(使用 tiktoken)"""
-        try:
-            encoding = tiktoken.get_encoding("cl100k_base")
-            tokens = encoding.encode(text)
-            
-            chunks = []
-            start = 0
-            while start < len(tokens):
-                end = start + chunk_size
-                chunk_tokens = tokens[start:end]
-                chunk_text = encoding.decode(chunk_tokens)
-                chunks.append(chunk_text)
-                start = end - chunk_overlap
-            
-            return chunks
-        except Exception as e:
-            print(f"Token 切分失敗,回退到字符切分: {str(e)}")
-            return self._character_split(text, chunk_size * 4, chunk_overlap * 4)
+            return chunking.character_spans(text, chunk_size, chunk_overlap)
 
-    def _semantic_split(self, text: str, max_size: int) -> List[str]:
-        """語義切分(基於句子)"""
-        import re
-        # 使用正則表達式按句子切分
-        sentences = re.split(r'[。！？\n]+|[.!?\n]+', text)
-        
-        chunks = []
-        current_chunk = ""
-        
-        for sentence in sentences:
-            sentence = sentence.strip()
-            if not sentence:
-                continue
-                
-            if len(current_chunk) + len(sentence) <= max_size:
-                current_chunk += sentence + "。"
-            else:
-                if current_chunk:
-                    chunks.append(current_chunk)
-                current_chunk = sentence + "。"
-        
-        if current_chunk:
-            chunks.append(current_chunk)
+    def get_embeddings(self, texts: List[str], provider: str = 'openai', model: str = 'text-embedding-3-small',
+                       use_cache: bool = True, dimension: Optional[int] = None) -> np.ndarray:
+        """
+        使用指定的 AI 供應商或本地模型產生 Embeddings
         
-        return chunks
+        相同 (provider, model, dimension, 文字) 的向量會從持久化快取取得,只有未命中的文字才會呼叫供應商。
+        dimension 指定時使用 Matryoshka 截斷後的維度。
+        """
+        if not use_cache or not self.embedding_cache:
+            return self._embed(texts, provider, model, dimension)
 
-    def _recursive_split(self, text: str, chunk_size: int, chunk_overlap: int) -> List[str]:
-        """遞歸切分(LangChain 風格)"""
-        separators = ["\n\n", "\n", "。", ".", " ", ""]
-        
-        def split_with_separators(text: str, seps: List[str]) -> List[str]:
-            if not seps:
-                return self._character_split(text, chunk_size, chunk_overlap)
-            
-            sep = seps[0]
-            if sep:
-                splits = text.split(sep)
-            else:
-                splits = list(text)
-            
-            chunks = []
-            current_chunk = ""
-            
-            for split in splits:
-                if len(current_chunk) + len(split) + len(sep) <= chunk_size:
-                    current_chunk += split + sep
-                else:
-                    if current_chunk:
-                        chunks.append(current_chunk)
-                    
-                    if len(split) > chunk_size:
-                        # 如果單個分段太大,使用下一個分隔符
-                        sub_chunks = split_with_separators(split, seps[1:])
-                        chunks.extend(sub_chunks)
-                        current_chunk = ""
-                    else:
-                        current_chunk = split + sep
-            
-            if current_chunk:
-                chunks.append(current_chunk)
-            
-            return chunks
+        cached = self.embedding_cache.get_many(provider, model, dimension, texts)
+        missing = list(dict.fromkeys(t for t, v in zip(texts, cached) if v is None))
+        hits = sum(v is not None for v in cached)
+        if hits:
+            print(f"[RAG] Embedding 快取命中 {hits}/{len(texts)}")
+        if not missing:
+            return np.array(cached, dtype='float32')
+
+        fresh = self._embed(missing, provider, model, dimension)
+        self.embedding_cache.put_many(provider, model, dimension, missing, fresh)
+        fresh_map = dict(zip(missing, fresh))
+        return np.array([v if v is not None else fresh_map[t] for t, v in zip(texts, cached)], dtype='float32')
+
+    @staticmethod
+    def _normalize_query(query: str) -> str:
+        """正規化查詢 (全形轉半形、合併空白、小寫),提高快取命中率"""
+        return " ".join(unicodedata.normalize('NFKC', query).split()).lower()
+
+    def embed_query(self, query: str, provider: str, model: str, dimension: Optional[int] = None) -> np.ndarray:
+        """
+        產生查詢的 Embedding (1 x d)
         
-        return split_with_separators(text, separators)
+        以 (provider, model, dimension, 正規化查詢) 為鍵快取於記憶體;
+        相同查詢同時進來時只會送出一次 Embedding 請求。
+        正規化結果只作為快取鍵,送去 Embedding 的仍是原始查詢 (大小寫、全形字元可能影響語意)
+        """
+        normalized = self._normalize_query(query)
+        key = (provider, model, dimension, normalized)
+        vector = self._query_cache.get(key)
+        if vector is not None:
+            return vector
+
+        def compute():
+            result = self.get_embeddings([query], provider, model, use_cache=False, dimension=dimension)
+            self._query_cache.set(key, result)
+            return result
+
+        return self._query_flight.do(key, compute)
+
+    def _embed(self, texts: List[str], provider: str, model: str, dimension: Optional[int] = None) -> np.ndarray:
+        """直接呼叫供應商產生 Embeddings (不經快取),依供應商限制切成批次並行送出"""
+        if dimension and provider != 'openai':
+            # 其他供應商不支援指定維度,取完整向量後截斷
+            return self._truncate_embeddings(self._embed(texts, provider, model), dimension)
 
-    def get_embeddings(self, texts: List[str], provider: str = 'openai', model: str = 'text-embedding-3-small') -> np.ndarray:
-        """使用指定的 AI 供應商或本地模型產生 Embeddings"""
         if provider == 'openai':
-            return self._get_openai_embeddings(texts, model)
+            self._get_openai_client()
+            embed_fn = functools.partial(self._get_openai_embeddings, dimension=dimension)
         elif provider == 'google':
-            return self._get_google_embeddings(texts, model)
+            embed_fn = self._get_google_embeddings
         elif provider == 'local':
-            return self._get_local_embeddings(texts, model)
+            embed_fn = self._get_local_embeddings
         else:
             raise ValueError(f"不支援的 Embedding 供應商: {provider}")
 
-    def _get_openai_embeddings(self, texts: List[str], model: str) -> np.ndarray:
-        """使用 OpenAI 產生 Embeddings"""
+        limits = EMBEDDING_BATCH_LIMITS[provider]
+        batches = self._pack_batches(texts, limits["max_items"], limits["max_tokens"])
+        if len(batches) == 1:
+            return self._embed_with_retry(embed_fn, texts, model)
+
+        concurrency = min(limits["concurrency"], len(batches))
+        print(f"[RAG] Embedding 分為 {len(batches)} 批,並行數 {concurrency}")
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [
+                executor.submit(self._embed_with_retry, embed_fn, [texts[i] for i in batch], model)
+                for batch in batches
+            ]
+            # 依批次順序組回,確保與輸入文字一一對應
+            return np.vstack([future.result() for future in futures])
+
+    @staticmethod
+    def _truncate_embeddings(embeddings: np.ndarray, dimension: int) -> np.ndarray:
+        """Matryoshka 截斷: 保留前 dimension 維並重新正規化"""
+        truncated = np.ascontiguousarray(embeddings[:, :dimension])
+        norms = np.linalg.norm(truncated, axis=1, keepdims=True)
+        return truncated / np.maximum(norms, 1e-12)
+
+    def _get_encoding(self):
+        """
+        取得 tiktoken 編碼器 (只載入一次)
+        
+        載入失敗 (例如離線無法下載編碼檔) 時,在 ENCODING_RETRY_INTERVAL 秒內直接拋出同一個錯誤,
+        避免每次切分都等待下載逾時
+        """
+        if self._encoding is None:
+            if self._encoding_error and time.monotonic() - self._encoding_error[0] < ENCODING_RETRY_INTERVAL:
+                raise self._encoding_error[1]
+            try:
+                self._encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                self._encoding_error = (time.monotonic(), e)
+                raise
+        return self._encoding
+
+    def _pack_batches(self, texts: List[str], max_items: int, max_tokens: Optional[int]) -> List[List[int]]:
+        """
+        依 token 數將文字打包成批次,回傳每批的文字索引
+        
+        單一文字超過 max_tokens 時自成一批,交由供應商回報錯誤
+        """
+        if max_tokens:
+            try:
+                token_counts = [len(t) for t in self._get_encoding().encode_ordinary_batch(texts)]
+            except Exception as e:
+                # 編碼器無法載入時以字元數估算 (中文約一字一 token,英文偏保守)
+                print(f"[RAG] tiktoken 無法使用,改以字元數估算 token: {str(e)[:100]}")
+                token_counts = [len(t) for t in texts]
+        else:
+            token_counts = [0] * len(texts)
+
+        batches = []
+        current = []
+        current_tokens = 0
+        for i, count in enumerate(token_counts):
+            if current and (len(current) >= max_items or (max_tokens and current_tokens + count > max_tokens)):
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append(i)
+            current_tokens += count
+        if current:
+            batches.append(current)
+        return batches
+
+    def _embed_with_retry(self, embed_fn, texts: List[str], model: str) -> np.ndarray:
+        """呼叫 Embedding 函式,遇到限流 (429) 或暫時性錯誤時以指數退避重試"""
+        for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+            try:
+                return embed_fn(texts, model)
+            except Exception as e:
+                if attempt == EMBEDDING_MAX_RETRIES or not self._is_retryable(e):
+                    raise
+                delay = self._retry_after(e) or min(EMBEDDING_RETRY_BASE_DELAY * (2 ** attempt), 60)
+                delay += random.uniform(0, delay * 0.1)
+                print(f"[RAG] Embedding 請求受限,{delay:.1f} 秒後重試 ({attempt + 1}/{EMBEDDING_MAX_RETRIES}): {str(e)[:100]}")
+                time.sleep(delay)
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        """判斷錯誤是否為限流或暫時性的伺服器錯誤"""
+        message = str(error).lower()
+        if 'insufficient_quota' in message:
+            # 額度用盡不會因重試而恢復
+            return False
+        status = getattr(error, 'status_code', None) or getattr(error, 'code', None)
+        if status in (429, 500, 502, 503, 504):
+            return True
+        return any(key in message for key in ('429', 'rate limit', 'resource_exhausted', 'overloaded'))
+
+    @staticmethod
+    def _retry_after(error: Exception) -> Optional[float]:
+        """從回應標頭讀取 Retry-After 秒數"""
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None)
+        if not headers:
+            return None
+        try:
+            return float(headers.get('retry-after'))
+        except (TypeError, ValueError):
+            return None
+
+    def _get_openai_client(self):
+        """取得 OpenAI client (懶載入,需在並行送出前建立)"""
         if not self._openai_client:
             api_key = os.getenv('OPENAI_API_KEY')
             if not api_key:
                 raise ValueError("未設定 OPENAI_API_KEY")
             from openai import OpenAI
             self._openai_client = OpenAI(api_key=api_key)
-            
-        response = self._openai_client.embeddings.create(
-            input=texts,
-            model=model
-        )
+        return self._openai_client
+
+    def _get_openai_embeddings(self, texts: List[str], model: str, dimension: Optional[int] = None) -> np.ndarray:
+        """使用 OpenAI 產生 Embeddings (text-embedding-3 系列可由 API 直接輸出截斷維度)"""
+        params = {"input": texts, "model": model}
+        if dimension:
+            params["dimensions"] = dimension
+        response = self._get_openai_client().embeddings.create(**params)
         embeddings = [data.embedding for data in response.data]
         return np.array(embeddings).astype('float32')
 
@@ -259,17 +578,13 @@ class RAGService:
         return np.array(response['embedding']).astype('float32')
 
     def _get_local_embeddings(self, texts: List[str], model: str) -> np.ndarray:
-        """使用本地 SentenceTransformers 產生 Embeddings"""
+        """
+        使用本地 SentenceTransformers 產生 Embeddings
+        
+        交由共用的本地 Embedding 服務處理: 模型只在一個行程載入,並行的請求會合併成批次推論
+        """
         try:
-            if not self._local_model:
-                from sentence_transformers import SentenceTransformer
-                # 如果使用者沒指定具體模型,使用預設的多語言模型
-                model_name = model if '/' in model or '-' in model else "paraphrase-multilingual-MiniLM-L12-v2"
-                print(f"[RAG] 正在載入本地模型: {model_name}")
-                self._local_model = SentenceTransformer(model_name)
-                
-            embeddings = self._local_model.encode(texts)
-            return np.array(embeddings).astype('float32')
+            return local_embedder.encode(texts, model)
         except ImportError:
             error_msg = (
                 "❌ 缺少 sentence-transformers 套件!\n\n"
@@ -283,111 +598,1263 @@ class RAGService:
             logger.error(error_msg)
             raise ValueError(error_msg)
 
-    def create_kb_index(self, kb_id: int, chunks: List[str], config: Dict[str, Any] = None):
-        """為指定的知識庫建立 FAISS 索引,支援不同索引類型"""
-        if not chunks:
+    def _build_index(self, index_type: str, dimension: int, embeddings: np.ndarray,
+                     index_params: Optional[Dict[str, Any]] = None) -> faiss.Index:
+        """
+        依 index_type 建立並訓練空索引,以 chunk ID 定址
+
+        IVF 本身即儲存任意 64-bit ID,直接回傳 (IndexIDMap2 移除向量時假設內層會重新編號,IVF 不會);
+        其餘類型外層包 IndexIDMap2
+        """
+        index_params = index_params or {}
+        nlist = min(len(embeddings) // 4, 100) if len(embeddings) > 10 else 1
+
+        if index_type == 'ivf_pq' and len(embeddings) < PQ_MIN_TRAINING_POINTS:
+            # PQ 碼本需要足夠的訓練樣本,資料太少時改用 SQ8
+            print(f"[RAG] 向量數 {len(embeddings)} 不足以訓練 IVF-PQ,改用 SQ8")
+            index_type = 'sq8'
+
+        if index_type == 'ivf':
+            # IVF 需要訓練,適合中大規模數據
+            quantizer = faiss.IndexFlatL2(dimension)
+            base = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_L2)
+        elif index_type == 'ivf_pq':
+            # IVF + 乘積量化: 每個向量只存 m 個子向量碼 (1536 維預設 96 bytes)
+            nlist = int(index_params.get('nlist') or min(max(int(np.sqrt(len(embeddings))), 1), 4096))
+            m = self._pq_subquantizers(dimension, index_params.get('pq_m'))
+            quantizer = faiss.IndexFlatL2(dimension)
+            base = faiss.IndexIVFPQ(quantizer, dimension, nlist, m, 8)
+        elif index_type == 'sq8':
+            # 純量量化: 每維 1 byte
+            base = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit)
+        elif index_type == 'fp16':
+            # 半精度: 每維 2 bytes
+            base = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_fp16)
+        elif index_type == 'hnsw':
+            # HNSW 圖索引,檢索速度極快
+            base = faiss.IndexHNSWFlat(dimension, 32)
+        else:
+            # 預設 Flat 索引 (IndexFlatL2)
+            base = faiss.IndexFlatL2(dimension)
+
+        if not base.is_trained:
+            base.train(embeddings)
+        if isinstance(base, faiss.IndexIVF):
+            return base
+        return faiss.IndexIDMap2(base)
+
+    @staticmethod
+    def _pq_subquantizers(dimension: int, requested: Optional[int]) -> int:
+        """PQ 子量化器數量 m (必須整除維度),預設每 16 維一個"""
+        if requested and dimension % int(requested) == 0:
+            return int(requested)
+        m = max(dimension // 16, 1)
+        while dimension % m:
+            m -= 1
+        return m
+
+    def _index_stats(self, index: faiss.Index, embeddings: np.ndarray, ids: np.ndarray,
+                     index_params: Dict[str, Any], k: int = 10, sample_size: int = 200) -> Dict[str, Any]:
+        """
+        索引壓縮率與 recall 檢查
+        
+        compression_ratio 以 float32 原始向量大小 / 序列化後索引大小計算;
+        recall 以原始向量的精確搜尋為基準,從 embeddings 抽樣作為查詢 (embeddings 須為索引中的全部向量)
+        """
+        stats = {"vectors": int(index.ntotal)}
+        if index.ntotal == 0:
+            return stats
+        index_bytes = faiss.serialize_index(index).nbytes
+        stats["bytes_per_vector"] = round(index_bytes / index.ntotal, 1)
+        stats["compression_ratio"] = round(index.ntotal * index.d * 4 / index_bytes, 2)
+
+        if len(embeddings):
+            k = min(k, len(embeddings))
+            rng = np.random.default_rng(0)
+            sample = rng.choice(len(embeddings), size=min(sample_size, len(embeddings)), replace=False)
+            exact = faiss.IndexFlatL2(embeddings.shape[1])
+            exact.add(embeddings)
+            _, truth = exact.search(embeddings[sample], k)
+            _, approx = index.search(embeddings[sample], k, params=self._search_params(index, index_params))
+            truth_ids = ids[truth]
+            stats["recall_at_k"] = round(float(np.mean([
+                len(set(a) & set(t)) / k for a, t in zip(approx.tolist(), truth_ids.tolist())
+            ])), 4)
+            stats["recall_k"] = k
+        return stats
+
+    @staticmethod
+    def chunk_id_range(file_id: int) -> Tuple[int, int]:
+        """回傳檔案的 chunk ID 區間 [lo, hi)"""
+        lo = int(file_id) << FILE_ID_SHIFT
+        return lo, lo + (1 << FILE_ID_SHIFT)
+
+    def _remove_file_ids(self, index: faiss.Index, file_ids: List[int], index_type: str) -> faiss.Index:
+        """從索引移除指定檔案的所有向量,回傳 (可能重建過的) 索引"""
+        if not file_ids or index.ntotal == 0:
+            return index
+        selectors = [faiss.IDSelectorRange(*self.chunk_id_range(f_id)) for f_id in file_ids]
+        try:
+            for selector in selectors:
+                index.remove_ids(selector)
+            return index
+        except RuntimeError:
+            # HNSW 不支援刪除,改用既有向量重建 (不需重新呼叫 Embedding API)
+            ids, vectors = self._index_vectors(index)
+            keep = np.ones(len(ids), dtype=bool)
+            for f_id in file_ids:
+                lo, hi = self.chunk_id_range(f_id)
+                keep &= ~((ids >= lo) & (ids < hi))
+            rebuilt = self._build_index(index_type, index.d, vectors[keep])
+            if keep.any():
+                rebuilt.add_with_ids(vectors[keep], ids[keep])
+            return rebuilt
+
+    @staticmethod
+    def _index_vectors(index: faiss.Index) -> Tuple[np.ndarray, np.ndarray]:
+        """還原索引中的所有向量,回傳 (chunk ID, 向量);IVF 需已建立 direct map"""
+        if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+            return faiss.vector_to_array(index.id_map), index.index.reconstruct_n(0, index.ntotal)
+        invlists = faiss.extract_index_ivf(index).invlists
+        ids = [faiss.rev_swig_ptr(invlists.get_ids(i), invlists.list_size(i)).copy()
+               for i in range(invlists.nlist) if invlists.list_size(i)]
+        ids = np.concatenate(ids) if ids else np.zeros(0, dtype='int64')
+        return ids, index.reconstruct_batch(ids)
+
+    def _kb_dir(self, kb_id: int) -> str:
+        """知識庫的版本目錄根 (內含 CURRENT 指標與 v<世代> 子目錄)"""
+        return os.path.join(self.index_path, f"kb_{kb_id}")
+
+    def _current_version(self, kb_id: int) -> Optional[int]:
+        """CURRENT 指向的版本世代,尚未建立版本目錄 (舊版平面配置) 時為 None"""
+        try:
+            with open(os.path.join(self._kb_dir(kb_id), "CURRENT"), "r", encoding="utf-8") as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _version_stamp(self, kb_id: int) -> Optional[Tuple[int, int]]:
+        """
+        CURRENT 檔的 (inode, mtime_ns)
+        
+        指標以 os.replace 換成新檔,inode 必定改變;查詢時只需一次 stat 即可得知其他行程是否發布了新版本
+        """
+        try:
+            st = os.stat(os.path.join(self._kb_dir(kb_id), "CURRENT"))
+            return st.st_ino, st.st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _list_versions(self, kb_id: int) -> List[int]:
+        kb_dir = self._kb_dir(kb_id)
+        if not os.path.isdir(kb_dir):
+            return []
+        return sorted(int(name[1:]) for name in os.listdir(kb_dir) if name[:1] == "v" and name[1:].isdigit())
+
+    def _kb_paths(self, kb_id: int, version: Optional[int] = None) -> Dict[str, str]:
+        """
+        知識庫各檔案的路徑
+        
+        未指定 version 時解析 CURRENT 指向的版本;尚未遷移的知識庫回傳舊版平面配置的路徑
+        """
+        if version is None:
+            version = self._current_version(kb_id)
+        if version is None:
+            return self._legacy_paths(kb_id)
+        version_dir = os.path.join(self._kb_dir(kb_id), f"v{version}")
+        return {
+            "version": version,
+            "index": os.path.join(version_dir, "index.faiss"),
+            "meta": os.path.join(version_dir, "meta.json"),
+            "store": os.path.join(version_dir, "chunks"),
+            "lexical": os.path.join(version_dir, "lexical"),
+            "dedup": os.path.join(version_dir, "dedup.npz"),
+            "legacy_meta": os.path.join(self.index_path, f"kb_{kb_id}_metadata.pkl"),
+            "legacy_chunks": os.path.join(self.index_path, f"kb_{kb_id}_chunks.pkl"),
+        }
+
+    def _legacy_paths(self, kb_id: int) -> Dict[str, str]:
+        """舊版平面配置 (所有檔案直接放在 indices/ 下,就地覆寫) 的路徑"""
+        return {
+            "version": None,
+            "index": os.path.join(self.index_path, f"kb_{kb_id}.index"),
+            "meta": os.path.join(self.index_path, f"kb_{kb_id}_meta.json"),
+            "store": os.path.join(self.index_path, f"kb_{kb_id}_store"),
+            "lexical": os.path.join(self.index_path, f"kb_{kb_id}_lexical"),
+            "dedup": os.path.join(self.index_path, f"kb_{kb_id}_dedup.npz"),
+            # 舊版 pickle 格式
+            "legacy_meta": os.path.join(self.index_path, f"kb_{kb_id}_metadata.pkl"),
+            "legacy_chunks": os.path.join(self.index_path, f"kb_{kb_id}_chunks.pkl"),
+        }
+
+    def _remove_legacy_files(self, kb_id: int):
+        legacy = self._legacy_paths(kb_id)
+        ChunkStore.remove(legacy["store"])
+        LexicalIndex.remove(legacy["lexical"])
+        for key in ("index", "meta", "dedup", "legacy_meta", "legacy_chunks"):
+            if os.path.exists(legacy[key]):
+                os.remove(legacy[key])
+
+    def _new_version(self, kb_id: int) -> Dict[str, str]:
+        """建立下一個世代的空版本目錄 (以 mkdir 佔用世代號碼,不會與其他寫入者衝突)"""
+        kb_dir = self._kb_dir(kb_id)
+        os.makedirs(kb_dir, exist_ok=True)
+        version = max(self._list_versions(kb_id) + [self._current_version(kb_id) or 0]) + 1
+        while True:
+            try:
+                os.mkdir(os.path.join(kb_dir, f"v{version}"))
+                return self._kb_paths(kb_id, version)
+            except FileExistsError:
+                version += 1
+
+    def _load_kb_metadata(self, kb_id: int, paths: Optional[Dict[str, str]] = None) -> Optional[Dict[str, Any]]:
+        """讀取知識庫 metadata (版本與索引配置),不存在時返回 None;paths 未指定時讀取目前版本"""
+        meta_path = (paths or self._kb_paths(kb_id))["meta"]
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save_kb_index(self, kb_id: int, paths: Dict[str, str], index: faiss.Index,
+                       records: Iterable[ChunkRecord], config: Dict[str, Any]):
+        """
+        將索引、chunk 儲存與 metadata 寫入新版本目錄 (paths 由 _new_version 取得),再原子地切換 CURRENT
+        
+        查詢端永遠只看到完整的一組檔案;正在使用舊版本的查詢不受影響,之後由 _gc_versions 清除
+        """
+        ChunkStore.write(paths["store"], records)
+        faiss.write_index(index, paths["index"])
+        with open(paths["meta"], "w", encoding="utf-8") as f:
+            json.dump({"version": METADATA_VERSION, "config": config}, f)
+        self._publish_version(kb_id, paths["version"])
+
+        # 已發布版本目錄,移除舊版平面配置與 pickle 檔案
+        self._remove_legacy_files(kb_id)
+
+        self._index_cache.pop(kb_id)
+        self._gc_versions(kb_id)
+
+    def _publish_version(self, kb_id: int, version: int):
+        """寫入暫存指標檔後以 os.replace 取代 CURRENT (原子操作)"""
+        pointer = os.path.join(self._kb_dir(kb_id), "CURRENT")
+        with open(pointer + ".tmp", "w", encoding="utf-8") as f:
+            f.write(str(version))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(pointer + ".tmp", pointer)
+        print(f"[RAG] 知識庫 {kb_id} 發布索引版本 v{version}")
+
+    def _gc_versions(self, kb_id: int):
+        """
+        清除舊版本目錄
+        
+        保留 CURRENT 與其前 RAG_INDEX_KEEP_VERSIONS - 1 個版本。已開啟的查詢以 mmap/檔案描述子持有舊檔,
+        刪除目錄項目不影響其讀取 (POSIX unlink 語意);保留前一版則涵蓋剛讀完 CURRENT、尚未開啟檔案的讀者。
+        比 CURRENT 新的目錄可能是其他寫入者正在建立的版本,超過 RAG_INDEX_GC_GRACE 秒未發布才視為中斷殘留
+        """
+        current = self._current_version(kb_id)
+        if current is None:
             return
-            
+        versions = self._list_versions(kb_id)
+        keep = set([v for v in versions if v <= current][-max(RAG_INDEX_KEEP_VERSIONS, 1):])
+        now = time.time()
+        for version in versions:
+            if version in keep:
+                continue
+            path = os.path.join(self._kb_dir(kb_id), f"v{version}")
+            try:
+                if version > current and now - os.path.getmtime(path) < RAG_INDEX_GC_GRACE:
+                    continue
+                shutil.rmtree(path)
+                print(f"[RAG] 知識庫 {kb_id} 清除舊索引版本 v{version}")
+            except OSError as e:
+                print(f"[RAG] 清除索引版本 v{version} 失敗: {str(e)}")
+
+    def kb_lock(self, kb_id: int) -> threading.RLock:
+        """取得知識庫的索引寫入鎖"""
+        with self._kb_locks_guard:
+            return self._kb_locks.setdefault(kb_id, threading.RLock())
+
+    @staticmethod
+    def _is_incremental_format(meta: Optional[Dict[str, Any]]) -> bool:
+        """metadata 對應的索引格式能否就地新增/移除向量 (版本 3 的非 IVF 索引與目前格式相同)"""
+        if not meta:
+            return False
+        version = meta.get("version")
+        return version == METADATA_VERSION or (
+            version == 3 and meta.get("config", {}).get("index_type") not in IVF_INDEX_TYPES)
+
+    def is_index_compatible(self, kb_id: int, config: Dict[str, Any]) -> bool:
+        """
+        檢查現有索引能否增量更新
+        
+        舊版 (依位置編號、pickle 儲存、IVF 包在 IndexIDMap2 內) 索引或 Embedding/索引配置已變更時,必須整體重建
+        """
+        paths = self._kb_paths(kb_id)
+        if not os.path.exists(paths["index"]) or not ChunkStore.exists(paths["store"]):
+            return False
+        meta = self._load_kb_metadata(kb_id, paths)
+        if not self._is_incremental_format(meta):
+            return False
+        stored = meta.get("config", {})
+        return (
+            stored.get("provider") == config.get('embedding_provider', 'openai') and
+            stored.get("model") == config.get('embedding_model', 'text-embedding-3-small') and
+            stored.get("index_type") == config.get('index_type', 'flat') and
+            stored.get("embed_dim") == self._matryoshka_dim(config)
+        )
+
+    @staticmethod
+    def _matryoshka_dim(config: Dict[str, Any]) -> Optional[int]:
+        """
+        Matryoshka 截斷維度 (kb_configs.index_params.matryoshka_dim)
+        
+        text-embedding-3 系列以較低維度輸出時仍保有大部分檢索品質,可直接減少索引大小
+        """
+        dim = (config.get('index_params') or {}).get('matryoshka_dim')
+        return int(dim) if dim else None
+
+    @staticmethod
+    def _dedup_threshold(config: Dict[str, Any]) -> float:
+        """近似重複合併門檻 (kb_configs.index_params.dedup_threshold,0 表示停用)"""
+        value = (config.get('index_params') or {}).get('dedup_threshold', RAG_DEDUP_THRESHOLD)
+        return float(value or 0.0)
+
+    def _dedup_chunks(self, dedup: Optional[DedupIndex], store: Optional[ChunkStore], removed_file_ids: List[int],
+                      ids: np.ndarray, texts: List[str], threshold: float
+                      ) -> Tuple[Optional[DedupIndex], np.ndarray, List[str], int]:
+        """
+        在產生 Embedding 前合併近似重複的 chunks
+        
+        被合併的 chunk 仍寫入 chunk 儲存,但不進入向量與關鍵字索引。移除檔案時,
+        代表段落屬於該檔案的重複 chunks 會與新 chunks 一起重新判斷,必要時提升為代表段落。
+        
+        Returns:
+            (去重狀態, 需加入索引的 chunk ID, 對應文字, 本次合併數);未啟用且無既有狀態時去重狀態為 None
+        """
+        if dedup is None:
+            if threshold <= 0:
+                return None, ids, texts, 0
+            dedup = DedupIndex()
+            if store is not None:
+                # 既有知識庫尚未去重: 目前索引中的 chunks 全部視為代表段落
+                existing = list(store.records(~store.file_mask(removed_file_ids)))
+                dedup.add([rec[0] for rec in existing], [bytes(rec[1]).decode('utf-8') for rec in existing], 0)
+        elif removed_file_ids:
+            orphans = dedup.remove_ranges([self.chunk_id_range(f_id) for f_id in removed_file_ids])
+            if len(orphans):
+                print(f"[RAG] {len(orphans)} 個重複 chunks 的代表段落已移除,重新判斷是否加入索引")
+                ids = np.concatenate([orphans, ids])
+                texts = store.get_texts(orphans) + list(texts)
+
+        keep = dedup.add(ids, texts, threshold)
+        collapsed = int((~keep).sum())
+        if collapsed:
+            print(f"[RAG] 近似重複合併 {collapsed}/{len(ids)} 個 chunks (門檻 {threshold})")
+        return dedup, ids[keep], [text for text, k in zip(texts, keep) if k], collapsed
+
+    def create_kb_index(self, kb_id: int, chunks: Union[List[ChunkInput], Dict[int, List[ChunkInput]]],
+                        config: Dict[str, Any] = None):
+        """
+        為指定的知識庫整體重建 FAISS 索引,支援不同索引類型
+        
+        Args:
+            kb_id: 知識庫 ID
+            chunks: {file_id: [chunk, ...]};傳入純列表時視為 file_id 0。
+                    chunk 可為文字,或含 text/page/offset 的字典
+            config: 知識庫配置 (沒傳則從資料庫讀取)
+        """
+        with self.kb_lock(kb_id):
+            return self._create_kb_index(kb_id, chunks, config)
+
+    def _create_kb_index(self, kb_id: int, chunks: Union[List[ChunkInput], Dict[int, List[ChunkInput]]],
+                         config: Dict[str, Any] = None):
+        file_chunks = chunks if isinstance(chunks, dict) else {0: chunks}
+        if not any(file_chunks.values()):
+            return
+
         # 獲取配置 (如果沒傳則去資料庫拿)
         if not config:
             config = self.get_kb_config(kb_id)
-            
+
         provider = config.get('embedding_provider', 'openai')
         model = config.get('embedding_model', 'text-embedding-3-small')
         index_type = config.get('index_type', 'flat')
+        index_params = config.get('index_params') or {}
+        embed_dim = self._matryoshka_dim(config)
+
+        print(f"[RAG] 建立索引 - Provider: {provider}, Model: {model}, Type: {index_type}, 維度: {embed_dim or '原生'}")
+
+        all_ids, all_texts, records = self._flatten_file_chunks(file_chunks)
+        dedup, ids, texts, collapsed = self._dedup_chunks(None, None, [], all_ids, all_texts,
+                                                          self._dedup_threshold(config))
+        embeddings = self.get_embeddings(texts, provider, model, dimension=embed_dim)
+        dimension = embeddings.shape[1]
+
+        index = self._build_index(index_type, dimension, embeddings, index_params)
+        index.add_with_ids(embeddings, ids)
+
+        stats = self._index_stats(index, embeddings, ids, index_params, k=config.get('retrieval_top_k') or 10)
+        stats["duplicates_collapsed"] = collapsed
+        stats["duplicates_total"] = dedup.duplicate_count if dedup else 0
+        print(f"[RAG] 索引統計: {stats}")
+        paths = self._new_version(kb_id)
+        self._write_lexical_index(paths, ids, texts)
+        if dedup:
+            dedup.save(paths["dedup"])
+
+        # 儲存 chunks 和使用的配置
+        self._save_kb_index(kb_id, paths, index, records, {
+            "provider": provider,
+            "model": model,
+            "index_type": index_type,
+            "dimension": dimension,
+            "embed_dim": embed_dim,
+            "stats": stats
+        })
+        return stats
+
+    def update_kb_index(self, kb_id: int, file_chunks: Dict[int, List[ChunkInput]], config: Dict[str, Any] = None):
+        """
+        增量更新知識庫索引: 只為傳入的檔案重新產生 Embedding
         
-        print(f"[RAG] 建立索引 - Provider: {provider}, Model: {model}, Type: {index_type}")
+        傳入的檔案若已在索引中會先被移除再加入,其餘檔案保持不變。
         
-        embeddings = self.get_embeddings(chunks, provider, model)
-        dimension = embeddings.shape[1]
+        Raises:
+            IndexRebuildRequired: 索引不存在或與配置不相容 (呼叫端需以知識庫所有檔案整體重建;
+                                  只用傳入的檔案重建會讓其餘檔案從索引中消失)
+        """
+        with self.kb_lock(kb_id):
+            return self._update_kb_index(kb_id, file_chunks, config)
+
+    def _update_kb_index(self, kb_id: int, file_chunks: Dict[int, List[ChunkInput]], config: Dict[str, Any] = None):
+        if not config:
+            config = self.get_kb_config(kb_id)
+
+        if not self.is_index_compatible(kb_id, config):
+            raise IndexRebuildRequired(f"知識庫 {kb_id} 的索引無法增量更新,需要整體重建")
+
+        paths = self._kb_paths(kb_id)
+        stored = self._load_kb_metadata(kb_id, paths)["config"]
+        index = faiss.read_index(paths["index"])
+        store = ChunkStore(paths["store"])
+
+        removed = list(file_chunks.keys())
+        index = self._remove_file_ids(index, removed, stored["index_type"])
+        kept = store.records(~store.file_mask(removed))
+
+        new_ids, new_texts, records = self._flatten_file_chunks(file_chunks)
+        dedup, ids, texts, collapsed = self._dedup_chunks(DedupIndex.load(paths["dedup"]), store, removed,
+                                                          new_ids, new_texts, self._dedup_threshold(config))
+        if texts:
+            print(f"[RAG] 增量更新索引 - 新增 {len(texts)} 個 chunks ({len(file_chunks)} 個檔案)")
+            embeddings = self.get_embeddings(texts, stored["provider"], stored["model"],
+                                             dimension=stored.get("embed_dim"))
+            index.add_with_ids(embeddings, ids)
+
+        new_paths = self._new_version(kb_id)
+        self._write_lexical_index(new_paths, ids, texts, removed, paths, store,
+                                  exclude_ids=np.concatenate([dedup.dup_ids, ids]) if dedup else ())
+        if dedup:
+            dedup.save(new_paths["dedup"])
+
+        # 增量更新只重算壓縮率;recall 以最近一次完整建立時的抽樣結果為準
+        previous = stored.get("stats") or {}
+        stored["stats"] = self._index_stats(index, np.zeros((0, index.d), dtype='float32'), ids, {})
+        for key in ("recall_at_k", "recall_k"):
+            if key in previous:
+                stored["stats"][key] = previous[key]
+        stored["stats"]["duplicates_collapsed"] = collapsed
+        stored["stats"]["duplicates_total"] = dedup.duplicate_count if dedup else 0
+        self._save_kb_index(kb_id, new_paths, index, itertools.chain(kept, records), stored)
+        return stored["stats"]
+
+    def _write_lexical_index(self, paths: Dict[str, str], ids: Iterable[int], texts: List[str],
+                             drop_file_ids: Optional[List[int]] = None, base_paths: Optional[Dict[str, str]] = None,
+                             store: Optional[ChunkStore] = None, exclude_ids: Iterable[int] = ()):
+        """
+        將關鍵字索引寫入新版本目錄 paths
         
-        # 根據 index_type 建立不同的索引
-        if index_type == 'ivf':
-            # IVF 需要訓練,適合中大規模數據
-            nlist = min(len(chunks) // 4, 100) if len(chunks) > 10 else 1
-            quantizer = faiss.IndexFlatL2(dimension)
-            index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_L2)
-            index.train(embeddings)
-        elif index_type == 'hnsw':
-            # HNSW 圖索引,檢索速度極快
-            index = faiss.IndexHNSWFlat(dimension, 32)
-        else:
-            # 預設 Flat 索引 (IndexFlatL2)
-            index = faiss.IndexFlatL2(dimension)
-            
-        index.add(embeddings)
-        
-        # 儲存索引與對應的文本區塊
-        kb_path = os.path.join(self.index_path, f"kb_{kb_id}.index")
-        faiss.write_index(index, kb_path)
-        
-        # 儲存 metadata (包括 chunks 和使用的配置)
-        metadata_path = os.path.join(self.index_path, f"kb_{kb_id}_metadata.pkl")
-        with open(metadata_path, "wb") as f:
-            pickle.dump({
-                "chunks": chunks,
-                "config": {
-                    "provider": provider,
-                    "model": model,
-                    "index_type": index_type,
-                    "dimension": dimension
-                }
-            }, f)
-            
-        # 更新快取
-        self._indices[kb_id] = {"index": index, "chunks": chunks}
-
-    def query_kb(self, kb_id: int, query: str, top_k: int = 3) -> List[str]:
-        """在知識庫中檢索與查詢最相關的內容"""
-        # 載入索引 (如果不在快取中)
-        if kb_id not in self._indices:
-            kb_path = os.path.join(self.index_path, f"kb_{kb_id}.index")
-            metadata_path = os.path.join(self.index_path, f"kb_{kb_id}_metadata.pkl")
-            # 兼容舊版命名
-            old_chunks_path = os.path.join(self.index_path, f"kb_{kb_id}_chunks.pkl")
-            
-            if not os.path.exists(kb_path):
+        drop_file_ids 為 None 時整體重建;否則以 base_paths 版本的關鍵字索引為基礎,移除這些檔案再加入新的 chunks。
+        舊知識庫尚無關鍵字索引時從 chunk 儲存補建 (略過 exclude_ids,即被合併的重複 chunks 與本次新加入的 chunks)。
+        失敗時不寫入關鍵字索引,檢索退回純向量
+        """
+        path = paths["lexical"]
+        try:
+            if drop_file_ids is None:
+                LexicalIndex.build(path, list(ids), texts)
+            elif LexicalIndex.exists(base_paths["lexical"]):
+                LexicalIndex.build(path, list(ids), texts, base=LexicalIndex(base_paths["lexical"]),
+                                   drop_ranges=[self.chunk_id_range(f_id) for f_id in drop_file_ids])
+            else:
+                exclude = set(int(i) for i in exclude_ids)
+                kept = [rec for rec in store.records(~store.file_mask(drop_file_ids)) if rec[0] not in exclude]
+                LexicalIndex.build(path, [rec[0] for rec in kept] + list(ids),
+                                   [bytes(rec[1]).decode('utf-8') for rec in kept] + list(texts))
+        except Exception as e:
+            print(f"[RAG] 關鍵字索引建立失敗,檢索將只使用向量: {str(e)}")
+            LexicalIndex.remove(path)
+
+    def remove_files_from_index(self, kb_id: int, file_ids: List[int]):
+        """
+        從知識庫索引中移除指定檔案的向量與 chunks
+
+        Raises:
+            IndexRebuildRequired: 舊版格式的索引無法就地移除 (呼叫端需以知識庫剩餘的檔案整體重建,
+                                  否則已刪除檔案的內容仍可被檢索)
+        """
+        with self.kb_lock(kb_id):
+            paths = self._kb_paths(kb_id)
+            if not os.path.exists(paths["index"]):
+                return
+            meta = self._load_kb_metadata(kb_id, paths)
+            if not self._is_incremental_format(meta) or not ChunkStore.exists(paths["store"]):
+                print(f"[RAG] 知識庫 {kb_id} 為舊版索引格式,無法就地移除檔案 {file_ids}")
+                raise IndexRebuildRequired(f"知識庫 {kb_id} 的索引無法就地移除檔案,需要整體重建")
+            index = faiss.read_index(paths["index"])
+            store = ChunkStore(paths["store"])
+            stored = meta["config"]
+            index = self._remove_file_ids(index, file_ids, stored["index_type"])
+
+            # 代表段落被移除的重複 chunks 需重新判斷,必要時補上 Embedding
+            dedup, ids, texts = DedupIndex.load(paths["dedup"]), np.zeros(0, dtype='int64'), []
+            if dedup:
+                dedup, ids, texts, _ = self._dedup_chunks(dedup, store, file_ids, ids, texts,
+                                                          self._dedup_threshold(self.get_kb_config(kb_id)))
+            if texts:
+                index.add_with_ids(self.get_embeddings(texts, stored["provider"], stored["model"],
+                                                       dimension=stored.get("embed_dim")), ids)
+            if dedup:
+                stored.setdefault("stats", {})["duplicates_total"] = dedup.duplicate_count
+
+            new_paths = self._new_version(kb_id)
+            self._write_lexical_index(new_paths, ids, texts, file_ids, paths, store,
+                                      exclude_ids=np.concatenate([dedup.dup_ids, ids]) if dedup else ())
+            if dedup:
+                dedup.save(new_paths["dedup"])
+            self._save_kb_index(kb_id, new_paths, index, store.records(~store.file_mask(file_ids)), stored)
+
+    def delete_kb_index(self, kb_id: int):
+        """刪除知識庫的索引檔案"""
+        with self.kb_lock(kb_id):
+            # 先移除 CURRENT,其他行程的下一次查詢就會發現索引已不存在
+            kb_dir = self._kb_dir(kb_id)
+            if os.path.exists(os.path.join(kb_dir, "CURRENT")):
+                os.remove(os.path.join(kb_dir, "CURRENT"))
+            shutil.rmtree(kb_dir, ignore_errors=True)
+            self._remove_legacy_files(kb_id)
+            self._index_cache.pop(kb_id)
+        self.invalidate_kb_config(kb_id)
+
+    def _tags_path(self, kb_id: int) -> str:
+        """檔案標籤快照 (放在版本目錄之外,修改標籤不需重建索引)"""
+        return os.path.join(self._kb_dir(kb_id), "tags.json")
+
+    def get_file_tags(self, kb_id: int) -> Dict[int, List[str]]:
+        """知識庫的檔案標籤 {file_id: [標籤]},以 tags.json 的 stat 判斷是否需要重新讀取"""
+        path = self._tags_path(kb_id)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return {}
+        stamp = (st.st_ino, st.st_mtime_ns)
+        cached = self._tags_cache.get(kb_id)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        with open(path, "r", encoding="utf-8") as f:
+            file_tags = {int(f_id): list(tags) for f_id, tags in json.load(f).get("files", {}).items()}
+        self._tags_cache[kb_id] = (stamp, file_tags)
+        return file_tags
+
+    def write_file_tags(self, kb_id: int, file_tags: Dict[int, List[str]]):
+        """
+        寫入知識庫的檔案標籤快照 (來源為 kb_files.tags)
+        
+        先寫暫存檔再以 os.replace 取代,其他 worker 下次過濾時依 stat 戳記重新讀取
+        """
+        path = self._tags_path(kb_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = {"files": {str(f_id): sorted(set(tags)) for f_id, tags in file_tags.items() if tags}}
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self._tags_cache.pop(kb_id, None)
+
+    def refresh_file_tags(self, kb_id: int):
+        """從 kb_files.tags 重新產生知識庫的標籤快照"""
+        conn = get_connection(pymysql.cursors.DictCursor)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT file_id, tags FROM kb_files WHERE kb_id = %s", (kb_id,))
+                rows = cursor.fetchall()
+        finally:
+            conn.close()
+        self.write_file_tags(kb_id, {row['file_id']: self.parse_tags(row.get('tags')) for row in rows})
+
+    @staticmethod
+    def parse_tags(value) -> List[str]:
+        """kb_files.tags (JSON 陣列) -> 標籤列表"""
+        if not value:
+            return []
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except ValueError:
                 return []
-                
-            index = faiss.read_index(kb_path)
-            
-            if os.path.exists(metadata_path):
-                with open(metadata_path, "rb") as f:
-                    meta = pickle.load(f)
-                    chunks = meta["chunks"]
-                    config = meta.get("config", {})
-            elif os.path.exists(old_chunks_path):
-                with open(old_chunks_path, "rb") as f:
-                    chunks = pickle.load(f)
-                    config = {}
+        return [str(tag) for tag in value] if isinstance(value, list) else []
+
+    @staticmethod
+    def normalize_filters(filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """
+        檢查並正規化 metadata 過濾條件,沒有任何條件時返回 None
+        
+            file_ids - 只檢索這些檔案
+            tags     - 只檢索帶有任一標籤的檔案 (與 file_ids 同時指定時取交集)
+            pages    - [起始頁, 結束頁],含兩端,可為 null 表示不限
+        
+        條件格式錯誤時拋出 ValueError
+        """
+        if not filters:
+            return None
+        if not isinstance(filters, dict):
+            raise ValueError("filters 必須為物件")
+        normalized = {}
+        try:
+            if filters.get('file_ids') is not None:
+                normalized['file_ids'] = sorted({int(f_id) for f_id in filters['file_ids']})
+            if filters.get('tags') is not None:
+                tags = [filters['tags']] if isinstance(filters['tags'], str) else filters['tags']
+                normalized['tags'] = sorted({str(tag).strip() for tag in tags} - {""})
+            if filters.get('pages') is not None:
+                pages = filters['pages']
+                if not isinstance(pages, (list, tuple)) or len(pages) != 2:
+                    raise ValueError("pages 必須為 [起始頁, 結束頁]")
+                normalized['pages'] = tuple(None if page is None else int(page) for page in pages)
+        except TypeError:
+            raise ValueError("filters 格式錯誤")
+        return normalized or None
+
+    def _resolve_filter(self, kb_id: int, index_data: Dict[str, Any],
+                        filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """
+        過濾條件 -> 檢索候選 chunk ID
+        
+        檔案與標籤先解析成檔案集合,再依 chunk ID 區間 (file_id << 32) 從 chunk 儲存取出符合的 chunks 並套用頁碼。
+        被合併的重複 chunk 不在索引中,改由其代表段落參與檢索,命中時換回符合條件的重複 chunk
+        
+        Returns:
+            None (不過濾) 或 {"ids": 已排序的候選 ID, "substitute": {代表段落 ID: 重複 chunk ID}}
+        """
+        filters = self.normalize_filters(filters)
+        if filters is None:
+            return None
+        file_ids = filters.get('file_ids')
+        if 'tags' in filters:
+            wanted = set(filters['tags'])
+            tagged = [f_id for f_id, tags in self.get_file_tags(kb_id).items() if wanted.intersection(tags)]
+            file_ids = tagged if file_ids is None else sorted(set(file_ids).intersection(tagged))
+        ranges = None if file_ids is None else [self.chunk_id_range(f_id) for f_id in file_ids]
+        allowed = index_data["chunks"].select_ids(ranges, filters.get('pages'))
+
+        substitute = {}
+        dup_ids, dup_of = self._dedup_links(kb_id, index_data)
+        if len(dup_ids) and len(allowed):
+            matched = np.isin(dup_ids, allowed)
+            dups, reps = dup_ids[matched], dup_of[matched]
+            allowed = np.setdiff1d(allowed, dups)
+            outside = ~np.isin(reps, allowed)
+            for rep, dup in zip(reps[outside].tolist(), dups[outside].tolist()):
+                substitute.setdefault(rep, dup)
+            allowed = np.union1d(allowed, reps[outside])
+        return {"ids": allowed, "substitute": substitute}
+
+    def _dedup_links(self, kb_id: int, index_data: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+        """索引版本的 (重複 chunk ID, 代表段落 ID),只讀取這兩個陣列並記在快取項目上"""
+        links = index_data.get("dedup_links")
+        if links is None:
+            version = index_data.get("version")
+            paths = self._kb_paths(kb_id, version) if version is not None else self._legacy_paths(kb_id)
+            links = (np.zeros(0, dtype='int64'), np.zeros(0, dtype='int64'))
+            try:
+                with np.load(paths["dedup"]) as data:
+                    links = (data["dup_ids"], data["dup_of"])
+            except FileNotFoundError:
+                pass
+            index_data["dedup_links"] = links
+        return links
+
+    @staticmethod
+    def _substitute(hits: List[Tuple], id_filter: Optional[Dict[str, Any]]) -> List[Tuple]:
+        """把命中的代表段落換回符合過濾條件的重複 chunk"""
+        if not id_filter or not id_filter["substitute"]:
+            return hits
+        substitute = id_filter["substitute"]
+        return [(substitute.get(hit[0], hit[0]),) + tuple(hit[1:]) for hit in hits]
+
+    def _flatten_file_chunks(self, file_chunks: Dict[int, List[ChunkInput]]) -> Tuple[np.ndarray, List[str], List[ChunkRecord]]:
+        """將 {file_id: chunks} 攤平成 (chunk ID 陣列, 文字列表, chunk 儲存紀錄)"""
+        ids = []
+        texts = []
+        records = []
+        for f_id, chunks in file_chunks.items():
+            lo, _ = self.chunk_id_range(f_id)
+            for seq, chunk in enumerate(chunks):
+                if isinstance(chunk, str):
+                    chunk = {"text": chunk}
+                chunk_id = lo + seq
+                ids.append(chunk_id)
+                texts.append(chunk["text"])
+                records.append((chunk_id, chunk["text"], f_id, chunk.get("page", -1), chunk.get("offset", -1)))
+        return np.array(ids, dtype='int64'), texts, records
+
+    def _read_index(self, kb_path: str, index_type: Optional[str]) -> Tuple[faiss.Index, int]:
+        """
+        讀取查詢用的索引,回傳 (索引, 估計的各行程私有記憶體 bytes)
+        
+        以 mmap 唯讀方式開啟,向量資料由 OS page cache 於多個 worker 間共用、不計入估計值:
+        IVF 的倒排串列使用 IO_FLAG_MMAP;Flat/SQ8/FP16 與 HNSW 的向量儲存使用 IO_FLAG_MMAP_IFC
+        (faiss 1.11 起提供,較舊版本只有 IVF 能以 mmap 開啟,其餘完整載入)。
+        IndexIDMap2 的 ID 對照表、HNSW 圖結構與 IVF 的粗量化器仍載入各行程記憶體
+        """
+        size = os.path.getsize(kb_path)
+        if index_type in IVF_INDEX_TYPES:
+            flag = faiss.IO_FLAG_MMAP
+        else:
+            flag = getattr(faiss, 'IO_FLAG_MMAP_IFC', None)
+        if flag is not None:
+            try:
+                index = faiss.read_index(kb_path, flag | faiss.IO_FLAG_READ_ONLY)
+                return index, max(size - self._mapped_bytes(index, flag), 0)
+            except RuntimeError as e:
+                print(f"[RAG] 無法以 mmap 開啟索引,改為完整載入: {str(e)[:100]}")
+        return faiss.read_index(kb_path), size
+
+    def _mapped_bytes(self, index: faiss.Index, flag: int) -> int:
+        """以 flag 開啟的索引中直接對應到檔案 (未複製到行程記憶體) 的資料大小"""
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            # 倒排串列每筆為向量碼 + 8 bytes ID
+            return ivf.ntotal * (ivf.code_size + 8) if flag == faiss.IO_FLAG_MMAP else 0
+        if flag == faiss.IO_FLAG_MMAP:
+            return 0
+        base = self._base_index(index)
+        if isinstance(base, faiss.IndexHNSW):
+            base = faiss.downcast_index(base.storage)
+        return base.ntotal * base.code_size if isinstance(base, faiss.IndexFlatCodes) else 0
+
+    def _get_kb_entry(self, kb_id: int) -> Optional[Dict[str, Any]]:
+        """
+        取得知識庫索引 (優先使用快取),不存在時返回 None
+        
+        每次先 stat CURRENT 指標;與快取載入時的戳記不同代表有新版本 (可能由其他 worker 發布),重新載入
+        """
+        stamp = self._version_stamp(kb_id)
+        entry = self._index_cache.get(kb_id)
+        if entry is not None and entry.get("stamp") == stamp:
+            return entry
+
+        # 讀取 CURRENT 與開啟檔案之間版本可能剛被清除,重讀指標後再試一次
+        for attempt in range(2):
+            try:
+                return self._load_kb_entry(kb_id, stamp)
+            except FileNotFoundError:
+                if attempt:
+                    raise
+                stamp = self._version_stamp(kb_id)
+
+    def _load_kb_entry(self, kb_id: int, stamp: Optional[Tuple[int, int]]) -> Optional[Dict[str, Any]]:
+        paths = self._kb_paths(kb_id)
+        if not os.path.exists(paths["index"]):
+            self._index_cache.pop(kb_id)
+            return None
+
+        meta = self._load_kb_metadata(kb_id, paths)
+        if meta and ChunkStore.exists(paths["store"]):
+            chunks = ChunkStore(paths["store"])
+            config = meta.get("config", {})
+        elif os.path.exists(paths["legacy_meta"]):
+            # 兼容舊版 pickle metadata
+            with open(paths["legacy_meta"], "rb") as f:
+                legacy = pickle.load(f)
+            chunks = InMemoryChunks(legacy["chunks"])
+            config = legacy.get("config", {})
+        elif os.path.exists(paths["legacy_chunks"]):
+            with open(paths["legacy_chunks"], "rb") as f:
+                chunks = InMemoryChunks(pickle.load(f))
+            config = {}
+        else:
+            return None
+
+        index, index_bytes = self._read_index(paths["index"], config.get("index_type"))
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            # MMR 與過濾後的精確搜尋需依 ID 還原向量;在放入快取前建立 direct map,查詢期間索引保持唯讀。
+            # chunk ID 不連續,使用 hashtable (只存在記憶體中,寫入的索引不帶 direct map,移除向量不受限制)
+            if isinstance(index, faiss.IndexIVF):
+                ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
             else:
+                try:
+                    ivf.make_direct_map()
+                except RuntimeError as e:
+                    # 版本 3 包在 IndexIDMap2 內的 IVF 移除過向量後內層編號不連續: 無法還原向量,需整體重建
+                    print(f"[RAG] 知識庫 {kb_id} 的 IVF 索引為舊版格式,無法還原向量 (MMR 停用),請整體重建: "
+                          f"{str(e)[:100]}")
+        lexical = LexicalIndex(paths["lexical"]) if LexicalIndex.exists(paths["lexical"]) else None
+        entry = {"index": index, "chunks": chunks, "config": config, "lexical": lexical,
+                 "version": paths["version"], "stamp": stamp}
+        # 只計各行程私有的記憶體: mmap 的頁面由 OS page cache 共用與回收,不佔用快取預算
+        self._index_cache.put(kb_id, entry, index_bytes + chunks.nbytes + (lexical.nbytes if lexical else 0))
+        return entry
+
+    @staticmethod
+    def _base_index(index: faiss.Index) -> faiss.Index:
+        """取出 IndexIDMap 內層的實際索引"""
+        if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+            return faiss.downcast_index(index.index)
+        return index
+
+    def _search_params(self, index: faiss.Index, index_params: Dict[str, Any],
+                       selector: Optional[faiss.IDSelector] = None) -> Optional[faiss.SearchParameters]:
+        """
+        依索引類型建立單次查詢的 SearchParameters
+        
+        以參數物件傳入而非修改索引屬性,多個執行緒共用同一個快取索引時互不影響
+        """
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            params = faiss.SearchParametersIVF()
+            params.nprobe = min(int(index_params.get('nprobe', DEFAULT_NPROBE)), ivf.nlist)
+        elif isinstance(self._base_index(index), faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW()
+            params.efSearch = int(index_params.get('ef_search', DEFAULT_EF_SEARCH))
+        elif selector is not None:
+            params = faiss.SearchParameters()
+        else:
+            return None
+        if selector is not None:
+            params.sel = selector
+        return params
+
+    @staticmethod
+    def distance_to_similarity(distance: float) -> float:
+        """
+        L2 平方距離 -> 相似度
+        
+        向量已正規化 (OpenAI/Google Embedding) 時 d = 2 - 2cos,因此 1 - d/2 即為餘弦相似度
+        """
+        return 1.0 - float(distance) / 2.0
+
+    def autotune_search_params(self, kb_id: int, target_recall: float = 0.95,
+                               sample_size: int = 200, top_k: Optional[int] = None) -> Dict[str, Any]:
+        """
+        自動調校檢索參數 (IVF 的 nprobe、HNSW 的 efSearch)
+        
+        從知識庫自身的向量抽樣作為查詢,以 Flat 精確搜尋結果為基準計算 recall@k,
+        選出達到 target_recall 的最低成本設定並寫回 kb_configs.index_params
+        """
+        paths = self._kb_paths(kb_id)
+        if not os.path.exists(paths["index"]):
+            raise ValueError("知識庫尚未建立索引")
+
+        # 使用獨立副本,調校過程不影響線上查詢
+        index = faiss.read_index(paths["index"])
+        base = self._base_index(index)
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            if isinstance(index, faiss.IndexIVF):
+                ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+            candidates = [("nprobe", n) for n in NPROBE_CANDIDATES if n <= ivf.nlist]
+        elif isinstance(base, faiss.IndexHNSW):
+            candidates = [("ef_search", ef) for ef in EF_SEARCH_CANDIDATES]
+        else:
+            return {"index_type": "flat", "recall": 1.0, "params": {}, "message": "Flat 索引為精確搜尋,不需調校"}
+
+        n = index.ntotal
+        if n == 0:
+            raise ValueError("索引中沒有向量")
+        k = min(top_k or self.get_kb_config(kb_id).get('retrieval_top_k') or 3, n)
+        ids, vectors = self._index_vectors(index)
+        rng = np.random.default_rng(0)
+        queries = vectors[rng.choice(n, size=min(sample_size, n), replace=False)]
+
+        # Flat 精確搜尋作為 ground truth (結果轉為 chunk ID 與索引的檢索結果比較)
+        flat = faiss.IndexFlatL2(index.d)
+        flat.add(vectors)
+        _, truth = flat.search(queries, k)
+        truth = ids[truth]
+
+        report = []
+        chosen = None
+        for name, value in candidates:
+            params = self._search_params(index, {name: value})
+            start = time.perf_counter()
+            _, approx = index.search(queries, k, params=params)
+            elapsed_ms = (time.perf_counter() - start) * 1000 / len(queries)
+            recall = float(np.mean([len(set(a) & set(t)) / k for a, t in zip(approx.tolist(), truth.tolist())]))
+            report.append({name: value, "recall": round(recall, 4), "latency_ms": round(elapsed_ms, 3)})
+            if recall >= target_recall:
+                chosen = {name: value}
+                break
+        if chosen is None:
+            # 所有候選都未達標,採用成本最高 (recall 最佳) 的設定
+            name, value = candidates[-1]
+            chosen = {name: value}
+
+        self.update_index_params(kb_id, chosen)
+        print(f"[RAG] 知識庫 {kb_id} 檢索參數調校完成: {chosen}")
+        return {
+            "params": chosen,
+            "target_recall": target_recall,
+            "top_k": k,
+            "sample_size": len(queries),
+            "trials": report
+        }
+
+    def query_kb(self, kb_id: int, query: str, top_k: Optional[int] = None,
+                 filters: Optional[Dict[str, Any]] = None) -> List[str]:
+        """
+        在知識庫中檢索與查詢最相關的內容
+        
+        top_k 未指定時使用 kb_configs.retrieval_top_k,並過濾低於 similarity_threshold 的向量結果。
+        檢索模式由 index_params.retrieval_mode 決定:
+            hybrid (預設) - BM25 與向量結果以 RRF 融合;關鍵字結果足夠明確時直接回傳,不呼叫 Embedding API
+            vector        - 只用向量
+            lexical       - 只用 BM25
+        filters 限定檢索的檔案、標籤與頁碼 (見 normalize_filters)
+        """
+        index_data = self._get_kb_entry(kb_id)
+        if index_data is None:
+            return []
+        hits = self._search_kb(kb_id, index_data, self.get_kb_config(kb_id), query, top_k, filters=filters)
+        return [text for text in index_data["chunks"].get_texts([chunk_id for chunk_id, _ in hits])
+                if text is not None]
+
+    def query_kbs(self, kb_ids: List[int], query: str, top_k: Optional[int] = None,
+                  filters: Optional[Dict[str, Any]] = None) -> List[str]:
+        """跨多個知識庫檢索 (見 search_kbs),只回傳文字"""
+        return [hit["text"] for hit in self.search_kbs(kb_ids, query, top_k, filters)]
+
+    def search_kbs(self, kb_ids: List[int], query: str, top_k: Optional[int] = None,
+                   filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """
+        跨多個知識庫檢索並合併結果 (Agent 綁定多個知識庫時使用)
+        
+        kb_ids 依優先順序排列 (agent_knowledge_bases.priority 由小到大)。
+        各知識庫在執行緒池中並行檢索,相同 Embedding 模型的知識庫共用同一次查詢 Embedding;
+        結果以正規化相似度 (0~1) 乘上優先順序權重 (RAG_PRIORITY_DECAY ** 順位) 排序後取前 top_k。
+        top_k 未指定時使用各知識庫 retrieval_top_k 的最大值;filters 套用到每個知識庫
+        
+        Returns:
+            [{"kb_id", "chunk_id", "score", "text"}, ...] 依分數由高到低
+        """
+        kb_ids = list(dict.fromkeys(kb_ids))
+        entries = {kb_id: self._get_kb_entry(kb_id) for kb_id in kb_ids}
+        kb_ids = [kb_id for kb_id in kb_ids if entries[kb_id] is not None]
+        if not kb_ids:
+            return []
+        configs = {kb_id: self.get_kb_config(kb_id) for kb_id in kb_ids}
+        top_k = top_k or max(config.get('retrieval_top_k') or 3 for config in configs.values())
+
+        # 每個 (provider, model, 維度) 只產生一次查詢 Embedding,由第一個需要的檢索任務計算
+        embeddings: Dict[Tuple, Future] = {}
+        embeddings_guard = threading.Lock()
+
+        def embed(provider: str, model: str, dimension: Optional[int]) -> np.ndarray:
+            key = (provider, model, dimension)
+            with embeddings_guard:
+                future = embeddings.get(key)
+                owner = future is None
+                if owner:
+                    future = embeddings[key] = Future()
+            if owner:
+                try:
+                    future.set_result(self.embed_query(query, provider, model, dimension))
+                except Exception as e:
+                    future.set_exception(e)
+            return future.result()
+
+        def search(kb_id: int) -> List[Tuple[int, float]]:
+            try:
+                return self._search_kb(kb_id, entries[kb_id], configs[kb_id], query, top_k, embed=embed,
+                                       filters=filters)
+            except Exception as e:
+                print(f"[RAG] 知識庫 {kb_id} 檢索失敗: {str(e)}")
                 return []
-                
-            self._indices[kb_id] = {"index": index, "chunks": chunks, "config": config}
-            
-        index_data = self._indices[kb_id]
+
+        if len(kb_ids) == 1:
+            results = [search(kb_ids[0])]
+        else:
+            results = list(self._get_search_pool().map(search, kb_ids))
+
+        merged = []
+        for rank, (kb_id, hits) in enumerate(zip(kb_ids, results)):
+            weight = RAG_PRIORITY_DECAY ** rank
+            texts = entries[kb_id]["chunks"].get_texts([chunk_id for chunk_id, _ in hits])
+            for position, ((chunk_id, score), text) in enumerate(zip(hits, texts)):
+                if text is not None:
+                    merged.append((score * weight, rank, position, kb_id, chunk_id, text))
+        merged.sort(key=lambda hit: (-hit[0], hit[1], hit[2]))
+        return [{"kb_id": kb_id, "chunk_id": chunk_id, "score": round(score, 4), "text": text}
+                for score, _, _, kb_id, chunk_id, text in merged[:top_k]]
+
+    def _get_search_pool(self) -> ThreadPoolExecutor:
+        """跨知識庫檢索共用的執行緒池 (faiss 搜尋會釋放 GIL)"""
+        with self._kb_locks_guard:
+            if self._search_pool is None:
+                self._search_pool = ThreadPoolExecutor(max_workers=RAG_SEARCH_WORKERS,
+                                                       thread_name_prefix="rag-search")
+            return self._search_pool
+
+    def _search_kb(self, kb_id: int, index_data: Dict[str, Any], kb_config: Dict[str, Any], query: str,
+                   top_k: Optional[int] = None, embed=None,
+                   filters: Optional[Dict[str, Any]] = None) -> List[Tuple[int, float]]:
+        """
+        單一知識庫檢索,回傳 [(chunk_id, 正規化分數 0~1), ...]
+        
+        向量結果的分數為餘弦相似度;只用關鍵字時為相對於第一名的 BM25 分數;
+        RRF 融合後只由關鍵字找到的結果沿用前一名的分數,讓分數隨排序遞減。
+        有 filters 時向量與關鍵字檢索都只在符合條件的 chunks 中進行,不必多取再丟棄
+        """
+        index_params = kb_config.get('index_params') or {}
+        top_k = top_k or kb_config.get('retrieval_top_k') or 3
+        lexical = index_data.get("lexical")
+        mode = index_params.get('retrieval_mode', 'hybrid') if lexical is not None else 'vector'
+        id_filter = self._resolve_filter(kb_id, index_data, filters)
+        if id_filter is not None and not len(id_filter["ids"]):
+            return []
+
+        lexical_ids = []
+        if mode in ('hybrid', 'lexical'):
+            terms = tokenize(query)
+            lexical_hits = lexical.search(
+                terms, max(top_k * HYBRID_FETCH_FACTOR, top_k),
+                k1=float(index_params.get('bm25_k1', BM25_K1)), b=float(index_params.get('bm25_b', BM25_B)),
+                allowed=id_filter["ids"] if id_filter else None
+            )
+            lexical_ids = [chunk_id for chunk_id, _, _ in lexical_hits]
+            if mode == 'lexical' or (index_params.get('lexical_fast_path', True) and
+                                     self._lexical_confident(lexical_hits, terms, index_params)):
+                if mode == 'hybrid':
+                    print(f"[RAG] 知識庫 {kb_id} 關鍵字檢索結果明確,略過向量檢索")
+                best = lexical_hits[0][1] if lexical_hits else 1.0
+                return self._substitute([(chunk_id, score / best) for chunk_id, score, _ in lexical_hits[:top_k]],
+                                        id_filter)
+
+        # MMR 開啟時先取較大的候選集合,再挑出相關且彼此不重複的 top_k
+        use_mmr = bool(index_params.get('mmr_enabled'))
+        pool_k = max(int(index_params.get('mmr_fetch_k') or 0), top_k * HYBRID_FETCH_FACTOR,
+                     MMR_MIN_FETCH_K) if use_mmr else top_k
+        fetch_k = max(top_k * HYBRID_FETCH_FACTOR, pool_k) if lexical_ids else pool_k
+        vector_hits = self._vector_search(index_data, kb_config, query, fetch_k, embed=embed, id_filter=id_filter)
+        if not lexical_ids:
+            hits = vector_hits[:pool_k]
+        else:
+            similarity = dict(vector_hits)
+            fused = self.reciprocal_rank_fusion([[chunk_id for chunk_id, _ in vector_hits], lexical_ids],
+                                                int(index_params.get('rrf_k', RRF_K)))[:pool_k]
+            running = max(similarity.values(), default=1.0)
+            hits = []
+            for chunk_id in fused:
+                running = min(running, similarity.get(chunk_id, running))
+                hits.append((chunk_id, running))
+
+        if use_mmr and len(hits) > top_k:
+            try:
+                vectors = self._reconstruct(index_data, [chunk_id for chunk_id, _ in hits])
+            except RuntimeError as e:
+                print(f"[RAG] 知識庫 {kb_id} 無法還原候選向量,略過 MMR: {str(e)[:100]}")
+            else:
+                order = self.mmr_select(vectors, np.array([score for _, score in hits], dtype='float32'), top_k,
+                                        float(index_params.get('mmr_lambda', MMR_LAMBDA)))
+                return self._substitute([hits[i] for i in order], id_filter)
+        return self._substitute(hits[:top_k], id_filter)
+
+    def _reconstruct(self, index_data: Dict[str, Any], chunk_ids: List[int]) -> np.ndarray:
+        """
+        從索引還原候選 chunk 的向量 (量化索引為近似值)
+        
+        IVF 的 direct map 已在 _load_kb_entry 載入時建立 (舊版格式無法建立時拋出 RuntimeError)
+        """
+        return index_data["index"].reconstruct_batch(np.asarray(chunk_ids, dtype='int64'))
+
+    @staticmethod
+    def mmr_select(vectors: np.ndarray, relevance: np.ndarray, k: int, mmr_lambda: float = MMR_LAMBDA) -> List[int]:
+        """
+        Maximal Marginal Relevance: 依序挑選 λ·相關性 - (1-λ)·與已選結果的最大相似度 最高者
+        
+        候選向量正規化後一次算出兩兩餘弦相似度矩陣,每輪只需更新「與已選結果的最大相似度」向量,
+        50 個候選約數十微秒。回傳挑選順序的候選索引
+        """
+        n = len(vectors)
+        k = min(k, n)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        unit = vectors / np.maximum(norms, 1e-12)
+        similarity = unit @ unit.T
+
+        selected = [int(np.argmax(relevance))]
+        max_similarity = similarity[selected[0]].copy()
+        available = np.ones(n, dtype=bool)
+        available[selected[0]] = False
+        for _ in range(k - 1):
+            scores = mmr_lambda * relevance - (1.0 - mmr_lambda) * max_similarity
+            scores[~available] = -np.inf
+            pick = int(np.argmax(scores))
+            selected.append(pick)
+            available[pick] = False
+            np.maximum(max_similarity, similarity[pick], out=max_similarity)
+        return selected
+
+    def _index_search(self, index_data: Dict[str, Any], vectors: np.ndarray, k: int,
+                      index_params: Dict[str, Any], id_filter: Optional[Dict[str, Any]] = None
+                      ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        FAISS 檢索,有過濾條件時只在候選 chunks 中搜尋
+        
+        候選數不超過 filter_exact_max 時還原候選向量直接計算距離 (精確,且不受 IVF 的 nprobe
+        或 HNSW 圖連通性影響而找不滿 k 筆);否則以 IDSelectorBatch 在搜尋過程中略過其他向量
+        """
         index = index_data["index"]
-        chunks = index_data["chunks"]
-        config = index_data.get("config", {})
+        if id_filter is None:
+            return index.search(vectors, k, params=self._search_params(index, index_params))
+        ids = id_filter["ids"]
+        if len(ids) <= int(index_params.get('filter_exact_max', FILTER_EXACT_MAX)):
+            try:
+                return self._exact_search(vectors, self._reconstruct(index_data, ids), ids, k)
+            except RuntimeError as e:
+                print(f"[RAG] 無法還原候選向量,改用 ID 選擇器: {str(e)[:100]}")
+        selector = id_filter.get("selector")
+        if selector is None:
+            selector = id_filter["selector"] = faiss.IDSelectorBatch(ids)
+        return index.search(vectors, k, params=self._search_params(index, index_params, selector))
+
+    @staticmethod
+    def _exact_search(vectors: np.ndarray, candidates: np.ndarray, ids: np.ndarray,
+                      k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """在候選向量中計算 L2 平方距離取前 k 筆,輸出格式與 index.search 相同 (不足補 -1)"""
+        distances = np.full((len(vectors), k), np.inf, dtype='float32')
+        labels = np.full((len(vectors), k), -1, dtype='int64')
+        found = min(k, len(ids))
+        if found == 0:
+            return distances, labels
+        dist = ((vectors ** 2).sum(axis=1)[:, None] - 2 * vectors @ candidates.T
+                + (candidates ** 2).sum(axis=1)[None, :])
+        np.maximum(dist, 0, out=dist)
+        top = np.argpartition(dist, found - 1, axis=1)[:, :found]
+        top = np.take_along_axis(top, np.take_along_axis(dist, top, axis=1).argsort(axis=1, kind='stable'), axis=1)
+        distances[:, :found] = np.take_along_axis(dist, top, axis=1)
+        labels[:, :found] = ids[top]
+        return distances, labels
+
+    def _vector_search(self, index_data: Dict[str, Any], kb_config: Dict[str, Any], query: str,
+                       k: int, embed=None, id_filter: Optional[Dict[str, Any]] = None) -> List[Tuple[int, float]]:
+        """
+        向量檢索,回傳通過相似度閾值的 [(chunk_id, 相似度), ...] (依距離排序)
         
-        # 如果是 IVF 索引,設定 nprobe
-        if isinstance(index, faiss.IndexIVF):
-            index.nprobe = 10
+        embed(provider, model, dimension) 可由呼叫端提供,讓多個知識庫共用查詢 Embedding;
+        id_filter 為 _resolve_filter 的結果
+        """
+        config = index_data.get("config", {})
+        threshold = float(kb_config.get('similarity_threshold') or 0.0)
             
         # 產生查詢的 Embedding
         provider = config.get('provider', 'openai')
         model = config.get('model', 'text-embedding-3-small')
-        query_embedding = self.get_embeddings([query], provider, model)
+        query_embedding = (embed or functools.partial(self.embed_query, query))(provider, model, config.get('embed_dim'))
+        
+        distances, indices = self._index_search(index_data, query_embedding, k,
+                                                kb_config.get('index_params') or {}, id_filter)
+        hits = []
+        for i, d in zip(indices[0], distances[0]):
+            similarity = min(max(self.distance_to_similarity(d), 0.0), 1.0)
+            if i != -1 and (threshold <= 0 or similarity >= threshold):
+                hits.append((int(i), similarity))
+        return hits
+
+    def search_many(self, kb_id: int, queries: List[str], top_k: Optional[int] = None,
+                    filters: Optional[Dict[str, Any]] = None) -> List[List[Dict[str, Any]]]:
+        """
+        批次向量檢索 (離線評估、常見問題預熱)
         
-        # 進行搜尋
-        distances, indices = index.search(query_embedding, top_k)
+        查詢先查記憶體快取,未命中者依供應商批次限制一起產生 Embedding (並寫回查詢快取),
+        再把所有查詢向量疊成矩陣,每 SEARCH_BATCH_SIZE 筆呼叫一次 FAISS search。
+        套用 similarity_threshold 與 index_params 的檢索參數;不經過 BM25 融合。
+        filters 限定檢索的檔案、標籤與頁碼 (見 normalize_filters),所有查詢共用同一組候選 chunks
         
+        Returns:
+            與 queries 對應的結果列表,每筆為 [{"id", "text", "file_id", "page", "offset", "distance", "similarity"}, ...]
+        """
+        index_data = self._get_kb_entry(kb_id)
+        if index_data is None:
+            raise ValueError("知識庫尚未建立索引")
+        if not queries:
+            return []
+        id_filter = self._resolve_filter(kb_id, index_data, filters)
+        if id_filter is not None and not len(id_filter["ids"]):
+            return [[] for _ in queries]
+
+        chunks = index_data["chunks"]
+        config = index_data.get("config", {})
+        kb_config = self.get_kb_config(kb_id)
+        top_k = top_k or kb_config.get('retrieval_top_k') or 3
+        threshold = float(kb_config.get('similarity_threshold') or 0.0)
+        provider = config.get('provider', 'openai')
+        model = config.get('model', 'text-embedding-3-small')
+        dimension = config.get('embed_dim')
+
+        # 正規化後相同的查詢只產生一次 Embedding
+        normalized = [self._normalize_query(q) for q in queries]
+        unique = list(dict.fromkeys(normalized))
+        vectors = {q: self._query_cache.get((provider, model, dimension, q)) for q in unique}
+        missing = [q for q, v in vectors.items() if v is None]
+        if missing:
+            print(f"[RAG] 批次檢索: 產生 {len(missing)} 個查詢 Embedding (快取命中 {len(unique) - len(missing)})")
+            fresh = self.get_embeddings(missing, provider, model, use_cache=False, dimension=dimension)
+            for q, vector in zip(missing, fresh):
+                vectors[q] = vector.reshape(1, -1)
+                self._query_cache.set((provider, model, dimension, q), vectors[q])
+        matrix = np.ascontiguousarray(np.vstack([vectors[q] for q in normalized]), dtype='float32')
+
+        index_params = kb_config.get('index_params') or {}
         results = []
-        for i in indices[0]:
-            if i != -1 and i < len(chunks):
-                results.append(chunks[i])
-                
+        for start in range(0, len(matrix), SEARCH_BATCH_SIZE):
+            distances, indices = self._index_search(index_data, matrix[start:start + SEARCH_BATCH_SIZE], top_k,
+                                                    index_params, id_filter)
+            for row_ids, row_distances in zip(indices, distances):
+                hits = [(int(i), float(d)) for i, d in zip(row_ids, row_distances) if i != -1]
+                hits = self._substitute([(i, d, self.distance_to_similarity(d)) for i, d in hits], id_filter)
+                if threshold > 0:
+                    hits = [hit for hit in hits if hit[2] >= threshold]
+                records = chunks.get_many([i for i, _, _ in hits])
+                results.append([
+                    dict(record, distance=round(d, 6), similarity=round(similarity, 6))
+                    for record, (_, d, similarity) in zip(records, hits) if record is not None
+                ])
         return results
 
+    @staticmethod
+    def _lexical_confident(hits: List[Tuple[int, float, int]], terms: List[str],
+                           index_params: Dict[str, Any]) -> bool:
+        """
+        關鍵字結果是否足以直接回答
+        
+        第一名須包含查詢的所有詞彙,且分數明顯領先第二名 (fast_path_ratio 倍);
+        適用於產品代碼、人名等精確查詢,一般自然語言問題很少符合
+        """
+        unique_terms = len(set(terms))
+        if not hits or unique_terms == 0 or hits[0][2] < unique_terms:
+            return False
+        ratio = float(index_params.get('fast_path_ratio', FAST_PATH_RATIO))
+        return len(hits) == 1 or hits[0][1] >= ratio * hits[1][1]
+
+    @staticmethod
+    def reciprocal_rank_fusion(rankings: List[List[int]], k: int = RRF_K) -> List[int]:
+        """RRF 融合多個排序: score = Σ 1 / (k + rank)"""
+        scores: Dict[int, float] = {}
+        for ranking in rankings:
+            for rank, chunk_id in enumerate(ranking, start=1):
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+        return sorted(scores, key=scores.get, reverse=True)
+
 # 全域單例
 rag_service = RAGService()
@@ -0,0 +1,84 @@
+"""
+測試文字切分
+驗證串流切分與整份切分的文字與位置一致,以及語義切分的輸出與舊版實作相同
+"""
+import sys
+import os
+import random
+import shutil
+import tempfile
+
+# 添加 backend 目錄到路徑
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ["EMBEDDING_CACHE_ENABLED"] = "false"
+
+from services import rag_service as rs
+from benchmark_chunking import legacy_split, make_corpus
+
+
+def _sample_pages(page_count=120, seed=7):
+    """產生超過串流視窗大小、含段落分隔的多頁文字"""
+    rng = random.Random(seed)
+    words = ["員工", "請假", "應於", "三日前", "提出申請", "經主管核准", "特別休假", "加班費",
+             "依勞基法", "規定計算", "DX-1800", "設備", "保固", "期間"]
+    pages = []
+    for page in range(1, page_count + 1):
+        paragraphs = []
+        for _ in range(rng.randint(8, 14)):
+            sentences = ["".join(rng.choice(words) for _ in range(rng.randint(4, 12))) + "。"
+                         for _ in range(rng.randint(3, 9))]
+            paragraphs.append("".join(sentences))
+        pages.append((page, "\n\n".join(paragraphs) + "\n\n"))
+    return pages
+
+
+def test_chunk_stream_matches_split_text():
+    """串流切分的文字與位置需與整份切分一致"""
+    print("=" * 60)
+    print("測試串流切分與整份切分一致")
+    print("=" * 60)
+
+    svc = rs.RAGService(tempfile.mkdtemp())
+    pages = _sample_pages()
+    text = "".join(page_text for _, page_text in pages)
+    assert len(text) > 2 * rs.STREAM_WINDOW_CHARS, "測試文字需跨越多個串流視窗"
+
+    step = 0
+    for strategy in ("character", "semantic", "recursive"):
+        for chunk_size, chunk_overlap in ((500, 50), (300, 200)):
+            step += 1
+            print(f"\n[{step}] {strategy} chunk_size={chunk_size} overlap={chunk_overlap}...")
+            expected = svc.split_spans(text, strategy, chunk_size, chunk_overlap)
+            streamed = list(svc.chunk_stream(pages, strategy, chunk_size, chunk_overlap))
+            assert [c["text"] for c in streamed] == svc.split_text(text, strategy, chunk_size, chunk_overlap)
+            assert [c["offset"] for c in streamed] == [s for s, _ in expected]
+            print(f"✓ {len(streamed)} 個 chunks 一致")
+
+    shutil.rmtree(svc.index_path, ignore_errors=True)
+
+
+def test_semantic_matches_legacy():
+    """語義切分的 chunks (各句補上 "。") 與舊版字串累加實作相同"""
+    print("=" * 60)
+    print("測試語義切分與舊版輸出一致")
+    print("=" * 60)
+
+    svc = rs.RAGService(tempfile.mkdtemp())
+    texts = [("中文", make_corpus('zh', 0.05)), ("英文", make_corpus('en', 0.05)),
+             ("空白與標點", "  開頭空白。。\n  第二句  ！？  \n\n...  \t結尾沒有標點  "),
+             ("超長句子", "短句。" + "很長" * 400 + "。短句。"),
+             ("只有標點", "。！？\n...")]
+    for step, (name, text) in enumerate(texts, 1):
+        print(f"\n[{step}] {name}...")
+        for chunk_size in (20, 100, 500):
+            expected = legacy_split(text, 'semantic', None, chunk_size, 0)
+            assert svc.split_text(text, 'semantic', chunk_size) == expected, (name, chunk_size)
+        print(f"✓ {len(expected)} 個 chunks 一致")
+
+    shutil.rmtree(svc.index_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    test_chunk_stream_matches_split_text()
+    test_semantic_matches_legacy()
@@ -0,0 +1,88 @@
+"""
+測試近似重複段落合併
+驗證型號不同的段落不合併、完全相同與全形半形差異的段落合併,
+以及分帶鍵隨去重狀態儲存後,增量加入與移除的結果與重新計算一致
+"""
+import sys
+import os
+import tempfile
+
+import numpy as np
+
+# 添加 backend 目錄到路徑
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from services.dedup import DedupIndex, LSH_BANDS
+
+
+def test_dedup_model_numbers():
+    """型號不同的段落不可合併;完全相同與全形半形差異的段落需合併"""
+    print("=" * 60)
+    print("測試近似重複段落合併")
+    print("=" * 60)
+
+    base = "DX-1800 型號設備的保固期間為三年,保固期間內非人為損壞可免費維修,請攜帶購買證明至服務據點。"
+    texts = [
+        base,
+        base.replace("DX-1800", "DX-2000"),
+        base.replace("DX-1800", "DX-1810"),
+        base,
+        base.replace("DX-1800", "ＤＸ－１８００"),
+    ]
+    dedup = DedupIndex()
+    keep = dedup.add(list(range(len(texts))), texts, threshold=0.9)
+
+    print("\n[1] 型號不同的段落...")
+    assert keep[:3].tolist() == [True, True, True], keep
+    print("✓ DX-1800 / DX-2000 / DX-1810 各自保留")
+
+    print("\n[2] 完全相同與全形型號的段落...")
+    assert keep[3:].tolist() == [False, False], keep
+    assert dict(zip(dedup.dup_ids.tolist(), dedup.dup_of.tolist())) == {3: 0, 4: 0}
+    print("✓ 合併到 DX-1800 的代表段落")
+
+
+
+def test_incremental_add_and_remove():
+    """儲存後重新載入的去重狀態,增量加入與移除後仍可找到既有的代表段落"""
+    print("=" * 60)
+    print("測試去重狀態增量更新")
+    print("=" * 60)
+
+    path = os.path.join(tempfile.mkdtemp(), "dedup.npz")
+    articles = [f"第{i}條 員工每年享有特別休假,服務滿{i}年者依規定增加天數,未休完之假期得遞延至次年度使用。"
+                for i in range(1, 31)]
+
+    print("\n[1] 檔案 1 建立去重狀態並儲存...")
+    dedup = DedupIndex()
+    dedup.add([(1 << 32) | i for i in range(len(articles))], articles, threshold=0.9)
+    dedup.save(path)
+    print(f"✓ {len(dedup.ids)} 個代表段落")
+
+    print("\n[2] 載入後加入檔案 2 (重複前 10 條,另有 5 條新條文)...")
+    dedup = DedupIndex.load(path)
+    new_articles = [f"附則第{i}條 本辦法自公布日施行,修正時亦同。" for i in range(5)]
+    keep = dedup.add([(2 << 32) | i for i in range(15)], articles[:10] + new_articles, threshold=0.9)
+    assert keep.tolist() == [False] * 10 + [True] * 5, keep
+    assert dedup.dup_of.tolist() == [(1 << 32) | i for i in range(10)]
+    print("✓ 重複條文合併到檔案 1,新條文成為代表段落")
+
+    print("\n[3] 移除檔案 1 後重新加入被合併的條文...")
+    orphans = dedup.remove_ranges([(1 << 32, 2 << 32)])
+    assert sorted(orphans.tolist()) == [(2 << 32) | i for i in range(10)]
+    keep = dedup.add(orphans, articles[:10], threshold=0.9)
+    assert keep.all(), keep
+    assert len(dedup.ids) == 15 and dedup.duplicate_count == 0
+    print("✓ 被合併的條文提升為代表段落")
+
+    print("\n[4] 分帶鍵與重新計算一致...")
+    rebuilt = DedupIndex(dedup.ids, dedup.signatures, dedup.dup_ids, dedup.dup_of, dedup.keys)
+    assert len(dedup.band_keys) == len(dedup.ids) * LSH_BANDS
+    assert np.array_equal(dedup.band_keys, rebuilt.band_keys)
+    assert np.array_equal(np.sort(dedup.band_rows), np.sort(rebuilt.band_rows))
+    print("✓ 一致")
+
+
+if __name__ == "__main__":
+    test_dedup_model_numbers()
+    test_incremental_add_and_remove()
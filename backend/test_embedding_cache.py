@@ -0,0 +1,108 @@
+"""
+測試 Embedding 快取
+驗證容量滿時依最近使用時間淘汰、淘汰與其他實例 (模擬其他 worker 行程) 的讀取互不干擾,
+以及其他實例只依變更紀錄更新雜湊索引
+"""
+import sys
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# 添加 backend 目錄到路徑
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from services import embedding_cache as ec
+
+DIMENSION = 8
+CAPACITY = 20
+
+
+def _vectors(texts):
+    return np.array([[sum(map(ord, text)) + i for i in range(DIMENSION)] for text in texts], dtype="float32")
+
+
+def _open_cache(path):
+    return ec.EmbeddingCache(path, CAPACITY * (DIMENSION * 4 + ec._ROW_OVERHEAD))
+
+
+def _namespace(cache):
+    return cache._open("local", "test", None)
+
+
+def test_eviction_keeps_recently_used():
+    """容量滿時淘汰最久未使用的向量,被讀取過的向量保留"""
+    print("=" * 60)
+    print("測試 Embedding 快取淘汰")
+    print("=" * 60)
+
+    path = tempfile.mkdtemp()
+    cache = _open_cache(path)
+    texts = [f"chunk {i}" for i in range(CAPACITY)]
+
+    print("\n[1] 寫滿快取並讀取前 5 筆...")
+    cache.put_many("local", "test", None, texts, _vectors(texts))
+    assert _namespace(cache).capacity == CAPACITY
+    hits = cache.get_many("local", "test", None, texts[:5])
+    assert all(np.array_equal(v, e) for v, e in zip(hits, _vectors(texts[:5])))
+    print("✓ 命中 5 筆")
+
+    print("\n[2] 再寫入 5 筆觸發淘汰...")
+    extra = [f"extra {i}" for i in range(5)]
+    cache.put_many("local", "test", None, extra, _vectors(extra))
+    results = cache.get_many("local", "test", None, texts + extra)
+    kept = [text for text, v in zip(texts + extra, results) if v is not None]
+    assert len(kept) <= CAPACITY
+    assert set(texts[:5] + extra) <= set(kept), kept
+    assert not set(texts[5:7]) & set(kept), kept
+    for text, v in zip(texts + extra, results):
+        if v is not None:
+            assert np.array_equal(v, _vectors([text])[0])
+    print(f"✓ 保留 {len(kept)} 筆,最近讀取與新寫入的都在")
+
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def test_eviction_across_instances():
+    """其他實例淘汰後,讀取端延後寫回的使用時間不會讓空列看起來仍在使用"""
+    print("=" * 60)
+    print("測試跨實例淘汰")
+    print("=" * 60)
+
+    path = tempfile.mkdtemp()
+    writer, reader = _open_cache(path), _open_cache(path)
+    texts = [f"chunk {i}" for i in range(CAPACITY)]
+    writer.put_many("local", "test", None, texts, _vectors(texts))
+
+    print("\n[1] 讀取端命中所有向量 (使用時間暫存在行程內)...")
+    assert all(v is not None for v in reader.get_many("local", "test", None, texts))
+    print("✓ 全部命中")
+
+    print("\n[2] 寫入端淘汰後,讀取端寫回使用時間...")
+    rebuilds = []
+    reader_ns = _namespace(reader)
+    original_rebuild = reader_ns._rebuild
+    reader_ns._rebuild = lambda: (rebuilds.append(1), original_rebuild())
+    extra = [f"extra {i}" for i in range(CAPACITY // 2)]
+    writer.put_many("local", "test", None, extra, _vectors(extra))
+    reader_ns.touched_at -= ec._TOUCH_FLUSH_INTERVAL
+    results = reader.get_many("local", "test", None, texts + extra)
+    assert not reader_ns.touched, "使用時間應已寫回"
+    assert not rebuilds, "變更未超過一圈時不應全部重建雜湊索引"
+    assert all(v is not None for v in results[CAPACITY:])
+    print("✓ 讀取端以變更紀錄取得新向量")
+
+    print("\n[3] 檢查空列...")
+    ns = ec._Namespace(_namespace(writer).path, DIMENSION, CAPACITY)
+    empty = ~ns.keys.any(axis=1)
+    assert not ns.stamps[empty].any(), "被淘汰的列不應留有使用時間"
+    assert empty.sum() + len(ns.slots) == CAPACITY
+    print(f"✓ {int(empty.sum())} 個空列皆可重用")
+
+    shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    test_eviction_keeps_recently_used()
+    test_eviction_across_instances()
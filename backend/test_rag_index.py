@@ -0,0 +1,138 @@
+"""
+測試知識庫索引的增量更新與檔案移除
+驗證各索引類型在重新加入、移除檔案後 chunk ID 仍對應正確的段落,
+以及移除檔案後被合併的重複段落會重新提升為代表段落
+
+不需要資料庫與 Embedding 模型:知識庫設定與 Embedding 以測試內的固定函式取代
+"""
+import sys
+import os
+import json
+import shutil
+import tempfile
+
+import numpy as np
+
+# 添加 backend 目錄到路徑
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ["EMBEDDING_CACHE_ENABLED"] = "false"
+
+from services import rag_service as rs
+from services.dedup import DedupIndex
+
+
+def _fake_embed(texts, provider, model, dimension=None):
+    """依文字內容決定的單位向量"""
+    vectors = [np.random.default_rng(sum(map(ord, text)) * 7919 + len(text)).normal(size=16) for text in texts]
+    return np.array([v / np.linalg.norm(v) for v in vectors], dtype="float32")
+
+
+def _make_service(index_type="flat", **index_params):
+    svc = rs.RAGService(tempfile.mkdtemp())
+    svc._embed = _fake_embed
+    params = {"retrieval_mode": "vector", "dedup_threshold": 0, "nprobe": 256}
+    params.update(index_params)
+    config = dict(rs.DEFAULT_KB_CONFIG, embedding_provider="local", embedding_model="test",
+                  index_type=index_type, index_params=params)
+    svc.get_kb_config = lambda kb_id: config
+    return svc, config
+
+
+def test_incremental_update_keeps_ids():
+    """重新加入與移除檔案後,每個索引類型的檢索結果仍對應正確的 chunk"""
+    print("=" * 60)
+    print("測試增量更新後 chunk ID 對應")
+    print("=" * 60)
+
+    # ivf_pq 需要至少 PQ_MIN_TRAINING_POINTS 個向量才會真的建立 IVF-PQ
+    count = rs.PQ_MIN_TRAINING_POINTS // 2 + 100
+    files = {1: [f"alpha {i} x{i * 7}" for i in range(count)],
+             2: [f"beta {i} y{i * 3}" for i in range(count)]}
+
+    for step, index_type in enumerate(("flat", "ivf", "ivf_pq", "hnsw", "sq8"), 1):
+        print(f"\n[{step}] {index_type}...")
+        svc, config = _make_service(index_type)
+        svc.create_kb_index(1, files, config)
+
+        svc.update_kb_index(1, {1: files[1]}, config)
+        assert svc.query_kb(1, "beta 5 y15", top_k=1) == ["beta 5 y15"]
+        assert svc.query_kb(1, "alpha 5 x35", top_k=1) == ["alpha 5 x35"]
+
+        svc.remove_files_from_index(1, [2])
+        assert svc._get_kb_entry(1)["index"].ntotal == count
+        assert svc.query_kb(1, "alpha 9 x63", top_k=1) == ["alpha 9 x63"]
+        assert "beta 5 y15" not in svc.query_kb(1, "beta 5 y15", top_k=5)
+        print(f"✓ {index_type} 更新與移除後檢索正確")
+        shutil.rmtree(svc.storage_path, ignore_errors=True)
+
+
+def test_remove_files_promotes_duplicates():
+    """移除代表段落所屬檔案後,其他檔案的重複段落需重新加入索引"""
+    print("=" * 60)
+    print("測試移除檔案後重複段落重新提升")
+    print("=" * 60)
+
+    svc, config = _make_service(dedup_threshold=0.9)
+    shared = "第十二條 員工每年享有特別休假七日,服務滿三年者增加為十日,未休完之假期得遞延至次年度使用。"
+    other = "第十三條 加班費依勞基法規定計算,平日加班前兩小時加給三分之一。"
+    kb_id = 1
+
+    print("\n[1] 建立索引 (檔案 2 含檔案 1 的重複段落)...")
+    svc.create_kb_index(kb_id, {1: [shared], 2: [shared, other]}, config)
+    dedup = DedupIndex.load(svc._kb_paths(kb_id)["dedup"])
+    assert dedup.duplicate_count == 1
+    assert svc._get_kb_entry(kb_id)["index"].ntotal == 2
+    print("✓ 重複段落已合併")
+
+    print("\n[2] 移除檔案 1...")
+    svc.remove_files_from_index(kb_id, [1])
+    dedup = DedupIndex.load(svc._kb_paths(kb_id)["dedup"])
+    lo, hi = rs.RAGService.chunk_id_range(1)
+    assert dedup.duplicate_count == 0
+    assert not ((dedup.ids >= lo) & (dedup.ids < hi)).any(), dedup.ids
+    assert len(dedup.ids) == 2
+    assert svc._get_kb_entry(kb_id)["index"].ntotal == 2
+    print("✓ 檔案 1 的 chunks 已移除,重複段落已提升")
+
+    print("\n[3] 檢索被提升的段落...")
+    results = svc.query_kb(kb_id, shared, top_k=5)
+    assert shared in results, results
+    print("✓ 仍可檢索到檔案 2 的段落")
+
+    shutil.rmtree(svc.storage_path, ignore_errors=True)
+
+
+def test_remove_from_legacy_index_requires_rebuild():
+    """舊版格式 (包在 IndexIDMap2 內的 IVF) 無法就地移除,需要求整體重建"""
+    print("=" * 60)
+    print("測試舊版索引移除檔案")
+    print("=" * 60)
+
+    svc, config = _make_service("ivf")
+    svc.create_kb_index(1, {1: [f"alpha {i}" for i in range(50)], 2: [f"beta {i}" for i in range(50)]}, config)
+    meta_path = svc._kb_paths(1)["meta"]
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    meta["version"] = 3
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+    print("\n[1] 增量更新...")
+    assert not svc.is_index_compatible(1, config)
+    print("✓ 判定為不相容")
+
+    print("\n[2] 移除檔案...")
+    try:
+        svc.remove_files_from_index(1, [2])
+        raise AssertionError("舊版索引應拋出 IndexRebuildRequired")
+    except rs.IndexRebuildRequired:
+        print("✓ 拋出 IndexRebuildRequired")
+
+    shutil.rmtree(svc.storage_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    test_incremental_update_keeps_ids()
+    test_remove_files_promotes_duplicates()
+    test_remove_from_legacy_index_requires_rebuild()
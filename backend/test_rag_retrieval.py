@@ -0,0 +1,135 @@
+"""
+測試知識庫檢索
+驗證 RRF 融合順序、關鍵字索引增量合併的結果與整體重建一致,
+以及從磁碟重新載入的知識庫 (含增量更新、移除過檔案的 IVF 索引) 可以進行 MMR 多樣化重排
+
+不需要資料庫與 Embedding 模型:知識庫設定與 Embedding 以測試內的固定函式取代
+"""
+import sys
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# 添加 backend 目錄到路徑
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ["EMBEDDING_CACHE_ENABLED"] = "false"
+
+from services import rag_service as rs
+from services.lexical_index import LexicalIndex, tokenize
+
+
+def _fake_embed(texts, provider, model, dimension=None):
+    """依文字內容決定的單位向量"""
+    vectors = [np.random.default_rng(sum(map(ord, text)) * 7919 + len(text)).normal(size=16) for text in texts]
+    return np.array([v / np.linalg.norm(v) for v in vectors], dtype="float32")
+
+
+def _make_service(storage_path, config):
+    svc = rs.RAGService(storage_path)
+    svc._embed = _fake_embed
+    svc.get_kb_config = lambda kb_id: config
+    return svc
+
+
+def test_reciprocal_rank_fusion():
+    """RRF 依 Σ 1/(k + 名次) 排序"""
+    print("=" * 60)
+    print("測試 RRF 融合順序")
+    print("=" * 60)
+
+    print("\n[1] 兩份排名部分重疊...")
+    # 1: 1/61 + 1/62, 3: 1/63 + 1/61, 2: 1/62, 4: 1/63
+    fused = rs.RAGService.reciprocal_rank_fusion([[1, 2, 3], [3, 1, 4]])
+    assert list(fused) == [1, 3, 2, 4], fused
+    print(f"✓ 融合順序: {list(fused)}")
+
+    print("\n[2] 兩份排名都出現者優先於只在一份排第一者...")
+    fused = rs.RAGService.reciprocal_rank_fusion([[10, 20], [20, 30]])
+    assert list(fused)[0] == 20, fused
+    print(f"✓ 融合順序: {list(fused)}")
+
+
+def test_lexical_incremental_merge():
+    """增量加入與移除檔案後的關鍵字索引,與以相同 chunks 整體重建的結果一致"""
+    print("=" * 60)
+    print("測試關鍵字索引增量合併")
+    print("=" * 60)
+
+    path = tempfile.mkdtemp()
+    files = {
+        1: ["員工請假應於三日前提出申請", "DX-1800 保固三年", "加班費依勞基法規定計算"],
+        2: ["DX-2000 保固兩年,A1-203 型號另計", "特別休假依年資計算"],
+        3: ["gpt-4o 模型設定", "員工 DX-1800 操作手冊"],
+    }
+
+    def chunk_ids(file_id):
+        return [rs.RAGService.chunk_id_range(file_id)[0] + i for i in range(len(files[file_id]))]
+
+    def snapshot(index):
+        terms = [index.terms[i] for i in range(len(index.terms))]
+        postings = {term: sorted(zip(index.postings[index.indptr[i]:index.indptr[i + 1]].tolist(),
+                                     index.tf[index.indptr[i]:index.indptr[i + 1]].tolist()))
+                    for i, term in enumerate(terms)}
+        return terms, postings, index.docs.tolist(), index.doc_len.tolist()
+
+    print("\n[1] 檔案 1 建立索引,增量加入檔案 2、3...")
+    index = LexicalIndex.build(os.path.join(path, "v1"), chunk_ids(1), files[1])
+    index = LexicalIndex.build(os.path.join(path, "v2"), chunk_ids(2), files[2], base=index,
+                               drop_ranges=[rs.RAGService.chunk_id_range(2)])
+    index = LexicalIndex.build(os.path.join(path, "v3"), chunk_ids(3), files[3], base=index,
+                               drop_ranges=[rs.RAGService.chunk_id_range(3)])
+
+    print("\n[2] 移除檔案 1,重新加入修改後的檔案 2...")
+    files[2] = ["DX-2000 保固延長為三年", "新增 B7-100 型號"]
+    index = LexicalIndex.build(os.path.join(path, "v4"), chunk_ids(2), files[2], base=index,
+                               drop_ranges=[rs.RAGService.chunk_id_range(1), rs.RAGService.chunk_id_range(2)])
+    del files[1]
+
+    full = LexicalIndex.build(os.path.join(path, "full"), chunk_ids(2) + chunk_ids(3), files[2] + files[3])
+    assert snapshot(index) == snapshot(full)
+    for query in ("DX-1800 保固", "B7-100", "員工請假", "203"):
+        assert index.search(tokenize(query), 5) == full.search(tokenize(query), 5), query
+    print("✓ 詞彙表、postings 與檢索結果都與整體重建一致")
+
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def test_mmr_on_reloaded_kb():
+    """增量更新與移除檔案後,新行程載入的索引仍可還原候選向量進行 MMR"""
+    print("=" * 60)
+    print("測試重新載入的知識庫 MMR 重排")
+    print("=" * 60)
+
+    files = {1: [f"alpha {i} x{i * 7}" for i in range(200)],
+             2: [f"beta {i} y{i * 3}" for i in range(200)],
+             3: [f"gamma {i} z{i * 5}" for i in range(200)]}
+
+    for step, index_type in enumerate(("flat", "ivf", "hnsw"), 1):
+        print(f"\n[{step}] {index_type}...")
+        storage = tempfile.mkdtemp()
+        config = dict(rs.DEFAULT_KB_CONFIG, embedding_provider="local", embedding_model="test",
+                      index_type=index_type,
+                      index_params={"retrieval_mode": "vector", "dedup_threshold": 0, "nprobe": 256})
+        writer = _make_service(storage, config)
+        writer.create_kb_index(1, {1: files[1], 2: files[2]}, config)
+        writer.update_kb_index(1, {3: files[3]}, config)
+        writer.remove_files_from_index(1, [2])
+
+        # 模擬另一個 worker: 全新的服務實例從磁碟載入索引
+        config["index_params"]["mmr_enabled"] = True
+        reader = _make_service(storage, config)
+        results = reader.query_kb(1, "gamma 5 z25", top_k=4)
+        assert results[0] == "gamma 5 z25", results
+        assert len(results) == 4 and len(set(results)) == 4, results
+        assert not any(text.startswith("beta") for text in results), results
+        print(f"✓ MMR 結果: {results}")
+        shutil.rmtree(storage, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    test_reciprocal_rank_fusion()
+    test_lexical_incremental_merge()
+    test_mmr_on_reloaded_kb()